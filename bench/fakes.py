@@ -0,0 +1,148 @@
+"""
+Local stand-ins for every external service, so the app can be benchmarked on one box with no network:
+  - Mongo:         mongomock behind the real DBClient / MongoCRUD
+  - Redis:         fakeredis (with Lua), or a real local Redis when BENCH_REDIS_HOST is set
+  - RabbitMQ:      an in-process publisher that applies events with the receiver's own handlers
+  - Google Books:  an httpx MockTransport serving canned, deterministic volumes
+
+install() has to run before main / the routers are imported, because they bind these clients at import time.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import asyncio, hashlib, json, os
+
+import httpx
+
+FAKE_BASE_URL = "https://books.bench.invalid/books/v1/volumes"
+
+
+class InProcessPublisher:
+    """
+    Drop-in for RabbitPublisher: every publish is serialized like the real one and
+    applied to the cache straight away by receiver.py's message handlers.
+    """
+    def __init__(self, redis_client, handlers):
+        self.redis_client = redis_client
+        self.handlers = handlers
+        self.published = 0
+
+    def start(self):
+        pass
+
+    def close(self, timeout: float = 5.0):
+        pass
+
+    def publish(self, routing_key: str, msg: dict[str, any]) -> bool:
+        from utils.utils import datetime_serializer
+
+        data = json.loads(json.dumps(msg, default=datetime_serializer))
+        pipe = self.redis_client.pipeline(transaction=False)
+        self.handlers[routing_key](pipe, data)
+        pipe.execute()
+        self.published += 1
+        return True
+
+
+def fake_volume(volume_id: str) -> dict[str, any]:
+    n = int(hashlib.md5(volume_id.encode()).hexdigest()[:6], 16)
+    return {
+        "id": volume_id,
+        "volumeInfo": {
+            "title": f"Book {volume_id}",
+            "authors": [f"Author {n % 97}"],
+            "pageCount": 100 + n % 400,
+            "averageRating": (n % 5) + 0.5,
+            "language": "en",
+            "categories": ["Fiction"],
+            "industryIdentifiers": [{"type": "ISBN_13", "identifier": f"978{n:010d}"[:13]}],
+            "description": f"Description of {volume_id}. " * 20,
+            "imageLinks": {"thumbnail": f"https://img.bench.invalid/{volume_id}/t", "large": f"https://img.bench.invalid/{volume_id}/l"},
+        },
+    }
+
+
+def google_books_transport(latency: float = 0.0) -> httpx.MockTransport:
+    """
+    Serves '<base>?q=...' searches and '<base>/<id>' volume lookups.
+    Results depend only on the query, so repeated searches hit the same volumes.
+    'latency' (seconds) is added to every upstream call.
+    """
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if latency:
+            await asyncio.sleep(latency)
+
+        path = request.url.path.rstrip("/")
+        base_path = httpx.URL(FAKE_BASE_URL).path
+        if path == base_path:
+            query = request.url.params.get("q", "")
+            max_results = int(request.url.params.get("maxResults", 15))
+            start_index = int(request.url.params.get("startIndex", 0))
+            prefix = hashlib.md5(query.encode()).hexdigest()[:8]
+            items = [fake_volume(f"{prefix}{i:04d}") for i in range(start_index, start_index + max_results)]
+            return httpx.Response(200, json={"totalItems": 1000, "items": items})
+
+        if path.startswith(base_path + "/"):
+            return httpx.Response(200, json=fake_volume(path.rsplit("/", 1)[1]))
+
+        return httpx.Response(404, json={"error": "not found"})
+
+    return httpx.MockTransport(handler)
+
+
+def install(upstream_latency: float = 0.0):
+    """
+    Points DBClient, redis_client, RabbitPublisher and HttpClient at the local stand-ins.
+    Returns the redis client in use.
+    """
+    os.environ.setdefault("BASE_URL", FAKE_BASE_URL)
+    os.environ.setdefault("BOOK_API", "bench")
+    # measure the app, not the Google Books rate limiter (set these to benchmark the limiter itself)
+    os.environ.setdefault("GOOGLE_BOOKS_RATE", "1000000")
+    os.environ.setdefault("GOOGLE_BOOKS_BURST", "1000000")
+    # mongomock has no $text, so searches skip the local catalog tier
+    os.environ.setdefault("SEARCH_LOCAL", "false")
+
+    import mongomock
+    import lib.redis
+    from lib.mongo import DBClient
+    from lib.rabbit import RabbitPublisher, queue_shards
+    from lib.http import HttpClient
+    import constants
+
+    # mongomock's bulk builder predates the 'sort' option pymongo 4.11+ passes for UpdateOne / ReplaceOne
+    from mongomock.collection import BulkOperationBuilder
+    add_update = BulkOperationBuilder.add_update
+    BulkOperationBuilder.add_update = lambda self, *args, sort=None, **kwargs: add_update(self, *args, **kwargs)
+
+    # Mongo: skip DBClient.__init__ (which connects over TLS) and wire up mongomock instead.
+    # mongomock isn't thread safe, so queries get a single executor thread.
+    db_client = DBClient.__new__(DBClient)
+    db_client.client = mongomock.MongoClient()
+    db_client.db = db_client.client["bench"]
+    db_client.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mongo")
+    db_client.indexes = {}
+    DBClient._instance = db_client
+
+    # Redis
+    redis_host = os.getenv("BENCH_REDIS_HOST")
+    if redis_host:
+        import redis
+        redis_client = redis.Redis(host=redis_host, port=6379, db=15, decode_responses=True)
+        redis_client.flushdb()
+    else:
+        import fakeredis
+        redis_client = fakeredis.FakeRedis(decode_responses=True)
+    lib.redis.redis_client = redis_client
+
+    # RabbitMQ: route events straight to the receiver's handlers
+    from receiver import apply_fav_message, apply_lib_message
+    handlers = {}
+    for base_queue, handler in ((constants.RABBIT_QUEUE_FAV, apply_fav_message), (constants.RABBIT_QUEUE_LIB, apply_lib_message)):
+        for shard in queue_shards(base_queue):
+            handlers[shard] = handler
+    handlers.update({constants.RABBIT_QUEUE_FAV: apply_fav_message, constants.RABBIT_QUEUE_LIB: apply_lib_message})
+    RabbitPublisher._instance = InProcessPublisher(redis_client, handlers)
+
+    # Google Books
+    HttpClient(transport=google_books_transport(upstream_latency))
+
+    return redis_client
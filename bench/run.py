@@ -0,0 +1,241 @@
+"""
+Offline benchmark for every endpoint. Runs the real app in process against the stand-ins in bench/fakes.py
+and reports throughput & p50/p95/p99 latency per route.
+
+    pip install -r requirements.txt -r bench/requirements.txt
+    python -m bench.run --concurrency 32 --requests 2000
+    python -m bench.run --routes search,my_books --latency 0.05 --json bench_output.json
+
+Set BENCH_REDIS_HOST to run against a real (local) Redis instead of fakeredis; db 15 is flushed first.
+"""
+from collections import Counter
+from dataclasses import dataclass, field
+import argparse, asyncio, json, logging, os, random, statistics, sys, time
+
+import httpx
+
+from bench import fakes
+from schemas.book import library_entry, catalog_entry
+
+
+@dataclass
+class RouteResult:
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+    statuses: Counter = field(default_factory=Counter)
+
+    def summary(self, elapsed: float) -> dict[str, any]:
+        ordered = sorted(self.latencies)
+        def pct(p: float) -> float:
+            if not ordered:
+                return 0.0
+            return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+        return {
+            "requests": len(ordered),
+            "errors": self.errors,
+            "statuses": dict(self.statuses),
+            "rps": round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+            "mean_ms": round(statistics.fmean(ordered) * 1000, 2) if ordered else 0.0,
+            "p50_ms": round(pct(50), 2),
+            "p95_ms": round(pct(95), 2),
+            "p99_ms": round(pct(99), 2),
+        }
+
+
+def make_book(book_id: str, **overrides) -> dict[str, any]:
+    volume_info = fakes.fake_volume(book_id)["volumeInfo"]
+    return {
+        "id": book_id,
+        "title": volume_info["title"],
+        "description": volume_info["description"],
+        "page_count": volume_info["pageCount"],
+        "average_rating": volume_info["averageRating"],
+        "language": "en",
+        "authors": volume_info["authors"],
+        "isbn": [{"identifier": i["identifier"], "type": i["type"]} for i in volume_info["industryIdentifiers"]],
+        "genre": volume_info["categories"],
+        "cover_img": list(volume_info["imageLinks"].values()),
+        "is_favorite": False,
+        "reading_progress": {"page_bookmark": 0, "is_finished": False, "is_reading": False},
+        **overrides,
+    }
+
+
+class Workload:
+    """
+    Builds requests for each route. Users and their seeded books are fixed by the seed,
+    so two runs with the same arguments send the same requests.
+    """
+    def __init__(self, users: int, books_per_user: int, queries: int, seed: int):
+        self.rng = random.Random(seed)
+        self.users = [f"bench-user-{i}" for i in range(users)]
+        self.books_per_user = books_per_user
+        self.queries = [f"query {i}" for i in range(queries)]
+        self.counter = 0
+        self.added: list[tuple[str, str]] = []
+
+    def seeded_book(self, uid: str) -> str:
+        return f"{uid}-book-{self.rng.randrange(self.books_per_user)}"
+
+    def fresh_book(self, uid: str) -> str:
+        self.counter += 1
+        book_id = f"{uid}-new-{self.counter}"
+        self.added.append((uid, book_id))
+        return book_id
+
+    def seed_docs(self) -> tuple[list[dict[str, any]], list[dict[str, any]]]:
+        """
+        Returns the library documents and the catalog entries of the seeded books.
+        """
+        docs, catalog = [], []
+        for uid in self.users:
+            for i in range(self.books_per_user):
+                progress = {"page_bookmark": i, "is_finished": i % 3 == 0, "is_reading": i % 3 == 1}
+                book = make_book(f"{uid}-book-{i}", is_favorite=i % 4 == 0, reading_progress=progress)
+                docs.append({"user_id": uid, "book": library_entry(book)})
+                catalog.append({"_id": book["id"], **catalog_entry(book)})
+        return docs, catalog
+
+    def request(self, route: str) -> tuple[str, str, dict[str, any]]:
+        """
+        Returns (method, path, httpx kwargs) for one call to 'route'.
+        """
+        uid = self.rng.choice(self.users)
+        match route:
+            case "remove_book" if self.added:
+                # removes a book added earlier in the run, so the seeded libraries stay intact
+                uid, book_id = self.added.pop(self.rng.randrange(len(self.added)))
+                return "DELETE", "/lib/remove-my-book", {"json": {"user_id": uid, "book_id": book_id}}
+            case "search":
+                return "GET", "/search", {"params": {"bookname": self.rng.choice(self.queries), "uid": uid}}
+            case "suggest":
+                query = self.rng.choice(self.queries)
+                return "GET", "/search/suggest", {"params": {"prefix": query[:self.rng.randint(2, len(query))]}}
+            case "recent_searches":
+                return "POST", "/recent-searches", {"json": {"uid": uid, "search_item": self.rng.choice(self.queries)}}
+            case "my_books":
+                return "GET", "/lib/my-books", {"params": {"uid": uid}}
+            case "my_books_page":
+                return "GET", "/lib/my-books", {"params": {"uid": uid, "limit": 20}}
+            case "my_books_stream":
+                return "GET", "/lib/my-books", {"params": {"uid": uid, "stream": "true"}}
+            case "completed_books":
+                return "GET", "/lib/completed-books", {"params": {"uid": uid}}
+            case "in_progress_books":
+                return "GET", "/lib/in-progress-books", {"params": {"uid": uid}}
+            case "get_favorites":
+                return "GET", "/book/get-favorites", {"params": {"uid": uid}}
+            case "add_book":
+                return "POST", "/lib/add-book", {"json": {"user_id": uid, "book": make_book(self.fresh_book(uid))}}
+            case "update_progress":
+                return "PATCH", "/lib/update-book-progress", {"json": {"user_id": uid, "book_id": self.seeded_book(uid), "page": self.rng.randrange(1, 300)}}
+            case "add_favorite":
+                return "POST", "/book/add-to-favorite", {"json": {"user_id": uid, "book": make_book(self.seeded_book(uid))}}
+            case "remove_favorite":
+                return "PATCH", "/book/remove-favorite", {"json": {"user_id": uid, "book_id": self.seeded_book(uid), "is_favorite": False}}
+            case "remove_book":
+                # nothing left to remove: measures the not found path
+                return "DELETE", "/lib/remove-my-book", {"json": {"user_id": uid, "book_id": f"{uid}-missing"}}
+            case "bulk_add":
+                return "POST", "/lib/bulk-add-books", {"json": {"user_id": uid, "books": [make_book(self.fresh_book(uid)) for _ in range(20)]}}
+            case "bulk_update_progress":
+                updates = [{"book_id": self.seeded_book(uid), "page": self.rng.randrange(1, 300)} for _ in range(20)]
+                return "PATCH", "/lib/bulk-update-book-progress", {"json": {"user_id": uid, "updates": updates}}
+        raise ValueError(f"Unknown route '{route}'")
+
+
+ROUTES = [
+    "search", "suggest", "recent_searches", "my_books", "my_books_page", "my_books_stream", "completed_books", "in_progress_books", "get_favorites",
+    "add_book", "update_progress", "add_favorite", "remove_favorite", "remove_book", "bulk_add", "bulk_update_progress",
+]
+
+
+async def run_route(client: httpx.AsyncClient, workload: Workload, route: str, requests: int, concurrency: int) -> dict[str, any]:
+    result = RouteResult()
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            method, path, kwargs = workload.request(route)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+                await response.aread()
+                result.statuses[response.status_code] += 1
+                ok = response.status_code < 500
+            except Exception as e:
+                logging.error(f"{route}: {e!r}")
+                ok = False
+            result.latencies.append(time.perf_counter() - start)
+            if not ok:
+                result.errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return result.summary(time.perf_counter() - start)
+
+
+async def main(args: argparse.Namespace) -> dict[str, any]:
+    fakes.install(upstream_latency=args.latency)
+
+    # imported only now, the app binds its clients at import time
+    from lib.mongo import DBClient
+    from main import app
+
+    # importing main sets the root level from LOG_LEVEL (INFO by default), run the app at --log-level instead
+    logging.getLogger().setLevel(args.log_level)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    workload = Workload(args.users, args.books_per_user, args.queries, args.seed)
+    docs, catalog = workload.seed_docs()
+    DBClient.get_instance().db["books"].insert_many(docs)
+    DBClient.get_instance().db["catalog"].insert_many(catalog)
+
+    transport = httpx.ASGITransport(app=app)
+    results = {}
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for route in args.routes:
+            if args.warmup:
+                await run_route(client, workload, route, args.warmup, args.concurrency)
+            results[route] = await run_route(client, workload, route, args.requests, args.concurrency)
+            print_row(route, results[route])
+
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "json"},
+        "results": results,
+    }
+
+
+def print_row(route: str, summary: dict[str, any]):
+    print(f"{route:<22}{summary['requests']:>8}{summary['errors']:>8}{summary['rps']:>10}"
+          f"{summary['p50_ms']:>10}{summary['p95_ms']:>10}{summary['p99_ms']:>10}", flush=True)
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline benchmark for the book API")
+    parser.add_argument("--routes", default=",".join(ROUTES), type=lambda s: s.split(","), help=f"comma separated subset of: {','.join(ROUTES)}")
+    parser.add_argument("--requests", type=int, default=500, help="measured requests per route")
+    parser.add_argument("--warmup", type=int, default=50, help="unmeasured requests per route, run first")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--books-per-user", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=50, help="distinct search queries")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of simulated Google Books latency per call")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING", help="app log level during the run")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    unknown = set(args.routes) - set(ROUTES)
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    print(f"{'route':<22}{'requests':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    report = asyncio.run(main(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
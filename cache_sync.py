@@ -0,0 +1,202 @@
+import os, json, time, sys, logging, redis
+from bson import ObjectId
+from prometheus_client import start_http_server
+from pymongo.errors import PyMongoError, OperationFailure
+from dotenv import load_dotenv
+
+# before the imports below, they read their settings from the environment when imported
+load_dotenv()
+
+from lib import book_cache, metrics
+from lib.mongo import DBClient
+from lib.rabbit import CACHE_SYNC
+from lib.redis import InstrumentedRedis
+from log import setup_global_logger
+import constants
+
+# Keeps the library & favorites caches in sync by tailing the 'books' collection's change stream,
+# instead of the per route RabbitMQ events receiver.py applies. Run exactly one of these, with CACHE_SYNC=change_stream
+# set for the API so routes stop publishing. Change streams need a replica set (a single node one is fine).
+
+logger = logging.getLogger("cache_sync")
+
+CACHE_SYNC_LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+MONGO_URI = os.getenv("MONGO_URI")
+DB_NAME = os.getenv("DB_NAME")
+
+CACHE_SYNC_BATCH_SIZE = int(os.getenv("CACHE_SYNC_BATCH_SIZE", "100"))        # max events applied per redis transaction
+CACHE_SYNC_BATCH_WINDOW = float(os.getenv("CACHE_SYNC_BATCH_WINDOW", "0.05"))  # seconds to wait for a batch to fill
+CACHE_SYNC_METRICS_PORT = int(os.getenv("CACHE_SYNC_METRICS_PORT", "9200"))    # serves /metrics on this port, 0 turns it off
+
+COLLECTION = "books"
+METRICS_QUEUE = "change_stream"     # 'queue' label of the consumer metrics
+
+# Mongo error codes meaning the stored resume token can't be used any more
+HISTORY_LOST_CODES = {
+    136,    # CappedPositionLost
+    260,    # InvalidResumeToken
+    280,    # ChangeStreamFatalError
+    286,    # ChangeStreamHistoryLost
+}
+
+WATCH_PIPELINE = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+
+
+def _score(doc: dict[str, any]) -> float | None:
+    # the same score a rebuild gives the book, so updates keep its position
+    return doc["_id"].generation_time.timestamp() if isinstance(doc.get("_id"), ObjectId) else None
+
+
+def _favorite_changed(change: dict[str, any]) -> bool:
+    description = change.get("updateDescription") or {}
+    fields = [*(description.get("updatedFields") or {}), *(description.get("removedFields") or [])]
+    return any(field == "book" or field.startswith("book.is_favorite") for field in fields)
+
+
+def apply_change(r: redis.Redis, change: dict[str, any]) -> str:
+    """
+    Mirrors one change event into the caches. 'r' may be a pipeline.
+    Returns the outcome for the metrics.
+    """
+    operation = change["operationType"]
+
+    if operation == "delete":
+        # a delete event only carries the _id, the user & book come from the pre-image
+        doc = change.get("fullDocumentBeforeChange")
+        if not doc:
+            logger.error("Delete without a pre-image, caches may keep the book until they expire", extra={"document_id": str(change["documentKey"]["_id"])})
+            return "no_pre_image"
+        book_cache.remove_book(r, doc["user_id"], doc["book"]["id"], book_cache.LIB)
+        book_cache.remove_book(r, doc["user_id"], doc["book"]["id"], book_cache.FAV)
+        return "applied"
+
+    # the document as it is now; None if it was deleted since, its delete event follows
+    doc = change.get("fullDocument")
+    if not doc:
+        return "skipped"
+
+    uid, book, score = doc["user_id"], doc["book"], _score(doc)
+    book_cache.put_book(r, uid, book, book_cache.LIB, score)
+    if book.get("is_favorite"):
+        book_cache.put_book(r, uid, book, book_cache.FAV, score)
+    elif operation == "replace" or (operation == "update" and _favorite_changed(change)):
+        book_cache.remove_book(r, uid, book["id"], book_cache.FAV)
+    return "applied"
+
+
+def load_resume_token(r: redis.Redis) -> dict[str, any] | None:
+    token = r.get(constants.CACHE_SYNC_RESUME_TOKEN_KEY)
+    return json.loads(token) if token else None
+
+
+def enable_pre_images(db):
+    """
+    Delete events need the deleted document (MongoDB 6.0+). Without it deletes can't be mirrored.
+    """
+    try:
+        db.command("collMod", COLLECTION, changeStreamPreAndPostImages={"enabled": True})
+    except PyMongoError as e:
+        logger.error(f"Could not enable change stream pre-images on '{COLLECTION}': {e}")
+
+
+def sync(db, redis_client: redis.Redis):
+    """
+    Tails the change stream, applying events to redis in batches. Each batch and the resume token
+    of its last event are written in one transaction, so after a restart no event is lost or applied twice.
+    """
+    token = load_resume_token(redis_client)
+    if token is None:
+        # no history to resume from: caches built before now may have missed writes
+        book_cache.drop_all(redis_client)
+
+    batch: list[dict[str, any]] = []
+
+    def flush(resume_token: dict[str, any]):
+        start = time.perf_counter()
+        pipe = redis_client.pipeline(transaction=True)
+        outcomes = []
+        for change in batch:
+            try:
+                outcomes.append((change, apply_change(pipe, change)))
+            except (KeyError, TypeError, AttributeError) as e:
+                # not a book document we know how to cache; skipping it can't break later events
+                logger.error(f"Skipping change event: {e!r}", extra={"document_id": str(change.get("documentKey", {}).get("_id"))})
+                outcomes.append((change, "malformed"))
+        pipe.set(constants.CACHE_SYNC_RESUME_TOKEN_KEY, json.dumps(resume_token))
+        pipe.execute()
+
+        now = time.time()
+        for change, outcome in outcomes:
+            metrics.CONSUMER_MESSAGES.labels(METRICS_QUEUE, change["operationType"], outcome).inc()
+            if "wallTime" in change:
+                metrics.CONSUMER_LAG_SECONDS.observe(max(0.0, now - change["wallTime"].timestamp()))
+        metrics.CONSUMER_BATCH_SIZE.observe(len(batch))
+        metrics.CONSUMER_BATCH_SECONDS.observe(time.perf_counter() - start)
+        logger.debug(f"Applied batch of {len(batch)} change events")
+        batch.clear()
+
+    with db[COLLECTION].watch(
+        WATCH_PIPELINE,
+        full_document="updateLookup",
+        full_document_before_change="whenAvailable",
+        resume_after=token,
+        max_await_time_ms=max(1, int(CACHE_SYNC_BATCH_WINDOW * 1000)),
+    ) as stream:
+        logger.info(f"Watching '{COLLECTION}' " + ("from the stored resume token" if token else "from now"))
+        saved_token = token
+        while stream.alive:
+            # wait for the first event, then give the batch a short window to fill
+            deadline = time.monotonic() + CACHE_SYNC_BATCH_WINDOW
+            while len(batch) < CACHE_SYNC_BATCH_SIZE:
+                change = stream.try_next()
+                if change is not None:
+                    batch.append(change)
+                elif not batch or time.monotonic() >= deadline:
+                    break
+            if batch:
+                flush(stream.resume_token)
+                saved_token = stream.resume_token
+            elif stream.resume_token != saved_token:
+                # idle: keep the token moving so a restart doesn't rescan oplog entries we don't care about
+                redis_client.set(constants.CACHE_SYNC_RESUME_TOKEN_KEY, json.dumps(stream.resume_token))
+                saved_token = stream.resume_token
+
+
+def main():
+    setup_global_logger(log_file_path=None, level=CACHE_SYNC_LOG_LEVEL)
+    if CACHE_SYNC != "change_stream":
+        logger.warning("CACHE_SYNC isn't 'change_stream': the API also publishes cache events, run either this or receiver.py")
+
+    if CACHE_SYNC_METRICS_PORT:
+        start_http_server(CACHE_SYNC_METRICS_PORT)
+
+    db = DBClient.get_instance(uri=MONGO_URI, db_name=DB_NAME).db
+    redis_client = InstrumentedRedis(host=REDIS_HOST, port=6379, db=0, decode_responses=True)
+    enable_pre_images(db)
+
+    retry_interval = 1
+    while True:
+        try:
+            sync(db, redis_client)
+            retry_interval = 1
+        except KeyboardInterrupt:
+            logger.info("Shutting down...")
+            return
+        except OperationFailure as e:
+            if e.code not in HISTORY_LOST_CODES:
+                logger.error(f"Change stream failed: {e}")
+                sys.exit(1)
+            # the oplog moved past the stored token: start over from now with empty caches
+            logger.error(f"Can't resume the change stream ({e}), starting from now")
+            redis_client.delete(constants.CACHE_SYNC_RESUME_TOKEN_KEY)
+        except (PyMongoError, redis.RedisError) as e:
+            # the unapplied batch is replayed from the stored token
+            logger.error(f"Cache sync interrupted: {e}. Retrying in {retry_interval}s")
+            time.sleep(retry_interval)
+            retry_interval = min(retry_interval * 2, 30)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,8 @@ UPDATED_FAV = "updated_to_favorite"
 ADD_LIB = "added_to_library"
 RM_LIB = "remove_from_library"
 UPDATE_LIB = "update_from_library"
+BULK_ADD_LIB = "bulk_added_to_library"
+BULK_UPDATE_LIB = "bulk_update_from_library"
 
 
 # RabbitMQ declared queues
@@ -14,6 +16,38 @@ RABBIT_QUEUE_FAV = "book-favorites-queue"
 
 
 # Redis cache keys
-FAV_CACHE_KEY = lambda uid: f"user_{uid}_fav_books"
-LIB_CACHE_KEY = lambda uid: f"user_{uid}_lib_books"
+# per user book caches: a hash of book.id -> book json, plus a sorted set of book.id by time added
+FAV_CACHE_KEY = lambda uid: f"user_{uid}_fav_map"
+FAV_ORDER_KEY = lambda uid: f"user_{uid}_fav_order"
+LIB_CACHE_KEY = lambda uid: f"user_{uid}_lib_map"
+LIB_ORDER_KEY = lambda uid: f"user_{uid}_lib_order"
+# library books by reading progress: sorted sets of book.id, same scores as the library order
+LIB_FINISHED_KEY = lambda uid: f"user_{uid}_lib_finished"
+LIB_READING_KEY = lambda uid: f"user_{uid}_lib_reading"
+# bumped by every cache write, so a rebuild can tell the cache changed while it was reading Mongo
+CACHE_VERSION_KEY = lambda uid: f"user_{uid}_cache_version"
+SEARCH_CACHE_KEY = lambda query, max_results, start_index, lang: f"search_{query}_{max_results}_{start_index}_{lang}"
+VOLUME_CACHE_KEY = lambda volume_id: f"volume_{volume_id}"
+# shared catalog entry of a book (everything but the per user fields), json
+CATALOG_CACHE_KEY = lambda volume_id: f"catalog_{volume_id}"
+# a user's last searches, most recent first: a list of searches as typed
+RECENT_SEARCHES_KEY = lambda uid: f"recent_searches_{uid}"
+# how often a user ran each search: a sorted set of normalized query -> count
+FREQUENT_SEARCHES_KEY = lambda uid: f"frequent_searches_{uid}"
+# trending searches: a count-min sketch (hash of counter -> decayed count, plus 'epoch') and a top-k sorted set
+TRENDING_SKETCH_KEY = "trending_searches_sketch"
+TRENDING_TOP_KEY = "trending_searches_top"
+# typeahead completions starting with a normalized prefix: a sorted set of "<type>|<text>" by popularity
+SUGGEST_KEY = lambda prefix: f"suggest_{prefix}"
+# last change stream event applied by cache_sync.py
+CACHE_SYNC_RESUME_TOKEN_KEY = "cache_sync_resume_token"
+# Google Books calls made per day: a hash of endpoint -> count, plus 'total'
+GOOGLE_BOOKS_QUOTA_KEY = lambda day: f"google_books_quota_{day}"
 
+
+# Library / favorites pagination
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Max books / progress updates accepted by one bulk request
+MAX_BULK_ITEMS = 500
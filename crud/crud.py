@@ -1,20 +1,110 @@
 from lib.mongo import DBClient
+from lib.metrics import MONGO_OPERATION_SECONDS, MONGO_EXECUTOR_WAIT_SECONDS, MONGO_ERRORS
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from bson import ObjectId
+from functools import partial
+from itertools import islice
+from typing import AsyncIterator
+import asyncio, json, logging, os, time
+
+logger = logging.getLogger(__name__)
+
+# Dev/test guardrail: explain() every new query shape and fail on collection scans
+MONGO_EXPLAIN_QUERIES = os.getenv("MONGO_EXPLAIN_QUERIES", "false").lower() == "true"
+
+
+class QueryPlanError(Exception):
+    pass
+
+
+def query_shape(query: any) -> any:
+    """
+    Reduces a query to its shape: same fields & operators, values replaced by their type.
+    {"user_id": "a", "book.id": "b"} and {"user_id": "c", "book.id": "d"} share one shape.
+    """
+    if isinstance(query, dict):
+        return {k: query_shape(v) for k, v in query.items()}
+    if isinstance(query, list):
+        return [query_shape(v) for v in query[:1]]
+    return type(query).__name__
+
+
+def plan_stages(plan: any) -> set[str]:
+    """
+    Collects every 'stage' name in an explain() plan tree.
+    """
+    stages = set()
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.add(plan["stage"])
+        for v in plan.values():
+            stages |= plan_stages(v)
+    elif isinstance(plan, list):
+        for v in plan:
+            stages |= plan_stages(v)
+    return stages
+
 
 class MongoCRUD:
+    # query shapes that have already passed the plan check, per collection
+    _checked_shapes: set[str] = set()
+
     def __init__(self, client: DBClient, collection_name: str):
         self.client = client
         self.collection = self.client.db[collection_name]
+
+    async def _run(self, fn, *args, **kwargs):
+        """
+        Runs a blocking pymongo call on the client's bounded executor
+        so the event loop is free while waiting on Mongo.
+        Time spent queued for a thread and time spent in the call are recorded separately.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.client.executor, partial(self._timed, fn, time.perf_counter(), *args, **kwargs))
+
+    def _timed(self, fn, submitted: float, *args, **kwargs):
+        collection, operation = self.collection.name, fn.__name__.lstrip("_")
+        start = time.perf_counter()
+        MONGO_EXECUTOR_WAIT_SECONDS.labels(collection).observe(start - submitted)
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            MONGO_ERRORS.labels(collection, operation, type(e).__name__).inc()
+            raise
+        finally:
+            MONGO_OPERATION_SECONDS.labels(collection, operation).observe(time.perf_counter() - start)
+
+    def check_query_plan(self, query: dict[str, any]):
+        """
+        Raises QueryPlanError if the winning plan for 'query' scans the whole collection.
+        """
+        plan = self.collection.find(query).explain()
+        stages = plan_stages(plan["queryPlanner"]["winningPlan"])
+        if "COLLSCAN" in stages:
+            raise QueryPlanError(f"query on '{self.collection.name}' does a COLLSCAN, add an index for it: {query_shape(query)}")
+
+    async def _guard(self, query: dict[str, any]):
+        if not MONGO_EXPLAIN_QUERIES:
+            return
+        shape = f"{self.collection.name}:{json.dumps(query_shape(query), sort_keys=True)}"
+        if shape not in MongoCRUD._checked_shapes:
+            await self._run(self.check_query_plan, query)
+            MongoCRUD._checked_shapes.add(shape)
     
     async def create_document(self, query: dict[str, any]) -> str:
         """
         Creates a new document in the collection.
         Returns the ID of the newly created document.
+        Raises DuplicateKeyError if it violates a unique index.
         """
         try:
-            res = self.collection.insert_one(query)
+            res = await self._run(self.collection.insert_one, query)
             return str(res.inserted_id)
+        except DuplicateKeyError:
+            raise
         except Exception as e:
-            print(f"Error creating document: {e}")
+            logger.error(f"Error creating document: {e!r}")
             return None
 
     
@@ -23,11 +113,12 @@ class MongoCRUD:
         Updates one or more documents in the collection based on the query.
         Returns the number of modified documents.
         """
+        await self._guard(query)
         try:
-            res = self.collection.update_many(query, {"$set": update_data})
+            res = await self._run(self.collection.update_many, query, {"$set": update_data})
             return res.modified_count
         except Exception as e:
-            print(f"Error updating document: {e}")
+            logger.error(f"Error updating document: {e!r}")
             return 0
     
     async def read_document(self, query: dict[str, any]) -> dict[str, any] | None:
@@ -35,37 +126,128 @@ class MongoCRUD:
         Reads a single document from the collection based on the query.
         Returns the document if found, otherwise None.
         """
+        await self._guard(query)
         try:
-            doc = self.collection.find_one(query)
+            doc = await self._run(self.collection.find_one, query)
             return doc
         except Exception as e:
-            print(f"Error reading document: {e}")
+            logger.error(f"Error reading document: {e!r}")
             return None
 
-    async def read_documents(self, query: dict[str, any], limit: int = 0) -> list[dict[str, any]]:
+    async def read_documents(self, query: dict[str, any], limit: int = 0, projection: dict[str, any] | None = None) -> list[dict[str, any]]:
         """
         Reads multiple documents from the collection based on the query.
+        Only the fields in 'projection' are returned when it is given.
         Returns a list of documents.
         """
+        await self._guard(query)
         try:
-            cursor = self.collection.find(query)
-            if limit > 0:
-                cursor = cursor.limit(limit)
-            return list(cursor)
+            return await self._run(self._find_all, query, limit, projection)
         except Exception as e:
-            print(f"Error reading documents: {e}")
+            logger.error(f"Error reading documents: {e!r}")
             return []  
     
+    def _find_all(self, query: dict[str, any], limit: int, projection: dict[str, any] | None) -> list[dict[str, any]]:
+        # cursor iteration does network I/O too, so it has to stay on the executor thread
+        cursor = self.collection.find(query, projection)
+        if limit > 0:
+            cursor = cursor.limit(limit)
+        return list(cursor)
+
+    async def read_page(self, query: dict[str, any], limit: int, after: str | None = None, projection: dict[str, any] | None = None) -> tuple[list[dict[str, any]], str | None]:
+        """
+        Reads one page of documents, newest first, using keyset pagination on '_id'.
+        'after' is the cursor returned with the previous page.
+        Returns the page and the cursor for the next page (None on the last page).
+        """
+        await self._guard(query)
+        if after:
+            query = {**query, "_id": {"$lt": ObjectId(after)}}
+        try:
+            # one extra document tells us whether there is a next page
+            docs = await self._run(self._find_page, query, limit + 1, projection)
+        except Exception as e:
+            logger.error(f"Error reading documents: {e!r}")
+            return [], None
+
+        next_cursor = str(docs[limit - 1]["_id"]) if len(docs) > limit else None
+        return docs[:limit], next_cursor
+
+    def _find_page(self, query: dict[str, any], limit: int, projection: dict[str, any] | None) -> list[dict[str, any]]:
+        return list(self.collection.find(query, projection).sort("_id", DESCENDING).limit(limit))
+
+    async def search_text(self, query: dict[str, any], text: str, limit: int, skip: int = 0) -> list[dict[str, any]]:
+        """
+        Runs a $text search (the collection needs a text index) together with 'query',
+        best matches first. Every document carries its relevance in 'score'.
+        """
+        query = {**query, "$text": {"$search": text}}
+        await self._guard(query)
+        try:
+            return await self._run(self._find_text, query, limit, skip)
+        except Exception as e:
+            logger.error(f"Error searching documents: {e!r}")
+            return []
+
+    def _find_text(self, query: dict[str, any], limit: int, skip: int) -> list[dict[str, any]]:
+        score = {"score": {"$meta": "textScore"}}
+        return list(self.collection.find(query, score).sort([("score", {"$meta": "textScore"})]).skip(skip).limit(limit))
+
+    async def iter_documents(self, query: dict[str, any], projection: dict[str, any] | None = None, batch_size: int = 100) -> AsyncIterator[dict[str, any]]:
+        """
+        Yields documents, newest first, as the cursor produces them,
+        so callers never hold more than one batch in memory.
+        """
+        await self._guard(query)
+        cursor = self.collection.find(query, projection, batch_size=batch_size).sort("_id", DESCENDING)
+
+        def next_batch():
+            return list(islice(cursor, batch_size))
+
+        try:
+            while True:
+                batch = await self._run(next_batch)
+                if not batch:
+                    break
+                for doc in batch:
+                    yield doc
+        finally:
+            await self._run(cursor.close)
+
+    async def bulk_write(self, operations: list[any]) -> dict[str, any]:
+        """
+        Applies the write operations in one unordered bulk write.
+        Returns per-operation outcomes keyed by operation index:
+        'upserted' (index -> new _id) and 'errors' (index -> error code), plus 'matched' / 'modified' counts.
+        """
+        try:
+            res = await self._run(self.collection.bulk_write, operations, ordered=False)
+            return {
+                "upserted": res.upserted_ids,
+                "errors": {},
+                "matched": res.matched_count,
+                "modified": res.modified_count,
+            }
+        except BulkWriteError as e:
+            # unordered: every operation without an entry in writeErrors was still applied
+            return {
+                "upserted": {u["index"]: u["_id"] for u in e.details.get("upserted", [])},
+                "errors": {err["index"]: err["code"] for err in e.details.get("writeErrors", [])},
+                "matched": e.details.get("nMatched", 0),
+                "modified": e.details.get("nModified", 0),
+            }
+
     async def delete_document(self, query: dict[str, any]) -> int:
         """
         Deletes one or more documents from the collection based on the query.
         Returns the number of deleted documents.
         """
+        await self._guard(query)
         try:
-            result = self.collection.delete_many(query)
+            result = await self._run(self.collection.delete_many, query)
             return result.deleted_count
         except Exception as e:
-            print(f"Error deleting document: {e}")
+            logger.error(f"Error deleting document: {e!r}")
             return 0
 
     async def doc_exists(self, query: dict[str, any]) -> bool:
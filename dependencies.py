@@ -1,7 +1,23 @@
 from crud.crud import MongoCRUD
 from lib.mongo import DBClient
+from lib.rabbit import RabbitPublisher
+from lib.http import HttpClient
+from lib.google_books import GoogleBooksClient
+from lib.catalog import Catalog
+import httpx
 
 def get_crud_service() -> MongoCRUD:
     client = DBClient.get_instance()
     return MongoCRUD(client, "books")
 
+def get_publisher() -> RabbitPublisher:
+    return RabbitPublisher.get_instance()
+
+def get_http_client() -> httpx.AsyncClient:
+    return HttpClient.get_instance().client
+
+def get_google_books() -> GoogleBooksClient:
+    return GoogleBooksClient.get_instance()
+
+def get_catalog() -> Catalog:
+    return Catalog.get_instance()
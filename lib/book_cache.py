@@ -0,0 +1,267 @@
+from typing import Awaitable, Callable
+from utils.singleflight import SingleFlight
+import redis, orjson, time, uuid, logging
+import constants
+
+logger = logging.getLogger(__name__)
+
+# Layout of the per user library & favorites caches:
+#   <kind>_map   hash        book.id -> book json
+#   <kind>_order sorted set  book.id scored by the time it was added (newest first on read)
+# Both keys are written together and the order key doubles as the "cache exists" marker,
+# so single book updates are O(1) field writes and never create a partial cache.
+#
+# The library cache also keeps one sorted set per reading progress flag (finished / reading)
+# holding the ids of the matching books, with the same scores as the order key.
+#
+# Every cache write from the consumer bumps a per user version, even when the cache isn't built.
+# A rebuild reads the version before reading Mongo, writes its keys under temporary names and
+# only swaps them in (RENAME) if the version hasn't moved, so it can't overwrite a newer update.
+
+LIB = "lib"
+FAV = "fav"
+
+# reading progress flags that have their own view of the library cache
+FINISHED = "is_finished"
+READING = "is_reading"
+
+CACHE_TTL = 86400
+REBUILD_TMP_TTL = 60    # leftovers of an abandoned rebuild expire on their own
+TIE_STEP = 1e-6         # seconds between the scores of books added within the same second
+
+_KEYS = {
+    LIB: (constants.LIB_CACHE_KEY, constants.LIB_ORDER_KEY),
+    FAV: (constants.FAV_CACHE_KEY, constants.FAV_ORDER_KEY),
+}
+
+_PROGRESS_KEYS = {
+    FINISHED: constants.LIB_FINISHED_KEY,
+    READING: constants.LIB_READING_KEY,
+}
+
+# Only touch a cache that has already been built; a missing cache is rebuilt from Mongo on read.
+# ZADD NX keeps a book's position when it is updated in place.
+# KEYS[3] is the user's cache version, KEYS[4..] are progress sets, ARGV[5..] say whether the book belongs in each of them.
+_PUT_SCRIPT = """
+redis.call('INCR', KEYS[3])
+redis.call('EXPIRE', KEYS[3], ARGV[4])
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], 'NX', ARGV[3], ARGV[1])
+local score = redis.call('ZSCORE', KEYS[2], ARGV[1])
+local ttl = redis.call('PTTL', KEYS[2])
+for i = 4, #KEYS do
+    if ARGV[i + 1] == '1' then
+        redis.call('ZADD', KEYS[i], score, ARGV[1])
+        if ttl > 0 then
+            redis.call('PEXPIRE', KEYS[i], ttl)
+        end
+    else
+        redis.call('ZREM', KEYS[i], ARGV[1])
+    end
+end
+return 1
+"""
+
+# Returns nil when the library cache hasn't been built, or has lost books (see read_books),
+# otherwise the matching books newest first
+_READ_PROGRESS_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return false
+end
+local books = {}
+for _, id in ipairs(redis.call('ZREVRANGE', KEYS[3], 0, -1)) do
+    local book = redis.call('HGET', KEYS[1], id)
+    if not book then
+        return false
+    end
+    books[#books + 1] = book
+end
+return books
+"""
+
+# Swaps a rebuilt cache in, unless the user's cache version (KEYS[1]) is no longer ARGV[1].
+# KEYS[2..] are pairs of (temporary key, live key); a live key without a temporary one is deleted.
+_SWAP_SCRIPT = """
+local current = redis.call('GET', KEYS[1]) or '0'
+if current ~= ARGV[1] then
+    for i = 2, #KEYS, 2 do
+        redis.call('DEL', KEYS[i])
+    end
+    return 0
+end
+for i = 2, #KEYS, 2 do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('RENAME', KEYS[i], KEYS[i + 1])
+        redis.call('EXPIRE', KEYS[i + 1], ARGV[2])
+    else
+        redis.call('DEL', KEYS[i + 1])
+    end
+end
+return 1
+"""
+
+# concurrent cache misses for the same user & kind share one rebuild
+_rebuilds = SingleFlight()
+
+
+def _keys(uid: str, kind: str) -> tuple[str, str]:
+    map_key, order_key = _KEYS[kind]
+    return map_key(uid), order_key(uid)
+
+
+def _progress_flags(book: dict[str, any]) -> list[str]:
+    progress = book.get("reading_progress") or {}
+    return ["1" if progress.get(flag) else "0" for flag in _PROGRESS_KEYS]
+
+
+def put_book(r: redis.Redis, uid: str, book: dict[str, any], kind: str, score: float | None = None):
+    """
+    Adds or replaces one book in an existing cache. 'r' may be a pipeline.
+    """
+    keys = [*_keys(uid, kind), constants.CACHE_VERSION_KEY(uid)]
+    args = [book["id"], orjson.dumps(book), score if score is not None else time.time(), CACHE_TTL]
+    if kind == LIB:
+        keys += [progress_key(uid) for progress_key in _PROGRESS_KEYS.values()]
+        args += _progress_flags(book)
+
+    put = r.register_script(_PUT_SCRIPT)
+    put(keys=keys, args=args)
+
+
+def remove_book(r: redis.Redis, uid: str, book_id: str, kind: str):
+    """
+    Removes one book from the cache. 'r' may be a pipeline.
+    """
+    map_key, order_key = _keys(uid, kind)
+    r.incr(constants.CACHE_VERSION_KEY(uid))
+    r.expire(constants.CACHE_VERSION_KEY(uid), CACHE_TTL)
+    r.hdel(map_key, book_id)
+    r.zrem(order_key, book_id)
+    if kind == LIB:
+        for progress_key in _PROGRESS_KEYS.values():
+            r.zrem(progress_key(uid), book_id)
+
+
+def read_books(r: redis.Redis, uid: str, kind: str) -> list[str] | None:
+    """
+    Returns the cached book json strings, newest first, in a single round trip.
+    Returns None when the cache has not been built, or when the order lists books the hash doesn't have:
+    Redis evicted the hash (a later put_book may have recreated it with a single book), so it's rebuilt.
+    """
+    map_key, order_key = _keys(uid, kind)
+    pipe = r.pipeline(transaction=True)
+    pipe.zrevrange(order_key, 0, -1)
+    pipe.hgetall(map_key)
+    order, books = pipe.execute()
+
+    if not order:
+        return None
+    if any(book_id not in books for book_id in order):
+        logger.info("Cache lost books, rebuilding", extra={"user_id": uid, "kind": kind})
+        return None
+    return [books[book_id] for book_id in order]
+
+
+def read_books_by_progress(r: redis.Redis, uid: str, flag: str) -> list[str] | None:
+    """
+    Returns the cached library books whose reading progress 'flag' is set, newest first.
+    Returns None when the library cache has not been built.
+    """
+    map_key, order_key = _keys(uid, LIB)
+    read = r.register_script(_READ_PROGRESS_SCRIPT)
+    return read(keys=[map_key, order_key, _PROGRESS_KEYS[flag](uid)])
+
+
+def drop_all(r: redis.Redis):
+    """
+    Deletes every library & favorites cache, they are rebuilt from Mongo on the next read.
+    Used when caches may have missed updates, or hold books in an outdated format.
+    """
+    deleted = 0
+    for pattern in ("user_*_lib_*", "user_*_fav_*"):
+        keys = []
+        for key in r.scan_iter(match=pattern, count=1000):
+            keys.append(key)
+            if len(keys) >= 1000:
+                deleted += r.unlink(*keys)
+                keys.clear()
+        if keys:
+            deleted += r.unlink(*keys)
+    logger.warning(f"Dropped {deleted} cache keys")
+
+
+def version(r: redis.Redis, uid: str) -> str:
+    """
+    Returns the user's cache version. Read it before reading Mongo for a rebuild.
+    """
+    return r.get(constants.CACHE_VERSION_KEY(uid)) or "0"
+
+
+def _scores(docs: list[dict[str, any]]) -> dict[str, float]:
+    """
+    Order set scores of the documents' books: the time they were added, from the document's _id.
+    _id times are whole seconds, so books added within the same second are spaced by TIE_STEP in _id order:
+    the cache lists books in the same order as read_page (_id descending) instead of breaking ties by book id.
+    """
+    scores, last = {}, None
+    for doc in sorted(docs, key=lambda doc: doc["_id"]):
+        score = doc["_id"].generation_time.timestamp()
+        if last is not None and score <= last:
+            score = last + TIE_STEP
+        scores[doc["book"]["id"]] = last = score
+    return scores
+
+
+def rebuild(r: redis.Redis, uid: str, docs: list[dict[str, any]], kind: str, cache_version: str, ttl: int = CACHE_TTL) -> list[bytes]:
+    """
+    Replaces the cache with the given Mongo documents in one round trip: the new keys are written
+    under temporary names and renamed over the live ones atomically, unless the cache version
+    moved on since 'cache_version' was read (the documents may be outdated, so nothing is cached).
+    Returns the serialized books in cache order (newest first), so callers can respond
+    with exactly what a cache hit would return without serializing twice.
+    """
+    map_key, order_key = _keys(uid, kind)
+    scores = _scores(docs)
+    serialized = {doc["book"]["id"]: orjson.dumps(doc["book"]) for doc in docs}
+
+    suffix = f"_rebuild_{uuid.uuid4().hex}"
+    live = [map_key, order_key]
+    if kind == LIB:
+        live += [progress_key(uid) for progress_key in _PROGRESS_KEYS.values()]
+    tmp = {key: key + suffix for key in live}
+
+    pipe = r.pipeline(transaction=False)
+    if docs:
+        pipe.hset(tmp[map_key], mapping=serialized)
+        pipe.zadd(tmp[order_key], scores)
+    if kind == LIB:
+        for flag, progress_key in _PROGRESS_KEYS.items():
+            matching = {doc["book"]["id"]: scores[doc["book"]["id"]] for doc in docs if (doc["book"].get("reading_progress") or {}).get(flag)}
+            if matching:
+                pipe.zadd(tmp[progress_key(uid)], matching)
+    for key in tmp.values():
+        pipe.expire(key, REBUILD_TMP_TTL)
+
+    swap = r.register_script(_SWAP_SCRIPT)
+    pairs = [k for key in live for k in (tmp[key], key)]
+    swap(keys=[constants.CACHE_VERSION_KEY(uid), *pairs], args=[cache_version, ttl], client=pipe)
+    *_, swapped = pipe.execute()
+    if not swapped:
+        logger.debug("Cache changed during rebuild, not caching", extra={"user_id": uid, "kind": kind})
+
+    return [serialized[book_id] for book_id in sorted(scores, key=scores.get, reverse=True)]
+
+
+async def load(r: redis.Redis, uid: str, kind: str, read_docs: Callable[[], Awaitable[list[dict[str, any]]]]) -> list[bytes]:
+    """
+    Rebuilds a missing cache from the documents 'read_docs' returns and returns the serialized books.
+    Concurrent misses for the same user & kind in this worker share one Mongo read & rebuild.
+    """
+    async def build():
+        cache_version = version(r, uid)
+        return rebuild(r, uid, await read_docs(), kind, cache_version)
+
+    return await _rebuilds.do(f"{kind}_{uid}", build)
@@ -0,0 +1,369 @@
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import PyMongoError
+from redis.exceptions import RedisError
+from typing import AsyncIterator
+from lib.redis import redis_client
+from lib.l1cache import L1Cache, publish_invalidation
+from lib.mongo import DBClient
+from lib.google_books import GoogleBooksClient, UpstreamUnavailable
+from crud.crud import MongoCRUD
+from schemas.book import catalog_entry, build_book
+from utils.stats import get_cache_stats
+import asyncio, httpx, orjson, os, logging, time
+import constants
+
+logger = logging.getLogger(__name__)
+
+# Book details shared by every user, one document per volume id: {_id: <book.id>, title, description, ...}.
+# Users' library documents only hold the book id, favorite flag & reading progress, and are joined
+# with the catalog when read. Entries only ever come from Google (search results & volume lookups),
+# never from a request body, since every user sees them.
+CATALOG_COLLECTION = "catalog"
+CATALOG_CACHE_TTL = int(os.getenv("CATALOG_CACHE_TTL", str(86400 * 7)))
+CATALOG_FETCH_CONCURRENCY = int(os.getenv("CATALOG_FETCH_CONCURRENCY", "8"))   # Google volume lookups in flight per ensure() call
+
+# Books added to libraries are looked up in the background, library writes never wait on Google
+CATALOG_FILL_BATCH = int(os.getenv("CATALOG_FILL_BATCH", "50"))                 # books looked up per round
+CATALOG_FILL_CONCURRENCY = int(os.getenv("CATALOG_FILL_CONCURRENCY", "2"))      # lookups in flight, leaves most of the rate limit to searches
+CATALOG_FILL_MAX_PENDING = int(os.getenv("CATALOG_FILL_MAX_PENDING", "10000"))  # books waiting for a lookup before new ones are dropped
+CATALOG_FILL_MAX_ATTEMPTS = 8   # a book that still can't be looked up is dropped, the next read of it queues it again
+CATALOG_FILL_BACKOFF = 1        # seconds before the first retry, doubled on every attempt
+
+DUPLICATE_KEY = 11000   # Mongo error code
+
+catalog_l1 = L1Cache("catalog", max_entries=int(os.getenv("L1_CATALOG_MAX_ENTRIES", "20000")), ttl=float(os.getenv("L1_CATALOG_TTL", "600")))
+catalog_cache_stats = get_cache_stats("catalog")
+# ids Google doesn't know, so reads of libraries holding them don't look them up again every time
+unknown_books = L1Cache("catalog_unknown", max_entries=10000, ttl=3600)
+
+
+def splice(entry: bytes, shared: bytes) -> bytes:
+    """
+    Merges a serialized library entry and catalog entry into one book object, without decoding either.
+    """
+    if shared == b"{}":
+        return entry
+    return entry[:-1] + b"," + shared[1:]
+
+
+def null_field(book: bytes, field: str) -> bytes:
+    """
+    Sets a string field of a serialized book to null, without decoding the book.
+    A key can't be mistaken for text inside a value: quotes in json strings are escaped.
+    """
+    key = b'"' + field.encode() + b'":'
+    start = book.find(key)
+    if start == -1:
+        return book
+    value = start + len(key)
+    if not book.startswith(b'"', value):
+        return book
+    end = value
+    while True:
+        end = book.find(b'"', end + 1)
+        # a quote after an odd number of backslashes is part of the string
+        backslashes = 0
+        while book[end - 1 - backslashes] == ord("\\"):
+            backslashes += 1
+        if backslashes % 2 == 0:
+            break
+    return book[:value] + b"null" + book[end + 1:]
+
+
+# library entries are always serialized with their id first: {"id":"<book id>",...}
+_ID_PREFIX = b'{"id":"'
+# only entries that still embed the whole book have a title
+_LEGACY_FIELD = b'"title":'
+
+
+def _entry_id(raw: bytes) -> str:
+    """
+    The book id of a serialized library entry, read off its first field instead of decoding it.
+    """
+    if raw.startswith(_ID_PREFIX):
+        book_id = raw[len(_ID_PREFIX):raw.find(b'"', len(_ID_PREFIX))]
+        if b"\\" not in book_id:
+            return book_id.decode()
+    return orjson.loads(raw)["id"]
+
+
+def _cache_get(ids: list[str]) -> list[str | None]:
+    """
+    One MGET for the given books' entries. While Redis is down every book is a miss, so it is read from Mongo.
+    """
+    try:
+        return redis_client.mget([constants.CATALOG_CACHE_KEY(book_id) for book_id in ids])
+    except RedisError as e:
+        logger.warning(f"Could not read the catalog cache, reading Mongo instead: {e}")
+        return [None] * len(ids)
+
+
+def _cache_set(entries: dict[str, bytes], invalidate: list[str] = ()):
+    """
+    Caches serialized entries keyed by book id, in this worker's L1 and in Redis.
+    'invalidate' are books whose L1 copies other workers have to drop.
+    A Redis failure only costs later reads a trip to Mongo.
+    """
+    if not entries:
+        return
+    for book_id, raw in entries.items():
+        catalog_l1.set(constants.CATALOG_CACHE_KEY(book_id), raw)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for book_id, raw in entries.items():
+            pipe.set(constants.CATALOG_CACHE_KEY(book_id), raw, ex=CATALOG_CACHE_TTL)
+        for book_id in invalidate:
+            publish_invalidation(pipe, constants.CATALOG_CACHE_KEY(book_id))
+        pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Could not cache {len(entries)} catalog entries: {e}")
+
+
+class Catalog:
+    """
+    App-lifetime access to the shared book catalog. Lookups go through an in-process cache,
+    then Redis (one MGET), then Mongo (one query) for whatever is still missing.
+    """
+    _instance = None
+
+    def __init__(self, crud: MongoCRUD):
+        if Catalog._instance is not None:
+            raise Exception("this is a singleton class")
+
+        self.crud = crud
+        # book id -> (when to look it up, failed attempts)
+        self._pending: dict[str, tuple[float, int]] = {}
+        self._filler: asyncio.Task | None = None
+        Catalog._instance = self
+
+    @staticmethod
+    def get_instance():
+        if Catalog._instance is None:
+            Catalog(MongoCRUD(DBClient.get_instance(), CATALOG_COLLECTION))
+        return Catalog._instance
+
+    async def save(self, books: list[dict[str, any]]):
+        """
+        Writes Google's details of the given books to the catalog. Only call it with data fetched from Google.
+        Books the catalog doesn't have are added, and entries that differ are replaced: Google is the reference.
+        Books whose cached entry is already the same are skipped, so repeated searches don't write.
+        """
+        entries = {book["id"]: orjson.dumps(catalog_entry(book)) for book in books}
+        current = {book_id: catalog_l1.get(constants.CATALOG_CACHE_KEY(book_id)) for book_id in entries}
+        uncached = [book_id for book_id, raw in current.items() if raw is None]
+        if uncached:
+            for book_id, raw in zip(uncached, _cache_get(uncached)):
+                current[book_id] = raw.encode() if raw is not None else None
+
+        # books that aren't cached are usually new: insert them, and replace the ones the catalog turns out to have
+        new = [book_id for book_id, raw in current.items() if raw is None]
+        changed = [book_id for book_id, raw in current.items() if raw is not None and raw != entries[book_id]]
+        if not new and not changed:
+            return
+        if new:
+            res = await self.crud.bulk_write([InsertOne({"_id": book_id, **orjson.loads(entries[book_id])}) for book_id in new])
+            if any(code != DUPLICATE_KEY for code in res["errors"].values()):
+                raise PyMongoError(f"Failed to add {len(res['errors'])} books to the catalog")
+            changed += [new[i] for i in res["errors"]]
+        if changed:
+            # every entry has all the catalog fields, so $set replaces the whole entry
+            res = await self.crud.bulk_write([UpdateOne({"_id": book_id}, {"$set": orjson.loads(entries[book_id])}, upsert=True) for book_id in changed])
+            if res["errors"]:
+                raise PyMongoError(f"Failed to write {len(res['errors'])} books to the catalog")
+
+        written = {book_id: entries[book_id] for book_id in dict.fromkeys(new + changed)}
+        # replaced entries other workers may hold
+        _cache_set(written, invalidate=[book_id for book_id in written if current[book_id] is not None])
+
+    async def ensure(self, ids: list[str], books_api: GoogleBooksClient, concurrency: int = CATALOG_FETCH_CONCURRENCY,
+                     refresh: bool = False) -> tuple[set[str], set[str]]:
+        """
+        Makes sure the catalog has the given books, looking the missing ones up on Google
+        ('refresh' looks every one up, replacing entries that differ from Google's).
+        Returns the ids of the books it has and the ids Google doesn't know.
+        Books that can't be looked up right now (Google unavailable or failing) are in neither.
+        """
+        found = set() if refresh else set(await self.read_raw(ids))
+        missing = [book_id for book_id in dict.fromkeys(ids) if book_id not in found]
+        if not missing:
+            return found, set()
+
+        sem = asyncio.Semaphore(concurrency)
+
+        async def lookup(volume_id: str) -> dict[str, any] | None:
+            async with sem:
+                try:
+                    volume = await books_api.volume(volume_id)
+                except httpx.HTTPStatusError as e:
+                    if e.response.status_code in (400, 404):
+                        return None
+                    raise
+            return build_book(volume, volume.get("volumeInfo", {})).model_dump()
+
+        books, unknown = [], set()
+        for volume_id, res in zip(missing, await asyncio.gather(*(lookup(volume_id) for volume_id in missing), return_exceptions=True)):
+            if isinstance(res, (UpstreamUnavailable, httpx.HTTPError)):
+                logger.debug("Catalog lookup failed", extra={"book_id": volume_id, "error": repr(res)})
+            elif isinstance(res, BaseException):
+                raise res
+            elif res is None:
+                unknown.add(volume_id)
+            else:
+                books.append(res)
+        if books:
+            await self.save(books)
+        return found | {book["id"] for book in books}, unknown
+
+    def fill_later(self, ids: list[str]):
+        """
+        Adds the given books to the catalog in the background (see ensure), for library writes & reads
+        that shouldn't wait on Google. Books that can't be looked up yet are retried with backoff.
+        """
+        for book_id in ids:
+            if book_id in self._pending or unknown_books.get(book_id) is not None:
+                continue
+            if len(self._pending) >= CATALOG_FILL_MAX_PENDING:
+                logger.error("Too many books waiting for a catalog lookup, dropping", extra={"book_id": book_id})
+                break
+            self._pending[book_id] = (0.0, 0)
+
+        if self._pending and (self._filler is None or self._filler.done()):
+            self._filler = asyncio.create_task(self._fill())
+
+    async def _fill(self):
+        """
+        Looks the pending books up, a batch at a time, until none are left.
+        """
+        books_api = GoogleBooksClient.get_instance()
+        while self._pending:
+            now = time.monotonic()
+            due = [book_id for book_id, (at, _) in self._pending.items() if at <= now][:CATALOG_FILL_BATCH]
+            if not due:
+                await asyncio.sleep(min(at for at, _ in self._pending.values()) - now)
+                continue
+
+            try:
+                found, unknown = await self.ensure(due, books_api, CATALOG_FILL_CONCURRENCY)
+            except (PyMongoError, RedisError) as e:
+                logger.warning(f"Could not save books to the catalog: {e}")
+                found, unknown = set(), set()
+
+            for book_id in due:
+                _, attempts = self._pending.pop(book_id)
+                if book_id in unknown:
+                    logger.warning("Book added to a library is unknown to Google", extra={"book_id": book_id})
+                    unknown_books.set(book_id, True)
+                elif book_id not in found:
+                    if attempts + 1 < CATALOG_FILL_MAX_ATTEMPTS:
+                        self._pending[book_id] = (time.monotonic() + CATALOG_FILL_BACKOFF * 2 ** attempts, attempts + 1)
+                    else:
+                        logger.warning("Giving up looking a book up for the catalog", extra={"book_id": book_id})
+
+    async def read_raw(self, ids: list[str]) -> dict[str, bytes]:
+        """
+        Returns the serialized catalog entries (without the id) of the given books, keyed by id.
+        Books that aren't in the catalog are left out.
+        """
+        found, missing = {}, []
+        for book_id in dict.fromkeys(ids):
+            raw = catalog_l1.get(constants.CATALOG_CACHE_KEY(book_id))
+            if raw is None:
+                missing.append(book_id)
+            else:
+                found[book_id] = raw
+
+        if missing:
+            cached = _cache_get(missing)
+            still_missing = []
+            for book_id, raw in zip(missing, cached):
+                if raw is None:
+                    still_missing.append(book_id)
+                else:
+                    found[book_id] = raw.encode()
+                    catalog_l1.set(constants.CATALOG_CACHE_KEY(book_id), found[book_id])
+            catalog_cache_stats.record(hits=len(missing) - len(still_missing), misses=len(still_missing))
+
+            if still_missing:
+                docs = await self.crud.read_documents({"_id": {"$in": still_missing}})
+                read = {}
+                for doc in docs:
+                    book_id = doc.pop("_id")
+                    read[book_id] = orjson.dumps(doc)
+                found.update(read)
+                _cache_set(read)
+
+        return found
+
+    async def search(self, query: str, lang: str, limit: int) -> list[dict[str, any]]:
+        """
+        Full text search over the catalog's titles, authors, ISBNs & genres in 'lang', best matches first.
+        Only books matching every word of the query are returned, as catalog entries with their id.
+        """
+        words = query.replace('"', " ").lower().split()
+        if not words:
+            return []
+        # quoted words are ANDed by $text, instead of matching any of them
+        docs = await self.crud.search_text({"language": lang}, " ".join(f'"{word}"' for word in words), limit)
+
+        books = []
+        for doc in docs:
+            doc.pop("score", None)
+            book_id = doc.pop("_id")
+            # $text stems & ignores stop words, keep only books containing every word as typed
+            searchable = " ".join([doc.get("title") or "", *(doc.get("authors") or []), *(doc.get("genre") or []),
+                                   *(isbn.get("identifier", "") for isbn in doc.get("isbn") or [])]).lower()
+            if all(word in searchable for word in words):
+                books.append({"id": book_id, **doc})
+        return books
+
+    async def read(self, ids: list[str]) -> dict[str, dict[str, any]]:
+        """
+        Like read_raw, but decoded.
+        """
+        return {book_id: orjson.loads(raw) for book_id, raw in (await self.read_raw(ids)).items()}
+
+    async def join(self, entries: list[str | bytes], omit: tuple[str, ...] = ()) -> list[bytes]:
+        """
+        Turns serialized library entries into serialized full books, in the same order, without decoding them.
+        Entries that still embed the whole book (not migrated yet) are returned as they are;
+        entries without a catalog entry are left out, and looked up in the background.
+        The (string) fields in 'omit' are set to null, e.g. the long description.
+        """
+        raws = [entry.encode() if isinstance(entry, str) else entry for entry in entries]
+        ids = [None if _LEGACY_FIELD in raw else _entry_id(raw) for raw in raws]
+        shared = await self.read_raw([book_id for book_id in ids if book_id is not None])
+
+        books, missing = [], []
+        for raw, book_id in zip(raws, ids):
+            if book_id is None:
+                books.append(raw)
+            elif book_id in shared:
+                books.append(splice(raw, shared[book_id]))
+            else:
+                missing.append(book_id)
+        if missing:
+            logger.info(f"{len(missing)} books not in the catalog yet, left out")
+            self.fill_later(missing)
+        for field in omit:
+            books = [null_field(book, field) for book in books]
+        return books
+
+    async def join_docs(self, docs: list[dict[str, any]], omit: tuple[str, ...] = ()) -> list[bytes]:
+        """
+        join() for library documents read from Mongo.
+        """
+        return await self.join([orjson.dumps(doc["book"]) for doc in docs], omit)
+
+    async def stream(self, docs: AsyncIterator[dict[str, any]], batch_size: int = 100) -> AsyncIterator[bytes]:
+        """
+        join_docs() for a stream of library documents, one catalog lookup per 'batch_size' documents.
+        """
+        batch = []
+        async for doc in docs:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                for book in await self.join_docs(batch):
+                    yield book
+                batch.clear()
+        for book in await self.join_docs(batch):
+            yield book
@@ -0,0 +1,275 @@
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from redis.exceptions import RedisError
+from lib.http import HttpClient
+from lib.redis import redis_client
+from lib import metrics
+import httpx, asyncio, logging, os, random, time
+import constants
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = os.getenv("BASE_URL")
+API_KEY = os.getenv("BOOK_API")
+
+# Calls are spread out by a token bucket (per worker), retried with backoff on 429 / 5xx,
+# and short circuited while Google keeps failing so requests fall back to cached or partial results.
+GOOGLE_BOOKS_RATE = float(os.getenv("GOOGLE_BOOKS_RATE", "10"))             # calls per second, per worker
+GOOGLE_BOOKS_BURST = int(os.getenv("GOOGLE_BOOKS_BURST", "20"))             # calls that may go out at once after being idle
+GOOGLE_BOOKS_MAX_WAIT = float(os.getenv("GOOGLE_BOOKS_MAX_WAIT", "1"))      # seconds a call may queue for the rate limiter
+GOOGLE_BOOKS_RETRIES = int(os.getenv("GOOGLE_BOOKS_RETRIES", "2"))          # retries of a search after a 429, 5xx or network error
+GOOGLE_BOOKS_BREAKER_FAILURES = int(os.getenv("GOOGLE_BOOKS_BREAKER_FAILURES", "5"))   # consecutive failures that open the circuit
+GOOGLE_BOOKS_BREAKER_RESET = float(os.getenv("GOOGLE_BOOKS_BREAKER_RESET", "30"))      # seconds before a probe call is let through
+GOOGLE_BOOKS_DAILY_QUOTA = int(os.getenv("GOOGLE_BOOKS_DAILY_QUOTA", "0"))  # calls per day across all workers, 0 = unlimited
+GOOGLE_BOOKS_QUOTA_TZ = os.getenv("GOOGLE_BOOKS_QUOTA_TZ", "America/Los_Angeles")     # Google resets quotas at midnight Pacific
+
+BACKOFF_BASE = 0.25     # seconds, doubled on every retry
+BACKOFF_MAX = 5         # a Retry-After longer than this isn't waited out inside a request
+
+try:
+    QUOTA_TZ = ZoneInfo(GOOGLE_BOOKS_QUOTA_TZ)
+except ZoneInfoNotFoundError:
+    logger.warning(f"Unknown time zone '{GOOGLE_BOOKS_QUOTA_TZ}', counting the Google Books quota by UTC day")
+    QUOTA_TZ = ZoneInfo("UTC")
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Google Books can't be called right now (circuit open, rate limited, quota used up or still failing after retries).
+    'retry_after' is a hint, in seconds, for when it is worth trying again.
+    """
+    def __init__(self, message: str, retry_after: float = 0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Token bucket for one event loop. A caller reserves the next token and sleeps until it's due,
+    so calls go out at 'rate' per second with bursts of up to 'burst'.
+    The rate is halved on every 429 and grows back gradually on successful calls.
+    """
+    def __init__(self, rate: float, burst: int):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, max_wait: float) -> bool:
+        """
+        Waits for a token. Returns False, without waiting, if that would take longer than 'max_wait'.
+        """
+        self._refill()
+        wait = max(0.0, (1 - self.tokens) / self.rate)
+        if wait > max_wait:
+            return False
+        self.tokens -= 1
+        if wait:
+            await asyncio.sleep(wait)
+        return True
+
+    def slow_down(self):
+        self._refill()
+        self.rate = max(self.max_rate / 16, self.rate / 2)
+
+    def speed_up(self):
+        self._refill()
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class CircuitBreaker:
+    """
+    Opens after 'failure_threshold' consecutive failures and fails calls fast for 'reset_timeout' seconds.
+    Then one probe call is let through: success closes the circuit, failure opens it again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if not self.open_until:
+            return self.CLOSED
+        if time.monotonic() < self.open_until:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self) -> bool:
+        match self.state:
+            case self.CLOSED:
+                return True
+            case self.HALF_OPEN if not self.probing:
+                self.probing = True
+                return True
+        return False
+
+    def retry_after(self) -> float:
+        return max(0.0, self.open_until - time.monotonic())
+
+    def record_success(self):
+        if self.open_until:
+            logger.info("Google Books circuit closed")
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def record_failure(self, retry_after: float = 0):
+        self.failures += 1
+        self.probing = False
+        # a failed probe re-opens the circuit straight away
+        if self.failures >= self.failure_threshold or self.open_until:
+            if self.state != self.OPEN:
+                logger.warning("Google Books circuit opened", extra={"failures": self.failures})
+            self.open_until = time.monotonic() + max(self.reset_timeout, retry_after)
+
+
+def _retry_after(response: httpx.Response) -> float:
+    try:
+        return max(0.0, float(response.headers.get("Retry-After", 0)))
+    except ValueError:
+        # an HTTP date; the backoff schedule is good enough
+        return 0.0
+
+
+class GoogleBooksClient:
+    """
+    App-lifetime client for the Google Books API, shared by every request in the worker.
+    Every call goes through the circuit breaker, the daily quota counter and the rate limiter,
+    and raises UpstreamUnavailable when Google can't be used right now.
+    """
+    _instance = None
+
+    def __init__(self, client: httpx.AsyncClient, base_url: str = BASE_URL, api_key: str = API_KEY):
+        if GoogleBooksClient._instance is not None:
+            raise Exception("this is a singleton class")
+
+        self.client = client
+        self.base_url = base_url
+        self.api_key = api_key
+        self.bucket = TokenBucket(GOOGLE_BOOKS_RATE, GOOGLE_BOOKS_BURST)
+        self.breaker = CircuitBreaker(GOOGLE_BOOKS_BREAKER_FAILURES, GOOGLE_BOOKS_BREAKER_RESET)
+        metrics.GOOGLE_BOOKS_RATE.set_function(lambda: self.bucket.rate)
+        metrics.GOOGLE_BOOKS_CIRCUIT_OPEN.set_function(lambda: self.breaker.state != CircuitBreaker.CLOSED)
+        GoogleBooksClient._instance = self
+
+    @staticmethod
+    def get_instance():
+        if GoogleBooksClient._instance is None:
+            GoogleBooksClient(HttpClient.get_instance().client)
+        return GoogleBooksClient._instance
+
+    async def search(self, query: str, max_results: int, start_index: int, lang: str) -> dict[str, any]:
+        params = {"q": query, "maxResults": max_results, "startIndex": start_index, "key": self.api_key, "printType": "books", "langRestrict": lang}
+        return await self._get("search", self.base_url, params, retries=GOOGLE_BOOKS_RETRIES)
+
+    async def volume(self, volume_id: str, timeout: float | None = None) -> dict[str, any]:
+        # details are optional extras for a search, so they're never retried
+        return await self._get("volume", f"{self.base_url}/{volume_id}", timeout=timeout)
+
+    async def _get(self, endpoint: str, url: str, params: dict[str, any] | None = None, timeout: float | None = None, retries: int = 0) -> dict[str, any]:
+        """
+        Returns the decoded JSON body. 4xx responses other than 429 raise httpx.HTTPStatusError,
+        they are about the request, not about Google's health.
+        """
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                metrics.GOOGLE_BOOKS_CALLS.labels(endpoint, "short_circuited").inc()
+                raise UpstreamUnavailable("Google Books circuit is open", self.breaker.retry_after())
+
+            try:
+                if not await self.bucket.acquire(GOOGLE_BOOKS_MAX_WAIT):
+                    metrics.GOOGLE_BOOKS_CALLS.labels(endpoint, "throttled").inc()
+                    raise UpstreamUnavailable("Google Books rate limit reached", 1 / self.bucket.rate)
+                if not self._count_call(endpoint):
+                    metrics.GOOGLE_BOOKS_CALLS.labels(endpoint, "quota_exhausted").inc()
+                    raise UpstreamUnavailable("Google Books daily quota used up", self._seconds_until_quota_reset())
+
+                with metrics.upstream_call(endpoint) as call:
+                    request = self.client.get(url, params=params)
+                    response = await (asyncio.wait_for(request, timeout) if timeout else request)
+                    call["status"] = response.status_code
+            except (asyncio.TimeoutError, httpx.RequestError) as e:
+                outcome, retry_after, error = "transport_error", 0.0, e
+            except BaseException:
+                # refused locally or cancelled: not a verdict on Google's health, let the next call probe
+                self.breaker.probing = False
+                raise
+            else:
+                if response.status_code != 429 and response.status_code < 500:
+                    self.breaker.record_success()
+                    self.bucket.speed_up()
+                    metrics.GOOGLE_BOOKS_CALLS.labels(endpoint, "ok" if response.is_success else "client_error").inc()
+                    response.raise_for_status()
+                    return response.json()
+
+                outcome = "rate_limited" if response.status_code == 429 else "server_error"
+                retry_after, error = _retry_after(response), None
+                if response.status_code == 429:
+                    self.bucket.slow_down()
+
+            metrics.GOOGLE_BOOKS_CALLS.labels(endpoint, outcome).inc()
+            self.breaker.record_failure(retry_after)
+            logger.warning("Google Books call failed", extra={"endpoint": endpoint, "outcome": outcome, "attempt": attempt, "error": repr(error) if error else None})
+
+            if attempt >= retries or retry_after > BACKOFF_MAX:
+                raise UpstreamUnavailable(f"Google Books call failed: {outcome}", max(retry_after, self.breaker.retry_after())) from error
+            attempt += 1
+            # full jitter, so retries from concurrent requests don't line up
+            await asyncio.sleep(max(retry_after, random.uniform(0, BACKOFF_BASE * 2 ** attempt)))
+
+    def _quota_day(self) -> str:
+        return datetime.now(QUOTA_TZ).strftime("%Y-%m-%d")
+
+    def _seconds_until_quota_reset(self) -> float:
+        now = datetime.now(QUOTA_TZ)
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=QUOTA_TZ)
+        return (midnight - now).total_seconds()
+
+    def _count_call(self, endpoint: str) -> bool:
+        """
+        Counts a call against today's quota, shared by every worker.
+        Returns False (and doesn't count it) when the daily quota is used up.
+        If Redis is down the call is allowed, the quota is a guardrail not a hard limit.
+        """
+        key = constants.GOOGLE_BOOKS_QUOTA_KEY(self._quota_day())
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.hincrby(key, "total", 1)
+            pipe.hincrby(key, endpoint, 1)
+            pipe.expire(key, 2 * 86400)
+            total, _, _ = pipe.execute()
+            if GOOGLE_BOOKS_DAILY_QUOTA and total > GOOGLE_BOOKS_DAILY_QUOTA:
+                pipe.hincrby(key, "total", -1)
+                pipe.hincrby(key, endpoint, -1)
+                pipe.execute()
+                return False
+        except RedisError as e:
+            logger.warning(f"Could not count Google Books call against the quota: {e}")
+        return True
+
+    def stats(self) -> dict[str, any]:
+        day = self._quota_day()
+        try:
+            used = {field: int(count) for field, count in redis_client.hgetall(constants.GOOGLE_BOOKS_QUOTA_KEY(day)).items()}
+        except RedisError:
+            used = None
+        return {
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "rate_per_second": round(self.bucket.rate, 3),
+            "quota": {"day": day, "limit": GOOGLE_BOOKS_DAILY_QUOTA or None, "used": used},
+        }
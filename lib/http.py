@@ -0,0 +1,37 @@
+import httpx, os, logging
+from importlib.util import find_spec
+
+logger = logging.getLogger(__name__)
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+
+class HttpClient:
+    _instance = None
+
+    def __init__(self, transport: httpx.AsyncBaseTransport | None = None):
+        if HttpClient._instance is not None:
+            raise Exception("this is a singleton class")
+
+        # HTTP/2 needs the optional 'h2' package; fall back to HTTP/1.1 keep-alive without it
+        http2 = find_spec("h2") is not None
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+            transport=transport,
+        )
+        logger.info(f"shared http client created (http2={http2})")
+        HttpClient._instance = self
+
+    @staticmethod
+    def get_instance():
+        if HttpClient._instance is None:
+            HttpClient()
+        return HttpClient._instance
+
+    async def close(self):
+        logger.info("closing shared http client")
+        await self.client.aclose()
+        HttpClient._instance = None
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+from utils.stats import get_cache_stats
+import redis, threading, time, uuid, os, logging
+
+logger = logging.getLogger(__name__)
+
+# Writers publish the Redis key they changed on this channel, every other worker drops its L1 copy
+INVALIDATION_CHANNEL = "cache-invalidate"
+
+# Tags this process' invalidations ("<process id> <key>"), so its own listener doesn't drop what it just wrote
+PROCESS_ID = uuid.uuid4().hex
+
+
+def _new_process_id():
+    global PROCESS_ID
+    PROCESS_ID = uuid.uuid4().hex
+
+# a forked worker is another process, with its own L1 caches
+os.register_at_fork(after_in_child=_new_process_id)
+
+
+class L1Cache:
+    """
+    Small in-process LRU cache with a TTL, for hot read paths in front of Redis.
+    Entries are dropped when another process publishes an invalidation for their key.
+    """
+    def __init__(self, name: str, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = get_cache_stats(f"{name}_l1")
+        self._entries: OrderedDict[str, tuple[float, any]] = OrderedDict()
+        self._lock = threading.Lock()
+        l1_caches.append(self)
+
+    def get(self, key: str) -> any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.stats.record(misses=1)
+                return None
+            self._entries.move_to_end(key)
+        self.stats.record(hits=1)
+        return entry[1]
+
+    def set(self, key: str, value: any):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# every L1 cache in this process, so invalidations reach all of them
+l1_caches: list[L1Cache] = []
+
+
+def publish_invalidation(r: redis.Redis, key: str):
+    """
+    Tells every other worker to drop its L1 copy of 'key'. 'r' may be a pipeline.
+    """
+    r.publish(INVALIDATION_CHANNEL, f"{PROCESS_ID} {key}")
+
+
+def _invalidate(message: str):
+    origin, _, key = message.partition(" ")
+    if origin == PROCESS_ID:
+        return
+    for cache in l1_caches:
+        cache.invalidate(key)
+
+
+def _listen(r: redis.Redis):
+    while True:
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                _invalidate(message["data"])
+        except redis.RedisError as e:
+            # invalidations may have been missed while disconnected, so nothing in L1 can be trusted
+            logger.error(f"L1 invalidation listener lost its connection, clearing L1 caches: {e}")
+            for cache in l1_caches:
+                cache.clear()
+            time.sleep(1)
+
+
+def start_invalidation_listener(r: redis.Redis):
+    threading.Thread(target=_listen, args=(r,), name="l1-invalidation", daemon=True).start()
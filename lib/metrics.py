@@ -0,0 +1,112 @@
+from contextlib import contextmanager
+from prometheus_client import Counter, Histogram, Gauge, REGISTRY
+from prometheus_client.core import CounterMetricFamily
+from utils.stats import cache_stats
+import asyncio, httpx, time
+
+# Prometheus metrics for the API and the cache consumer, served on /metrics (and on the consumer's own port).
+# Label values are always from a small fixed set (route templates, command & operation names), never ids.
+
+# Redis & in-process work is sub millisecond, so it needs finer buckets than the default
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Routes
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Time to serve a request, including the response body", ["method", "route", "status"])
+
+# Mongo (MongoCRUD)
+MONGO_OPERATION_SECONDS = Histogram("mongo_operation_duration_seconds", "Time spent in a pymongo call", ["collection", "operation"])
+MONGO_EXECUTOR_WAIT_SECONDS = Histogram("mongo_executor_wait_seconds", "Time a pymongo call waited for a free executor thread", ["collection"], buckets=FAST_BUCKETS)
+MONGO_ERRORS = Counter("mongo_operation_errors", "pymongo calls that raised", ["collection", "operation", "error"])
+
+# Redis
+REDIS_COMMAND_SECONDS = Histogram("redis_command_duration_seconds", "Round trip time of a Redis command or pipeline", ["command"], buckets=FAST_BUCKETS)
+REDIS_ERRORS = Counter("redis_command_errors", "Redis commands or pipelines that raised", ["command", "error"])
+
+# RabbitMQ publisher
+RABBIT_MESSAGES = Counter("rabbit_publisher_messages", "Messages handed to the publisher, by outcome", ["queue", "outcome"])
+RABBIT_PUBLISH_DELAY_SECONDS = Histogram("rabbit_publish_delay_seconds", "Time from publish() until the broker had the message", buckets=FAST_BUCKETS)
+RABBIT_BATCH_SECONDS = Histogram("rabbit_publish_batch_duration_seconds", "Time to publish one batch to the broker", buckets=FAST_BUCKETS)
+RABBIT_BATCH_SIZE = Histogram("rabbit_publish_batch_size", "Messages per published batch", buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+RABBIT_PENDING = Gauge("rabbit_publisher_pending", "Messages buffered and not yet published")
+RABBIT_RECONNECTS = Counter("rabbit_publisher_reconnects", "Times the publisher had to (re)connect to the broker")
+
+# Google Books
+UPSTREAM_SECONDS = Histogram("upstream_request_duration_seconds", "Time of a Google Books API call", ["endpoint", "status"])
+GOOGLE_BOOKS_CALLS = Counter("google_books_calls", "Google Books calls by outcome; everything but short_circuited, throttled & quota_exhausted used quota", ["endpoint", "outcome"])
+GOOGLE_BOOKS_RATE = Gauge("google_books_rate_limit", "Current Google Books calls per second allowed by this worker's rate limiter")
+GOOGLE_BOOKS_CIRCUIT_OPEN = Gauge("google_books_circuit_open", "1 while the Google Books circuit breaker is open or probing")
+
+# Logging
+LOG_RECORDS_DROPPED = Counter("log_records_dropped", "Log records dropped because the background writer fell behind")
+
+# Cache consumer (receiver.py)
+CONSUMER_MESSAGES = Counter("consumer_messages", "Messages processed by the cache consumer", ["queue", "action", "outcome"])
+CONSUMER_LAG_SECONDS = Histogram("consumer_lag_seconds", "Time from publish to the message's cache update being applied",
+                                 buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+CONSUMER_BATCH_SIZE = Histogram("consumer_batch_size", "Messages applied per Redis pipeline", buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+CONSUMER_BATCH_SECONDS = Histogram("consumer_batch_duration_seconds", "Time to apply one batch to Redis", buckets=FAST_BUCKETS)
+CONSUMER_REQUEUED = Counter("consumer_requeued_messages", "Messages requeued because their batch failed to apply")
+
+
+class CacheStatsCollector:
+    """
+    Exposes every CacheStats in utils.stats as counters, so /metrics and /cache-stats report the same numbers.
+    """
+    def collect(self):
+        hits = CounterMetricFamily("cache_hits", "Cache lookups served from the cache", labels=["cache"])
+        misses = CounterMetricFamily("cache_misses", "Cache lookups that missed", labels=["cache"])
+        stale = CounterMetricFamily("cache_stale_hits", "Cache hits served past their freshness window", labels=["cache"])
+        for name, stats in list(cache_stats.items()):
+            hits.add_metric([name], stats.hits)
+            misses.add_metric([name], stats.misses)
+            stale.add_metric([name], stats.stale)
+        return [hits, misses, stale]
+
+
+REGISTRY.register(CacheStatsCollector())
+
+
+@contextmanager
+def upstream_call(endpoint: str):
+    """
+    Times a Google Books call. Set result["status"] to the response's status code;
+    calls that raise are recorded as 'timeout' or 'error'.
+    """
+    result = {"status": "error"}
+    start = time.perf_counter()
+    try:
+        yield result
+    except (asyncio.TimeoutError, httpx.TimeoutException):
+        result["status"] = "timeout"
+        raise
+    finally:
+        UPSTREAM_SECONDS.labels(endpoint, str(result["status"])).observe(time.perf_counter() - start)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every request by its route template (e.g. /lib/my-books),
+    up to the last byte of the response so streamed responses are measured in full.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # the router stores the matched route in the scope; unmatched paths share one label
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(scope["method"], getattr(route, "path", "unmatched"), str(status)).observe(time.perf_counter() - start)
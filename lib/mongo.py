@@ -1,22 +1,76 @@
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
-import logging
+from pymongo import IndexModel, ASCENDING, DESCENDING, TEXT
+from pymongo.errors import PyMongoError
+from concurrent.futures import ThreadPoolExecutor
+import logging, os
+
+logger = logging.getLogger(__name__)
+
+# Connection pool sizing, overridable per deployment
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+MONGO_TLS = os.getenv("MONGO_TLS", "true").lower() == "true"   # false for a local (e.g. docker compose) replica set
+
+# the unique index that keeps a book from being added to a library twice
+BOOKS_UNIQUE_INDEX = "user_book_unique"
+
+# Indexes the 'books' collection needs, created at startup by DBClient.ensure_indexes()
+BOOKS_INDEXES = [
+    # every per-book lookup; also serves the plain {user_id} library query and
+    # stops concurrent adds from inserting the same book twice
+    IndexModel([("user_id", ASCENDING), ("book.id", ASCENDING)], name=BOOKS_UNIQUE_INDEX, unique=True),
+    # library pages & streams, newest first
+    IndexModel([("user_id", ASCENDING), ("_id", DESCENDING)], name="user_recent"),
+    # {user_id, book.is_favorite: True}, also paged newest first
+    IndexModel([("user_id", ASCENDING), ("book.is_favorite", ASCENDING), ("_id", DESCENDING)], name="user_favorites",
+               partialFilterExpression={"book.is_favorite": True}),
+    # {user_id, book.reading_progress.is_finished: True} / {..., is_reading: True}
+    IndexModel([("user_id", ASCENDING), ("book.reading_progress.is_finished", ASCENDING)], name="user_finished",
+               partialFilterExpression={"book.reading_progress.is_finished": True}),
+    IndexModel([("user_id", ASCENDING), ("book.reading_progress.is_reading", ASCENDING)], name="user_reading",
+               partialFilterExpression={"book.reading_progress.is_reading": True}),
+]
+
+# Indexes the shared 'catalog' collection needs (its _id is the book id)
+CATALOG_INDEXES = [
+    # local search tier: {language, $text} over the fields people search books by.
+    # 'language' holds codes Mongo's stemmer doesn't know, so it must not be read as the text language
+    IndexModel([("language", ASCENDING), ("title", TEXT), ("authors", TEXT), ("isbn.identifier", TEXT), ("genre", TEXT)], name="catalog_text",
+               weights={"title": 10, "authors": 5, "isbn.identifier": 5, "genre": 1}, default_language="english", language_override="text_language"),
+]
 
 class DBClient:
     _instance = None
     
-    def __init__(self, uri: str = "uri", db_name: str = "db_name"):
+    def __init__(self, uri: str = "uri", db_name: str = "db_name", max_pool_size: int = MONGO_MAX_POOL_SIZE, min_pool_size: int = MONGO_MIN_POOL_SIZE):
         if DBClient._instance is not None:
             raise Exception("this is a singleton clasee")
 
-        self.client = MongoClient(uri, tls=True, tlsAllowInvalidCertificates=True,server_api=ServerApi('1') )
+        self.client = MongoClient(
+            uri,
+            tls=MONGO_TLS,
+            # pymongo refuses tls options when tls is off
+            **({"tlsAllowInvalidCertificates": True} if MONGO_TLS else {}),
+            server_api=ServerApi('1'),
+            maxPoolSize=max_pool_size,
+            minPoolSize=min_pool_size,
+            waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        )
         try:
             self.client.admin.command('ping')
-            logging.info("Pinged your deployment. You successfully connected to MongoDB!")
+            logger.info("Pinged your deployment. You successfully connected to MongoDB!")
         except Exception as e:
-            print(e)
+            logger.error(f"Could not ping MongoDB: {e}")
 
         self.db = self.client[db_name]
+
+        # pymongo is blocking, so queries are run on this executor instead of the event loop.
+        # One thread per pooled connection: more threads would only queue on the pool.
+        self.executor = ThreadPoolExecutor(max_workers=max_pool_size, thread_name_prefix="mongo")
+        # index names per collection, as found by ensure_indexes()
+        self.indexes: dict[str, set[str]] = {}
         DBClient._instance = self
     
     @staticmethod
@@ -25,7 +79,36 @@ class DBClient:
             DBClient(uri, db_name)  
         return DBClient._instance
     
+    def ensure_indexes(self, collection_name: str = "books", indexes: list[IndexModel] = BOOKS_INDEXES):
+        """
+        Creates any missing indexes. Existing indexes with the same definition are left alone.
+        Records which indexes the collection ends up with, see has_index().
+        """
+        try:
+            names = self.db[collection_name].create_indexes(indexes)
+            logger.info(f"indexes ensured on '{collection_name}': {names}")
+        except PyMongoError as e:
+            # e.g. the unique index can't be built while duplicate documents exist
+            logger.error(f"Failed to create indexes on '{collection_name}': {e}")
+
+        try:
+            self.indexes[collection_name] = set(self.db[collection_name].index_information())
+        except PyMongoError as e:
+            logger.error(f"Could not list the indexes of '{collection_name}': {e}")
+            self.indexes[collection_name] = set()
+
+        missing = {index.document["name"] for index in indexes} - self.indexes[collection_name]
+        if missing:
+            logger.error(f"'{collection_name}' is missing indexes {sorted(missing)}, queries relying on them fall back to slower paths")
+
+    def has_index(self, collection_name: str, index_name: str) -> bool:
+        """
+        Whether ensure_indexes() found the index on the collection.
+        """
+        return index_name in self.indexes.get(collection_name, set())
+
     def close(self):
-        logging.info("closing db connection")
+        logger.info("closing db connection")
+        self.executor.shutdown(wait=True)
         self.client.close()
         DBClient._instance = None
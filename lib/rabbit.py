@@ -1,4 +1,9 @@
-import pika, os
+import pika, os, json, queue, threading, time, logging, zlib
+import constants
+from utils.utils import datetime_serializer
+from lib import metrics
+
+logger = logging.getLogger(__name__)
 
 # RabbitMQ connection parameters
 # RABBITMQ_HOST = 'localhost' # Default if running RabbitMQ locally
@@ -7,20 +12,217 @@ import pika, os
 # RABBITMQ_PASS = 'guest' # Default password
 # RABBITMQ_VHOST = '/' # Default virtual host
 
-def init_rabbit_mq():
-    host = os.getenv("RABBITMQ_HOST", "localhost")
-    try:
-        connection_params = pika.ConnectionParameters(host=host)
-        connection = pika.BlockingConnection(connection_params)
-        channel = connection.channel()
-        
-        print("channel opened sucessfully")
-        return channel, connection
-        
-    except pika.exceptions.AMQPConnectionError as e:
-        print(f"Error: Failed to connect to RabbitMQ at {host}.")
-        print(f"Details: {e}")
-        return None, None
-    except Exception as e:
-        print(f"An unexpected error occurred during RabbitMQ initialization: {e}")
-        return None, None
\ No newline at end of file
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "localhost")
+RABBITMQ_CONFIRMS = os.getenv("RABBITMQ_CONFIRMS", "false").lower() == "true"
+RABBITMQ_BATCH_SIZE = int(os.getenv("RABBITMQ_BATCH_SIZE", "100"))          # max messages per flush
+RABBITMQ_BATCH_WINDOW = float(os.getenv("RABBITMQ_BATCH_WINDOW", "0.005"))  # seconds to wait for a batch to fill
+RABBITMQ_MAX_PENDING = int(os.getenv("RABBITMQ_MAX_PENDING", "10000"))      # messages buffered before publish() starts dropping
+
+# Each queue is split into this many shards, a user's messages always go to the same shard.
+# Consumer workers each own a subset of the shards, which keeps every user's events in order.
+# Publishers & consumers must agree on this value.
+RABBIT_QUEUE_SHARDS = int(os.getenv("RABBIT_QUEUE_SHARDS", "1"))
+
+# How the library & favorites caches follow Mongo writes:
+#   'rabbit'        routes publish an event per write, applied by receiver.py
+#   'change_stream' cache_sync.py tails the collection's change stream, routes publish nothing
+CACHE_SYNC = os.getenv("CACHE_SYNC", "rabbit")
+
+
+def queue_shards(queue_name: str) -> list[str]:
+    """
+    Returns the names of all shards of a queue. A single shard keeps the plain queue name.
+    """
+    if RABBIT_QUEUE_SHARDS <= 1:
+        return [queue_name]
+    return [f"{queue_name}.{i}" for i in range(RABBIT_QUEUE_SHARDS)]
+
+
+def shard_queue(queue_name: str, uid: str) -> str:
+    """
+    Returns the shard of a queue that carries the given user's messages.
+    """
+    shards = queue_shards(queue_name)
+    return shards[zlib.crc32(uid.encode()) % len(shards)]
+
+
+def base_queue(shard_name: str) -> str:
+    """
+    Returns the queue a shard belongs to (the inverse of shard_queue).
+    """
+    if RABBIT_QUEUE_SHARDS <= 1:
+        return shard_name
+    return shard_name.rsplit(".", 1)[0]
+
+
+class RabbitPublisher:
+    """
+    App-lifetime RabbitMQ publisher.
+
+    Routers hand messages to `publish()`, which only serializes and enqueues them.
+    A background thread owns the pika connection (pika is not thread safe), declares
+    the queues once, drains the buffer in micro-batches and reconnects on failure.
+    """
+    _instance = None
+    _STOP = object()
+
+    def __init__(self, host: str = RABBITMQ_HOST, queues: tuple[str, ...] = (constants.RABBIT_QUEUE_FAV, constants.RABBIT_QUEUE_LIB),
+                 confirms: bool = RABBITMQ_CONFIRMS, batch_size: int = RABBITMQ_BATCH_SIZE, batch_window: float = RABBITMQ_BATCH_WINDOW):
+        if RabbitPublisher._instance is not None:
+            raise Exception("this is a singleton class")
+
+        self.host = host
+        self.queues = queues
+        self.confirms = confirms
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.enabled = CACHE_SYNC != "change_stream"
+
+        self._buffer: queue.Queue = queue.Queue(maxsize=RABBITMQ_MAX_PENDING)
+        self._closing = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._connection = None
+        self._channel = None
+        metrics.RABBIT_PENDING.set_function(self._buffer.qsize)
+        RabbitPublisher._instance = self
+
+    @staticmethod
+    def get_instance():
+        if RabbitPublisher._instance is None:
+            RabbitPublisher()
+        return RabbitPublisher._instance
+
+    def start(self):
+        if not self.enabled:
+            logger.info("cache updates come from the Mongo change stream, RabbitMQ publisher not started")
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="rabbit-publisher", daemon=True)
+            self._thread.start()
+
+    def publish(self, routing_key: str, msg: dict[str, any]) -> bool:
+        """
+        Enqueues a message for publishing to the user's shard of the 'routing_key' queue. Never blocks.
+        Returns False if the message could not be serialized or the buffer is full.
+        Messages carry 'sent_at' so the consumer can measure how far behind it is.
+        Does nothing when the caches are kept in sync by the change stream.
+        """
+        if not self.enabled:
+            return True
+        queue_name = routing_key
+        try:
+            routing_key = shard_queue(routing_key, msg["user_id"])
+            sent_at = time.time()
+            body = json.dumps({**msg, "sent_at": sent_at}, default=datetime_serializer)
+            self._buffer.put_nowait((routing_key, body, sent_at))
+            metrics.RABBIT_MESSAGES.labels(queue_name, "enqueued").inc()
+            return True
+        except queue.Full:
+            metrics.RABBIT_MESSAGES.labels(queue_name, "buffer_full").inc()
+            logger.error(f"RabbitMQ publish buffer full, dropping message for '{routing_key}'")
+        except TypeError as e:
+            metrics.RABBIT_MESSAGES.labels(queue_name, "unserializable").inc()
+            logger.error(f"Could not serialize RabbitMQ message for '{routing_key}': {e}")
+        return False
+
+    def close(self, timeout: float = 5.0):
+        """
+        Stops the publishing thread once it has flushed the buffer, waiting for it at most 'timeout' seconds.
+        Never blocks on a full buffer: the thread also stops when the buffer runs empty after close().
+        """
+        logger.info("closing rabbitmq publisher")
+        if self._thread is not None:
+            self._closing.set()
+            try:
+                self._buffer.put_nowait(self._STOP)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.error(f"RabbitMQ publisher didn't stop within {timeout}s, {self._buffer.qsize()} messages not published")
+            self._thread = None
+        RabbitPublisher._instance = None
+
+    def _connect(self):
+        retry_interval = 1
+        while True:
+            try:
+                self._connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host, heartbeat=60))
+                self._channel = self._connection.channel()
+                for q in self.queues:
+                    for shard in queue_shards(q):
+                        self._channel.queue_declare(queue=shard, durable=True)
+                if self.confirms:
+                    self._channel.confirm_delivery()
+                metrics.RABBIT_RECONNECTS.inc()
+                logger.info(f"RabbitMQ publisher connected to {self.host}")
+                return
+            except pika.exceptions.AMQPError as e:
+                logger.error(f"RabbitMQ publisher failed to connect to {self.host}: {e}. Retrying in {retry_interval}s")
+                time.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, 30)
+
+    def _next_batch(self) -> tuple[list[tuple[str, str, float]], bool]:
+        """
+        Blocks for the first message, then collects more until the batch is full
+        or the batch window elapses. Returns the batch and whether to stop.
+        """
+        batch = []
+        try:
+            item = self._buffer.get(timeout=1)
+        except queue.Empty:
+            return batch, self._closing.is_set()
+        if item is self._STOP:
+            return batch, True
+        batch.append(item)
+
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._buffer.get(timeout=remaining) if remaining > 0 else self._buffer.get_nowait()
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        self._connect()
+        properties = pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent)
+        pending: list[tuple[str, str, float]] = []
+        stop = False
+
+        while True:
+            if not pending:
+                if stop:
+                    break
+                pending, stop = self._next_batch()
+                if not pending:
+                    # keep heartbeats flowing while idle
+                    try:
+                        self._connection.process_data_events(time_limit=0)
+                    except pika.exceptions.AMQPError:
+                        self._connect()
+                    continue
+            metrics.RABBIT_BATCH_SIZE.observe(len(pending))
+            start = time.perf_counter()
+            try:
+                while pending:
+                    routing_key, body, sent_at = pending[0]
+                    self._channel.basic_publish(exchange='', routing_key=routing_key, body=body, properties=properties)
+                    metrics.RABBIT_PUBLISH_DELAY_SECONDS.observe(time.time() - sent_at)
+                    pending.pop(0)
+            except (pika.exceptions.UnroutableError, pika.exceptions.NackError) as e:
+                logger.error(f"RabbitMQ rejected message for '{pending[0][0]}': {e}")
+                metrics.RABBIT_MESSAGES.labels(base_queue(pending[0][0]), "rejected").inc()
+                pending.pop(0)
+            except pika.exceptions.AMQPError as e:
+                logger.error(f"RabbitMQ publish failed, reconnecting: {e}")
+                self._connect()
+            finally:
+                metrics.RABBIT_BATCH_SECONDS.observe(time.perf_counter() - start)
+
+        if self._connection and self._connection.is_open:
+            self._connection.close()
@@ -1,10 +1,48 @@
-import redis, os
+import redis, os, time
+from redis.client import Pipeline
+from lib.metrics import REDIS_COMMAND_SECONDS, REDIS_ERRORS
+
+
+class InstrumentedPipeline(Pipeline):
+    """
+    Pipeline that records one timing for the whole round trip, labelled 'pipeline' or 'multi'.
+    """
+    def execute(self, raise_on_error: bool = True):
+        command = "multi" if self.transaction else "pipeline"
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        except redis.RedisError as e:
+            REDIS_ERRORS.labels(command, type(e).__name__).inc()
+            raise
+        finally:
+            REDIS_COMMAND_SECONDS.labels(command).observe(time.perf_counter() - start)
+
+
+class InstrumentedRedis(redis.Redis):
+    """
+    redis.Redis that records the latency & errors of every command (and pipeline) it runs.
+    """
+    def execute_command(self, *args, **options):
+        command = str(args[0]).lower()
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        except redis.RedisError as e:
+            REDIS_ERRORS.labels(command, type(e).__name__).inc()
+            raise
+        finally:
+            REDIS_COMMAND_SECONDS.labels(command).observe(time.perf_counter() - start)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
 
 # NOTE: redis stores data as bytes so use 'json.dumps()' when storing and 'json.loads()' when retrieving
 # default to 'redis' if 'localhost' doesn't work in docker container
-redis_client: redis.Redis = redis.Redis(
+redis_client: redis.Redis = InstrumentedRedis(
     host=os.getenv("REDIS_HOST", "localhost"),
-    port=6379, 
+    port=6379,
     db=0,
     decode_responses=True
 )
@@ -0,0 +1,137 @@
+import redis, os, time, hashlib
+import constants
+
+# Per user search history: the last few searches (a list, most recent first) and how often each
+# search was run (a sorted set of normalized query -> count, capped).
+# Global trending searches: a count-min sketch of every query (constant memory whatever the number of
+# distinct queries) feeding a top-k sorted set. Counts decay exponentially with TRENDING_HALF_LIFE
+# (forward decay: each search adds 2^(age of the sketch / half life), so newer searches weigh more).
+
+RECENT_SEARCHES_MAX = 5                 # recent searches kept per user
+RECENT_SEARCHES_TTL = 86400 * 2
+FREQUENT_SEARCHES_MAX = int(os.getenv("FREQUENT_SEARCHES_MAX", "50"))      # distinct searches counted per user
+FREQUENT_SEARCHES_SHOWN = 5
+FREQUENT_SEARCHES_TTL = int(os.getenv("FREQUENT_SEARCHES_TTL", str(86400 * 30)))
+
+TRENDING_HALF_LIFE = int(os.getenv("TRENDING_HALF_LIFE", "21600"))      # seconds for a search's weight to halve
+TRENDING_TOP_K = int(os.getenv("TRENDING_TOP_K", "100"))                # trending searches tracked
+TRENDING_SKETCH_WIDTH = 2048    # counters per row; estimates are off by at most ~e/width of all searches
+TRENDING_SKETCH_DEPTH = 4       # rows, each with its own hash of the query
+TRENDING_RESCALE_AT = 2 ** 20   # weight past which the sketch & top-k are scaled back down (every 20 half lives)
+
+# KEYS: recent list, frequency set, sketch hash, top-k set
+# ARGV: search as typed, normalized query, recent max, recent ttl, frequency max, frequency ttl,
+#       now, half life, top k, rescale at, frequent shown, then the query's sketch counter of each row
+# Returns the recent searches and the most frequent ones
+_RECORD_SCRIPT = """
+local removed = redis.call('LREM', KEYS[1], 0, ARGV[1])
+redis.call('LPUSH', KEYS[1], ARGV[1])
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[3]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+
+redis.call('ZINCRBY', KEYS[2], 1, ARGV[2])
+if redis.call('ZCARD', KEYS[2]) > tonumber(ARGV[5]) then
+    -- drop the least run search, but never the one just counted
+    for _, query in ipairs(redis.call('ZRANGE', KEYS[2], 0, 1)) do
+        if query ~= ARGV[2] then
+            redis.call('ZREM', KEYS[2], query)
+            break
+        end
+    end
+end
+redis.call('EXPIRE', KEYS[2], ARGV[6])
+
+-- a search the user repeats while it's still in their recent searches doesn't count again for trending
+if removed == 0 then
+    local now, half_life = tonumber(ARGV[7]), tonumber(ARGV[8])
+    local epoch = tonumber(redis.call('HGET', KEYS[3], 'epoch'))
+    if not epoch then
+        epoch = now
+        redis.call('HSET', KEYS[3], 'epoch', epoch)
+    end
+    local weight = 2 ^ ((now - epoch) / half_life)
+
+    if weight > tonumber(ARGV[10]) then
+        local counters = redis.call('HGETALL', KEYS[3])
+        for i = 1, #counters, 2 do
+            if counters[i] ~= 'epoch' then
+                redis.call('HSET', KEYS[3], counters[i], tonumber(counters[i + 1]) / weight)
+            end
+        end
+        local top = redis.call('ZRANGE', KEYS[4], 0, -1, 'WITHSCORES')
+        for i = 1, #top, 2 do
+            redis.call('ZADD', KEYS[4], tonumber(top[i + 1]) / weight, top[i])
+        end
+        redis.call('HSET', KEYS[3], 'epoch', now)
+        weight = 1
+    end
+
+    -- conservative update: only the counters below the new estimate are raised
+    local counts, estimate = {}, math.huge
+    for i = 12, #ARGV do
+        counts[i] = tonumber(redis.call('HGET', KEYS[3], ARGV[i])) or 0
+        estimate = math.min(estimate, counts[i])
+    end
+    estimate = estimate + weight
+    for i = 12, #ARGV do
+        if counts[i] < estimate then
+            redis.call('HSET', KEYS[3], ARGV[i], estimate)
+        end
+    end
+
+    redis.call('ZADD', KEYS[4], estimate, ARGV[2])
+    if redis.call('ZCARD', KEYS[4]) > tonumber(ARGV[9]) then
+        redis.call('ZREMRANGEBYRANK', KEYS[4], 0, -(tonumber(ARGV[9]) + 1))
+    end
+end
+
+return {redis.call('LRANGE', KEYS[1], 0, -1), redis.call('ZREVRANGE', KEYS[2], 0, tonumber(ARGV[11]) - 1)}
+"""
+
+
+def _sketch_counters(query: str) -> list[str]:
+    digest = hashlib.blake2b(query.encode(), digest_size=4 * TRENDING_SKETCH_DEPTH).digest()
+    return [
+        str(row * TRENDING_SKETCH_WIDTH + int.from_bytes(digest[row * 4:row * 4 + 4], "little") % TRENDING_SKETCH_WIDTH)
+        for row in range(TRENDING_SKETCH_DEPTH)
+    ]
+
+
+def record(r: redis.Redis, uid: str | None, search_item: str, query: str) -> tuple[list[str], list[str]]:
+    """
+    Records a search ('query' being its normalized form) in one script call.
+    Returns the user's recent searches and most frequent ones.
+    """
+    script = r.register_script(_RECORD_SCRIPT)
+    recent, frequent = script(
+        keys=[constants.RECENT_SEARCHES_KEY(uid), constants.FREQUENT_SEARCHES_KEY(uid), constants.TRENDING_SKETCH_KEY, constants.TRENDING_TOP_KEY],
+        args=[search_item, query, RECENT_SEARCHES_MAX, RECENT_SEARCHES_TTL, FREQUENT_SEARCHES_MAX, FREQUENT_SEARCHES_TTL,
+              time.time(), TRENDING_HALF_LIFE, TRENDING_TOP_K, TRENDING_RESCALE_AT, FREQUENT_SEARCHES_SHOWN, *_sketch_counters(query)],
+    )
+    return recent, frequent
+
+
+def history(r: redis.Redis, uid: str | None) -> tuple[list[str], list[str]]:
+    """
+    Returns the user's recent searches and most frequent ones, in one round trip.
+    """
+    pipe = r.pipeline(transaction=False)
+    pipe.lrange(constants.RECENT_SEARCHES_KEY(uid), 0, RECENT_SEARCHES_MAX - 1)
+    pipe.zrevrange(constants.FREQUENT_SEARCHES_KEY(uid), 0, FREQUENT_SEARCHES_SHOWN - 1)
+    recent, frequent = pipe.execute()
+    return recent, frequent
+
+
+def trending(r: redis.Redis, limit: int) -> list[dict[str, any]]:
+    """
+    Returns the most searched queries lately, with their decayed search counts (estimates).
+    """
+    pipe = r.pipeline(transaction=False)
+    pipe.hget(constants.TRENDING_SKETCH_KEY, "epoch")
+    pipe.zrevrange(constants.TRENDING_TOP_KEY, 0, limit - 1, withscores=True)
+    epoch, top = pipe.execute()
+    if epoch is None:
+        return []
+
+    weight = 2 ** ((time.time() - float(epoch)) / TRENDING_HALF_LIFE)
+    return [{"query": query, "score": round(score / weight, 2)} for query, score in top]
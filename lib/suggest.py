@@ -0,0 +1,115 @@
+import redis, re, os
+import constants
+
+# Typeahead index: one sorted set per prefix, holding the completions that start with it
+# ("<type>|<text>", type being title, author or query) scored by popularity.
+# Completions are indexed under the prefixes of their first few words too, so "pot" finds "Harry Potter".
+
+SUGGEST_MIN_PREFIX = 2          # shorter prefixes aren't indexed or answered
+SUGGEST_MAX_PREFIX = int(os.getenv("SUGGEST_MAX_PREFIX", "12"))         # longer prefixes are looked up by their first characters
+SUGGEST_MAX_WORDS = 3           # a completion is also found by the prefixes of its 2nd & 3rd word
+SUGGEST_MAX_ENTRIES = int(os.getenv("SUGGEST_MAX_ENTRIES", "100"))      # completions kept per prefix, the least popular are dropped
+SUGGEST_TTL = int(os.getenv("SUGGEST_TTL", str(86400 * 30)))            # prefixes nobody added to for this long expire
+
+TITLE = "title"
+AUTHOR = "author"
+QUERY = "query"
+
+# a search someone ran counts for more than a book showing up in results
+RESULT_WEIGHT = 1
+QUERY_WEIGHT = 5
+
+# ARGV[1] increment, ARGV[2] entries kept per prefix, ARGV[3] ttl, then (completion, number of prefixes) pairs;
+# KEYS are the prefix sets of every completion, in order
+_ADD_SCRIPT = """
+local cap = tonumber(ARGV[2])
+local k = 1
+for i = 4, #ARGV, 2 do
+    for _ = 1, tonumber(ARGV[i + 1]) do
+        local key = KEYS[k]
+        redis.call('ZINCRBY', key, ARGV[1], ARGV[i])
+        if redis.call('ZCARD', key) > cap then
+            redis.call('ZREMRANGEBYRANK', key, 0, -(cap + 1))
+        end
+        redis.call('EXPIRE', key, ARGV[3])
+        k = k + 1
+    end
+end
+return k - 1
+"""
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+
+
+def normalize(text: str) -> str:
+    """
+    "Harry Potter & the Sorcerer's Stone" -> "harry potter the sorcerers stone"
+    """
+    return " ".join(_PUNCTUATION.sub("", text.lower()).split())
+
+
+def _prefixes(text: str) -> set[str]:
+    words = normalize(text).split()
+    prefixes = set()
+    for start in range(min(len(words), SUGGEST_MAX_WORDS)):
+        tail = " ".join(words[start:])
+        prefixes.update(tail[:n] for n in range(SUGGEST_MIN_PREFIX, min(len(tail), SUGGEST_MAX_PREFIX) + 1))
+    return prefixes
+
+
+def add(r: redis.Redis, completions: list[tuple[str, str]], weight: int = RESULT_WEIGHT):
+    """
+    Adds (type, text) completions to the index, or makes them more popular if they're already in it.
+    All of them are written by one script call.
+    """
+    keys, args = [], [weight, SUGGEST_MAX_ENTRIES, SUGGEST_TTL]
+    for kind, text in dict.fromkeys(completions):
+        text = " ".join(text.split())
+        prefixes = _prefixes(text)
+        if prefixes:
+            keys.extend(constants.SUGGEST_KEY(prefix) for prefix in prefixes)
+            args.extend([f"{kind}|{text}", len(prefixes)])
+    if keys:
+        r.register_script(_ADD_SCRIPT)(keys=keys, args=args)
+
+
+def add_books(r: redis.Redis, books: list[dict[str, any]], weight: int = RESULT_WEIGHT):
+    """
+    Adds the titles & authors of search results.
+    """
+    completions = []
+    for book in books:
+        if book.get("title"):
+            completions.append((TITLE, book["title"]))
+        completions.extend((AUTHOR, author) for author in book.get("authors") or [] if author)
+    add(r, completions, weight)
+
+
+def suggest(r: redis.Redis, text: str, limit: int) -> list[dict[str, any]]:
+    """
+    Returns up to 'limit' completions of what the user typed so far, most popular first.
+    """
+    prefix = normalize(text)
+    if len(prefix) < SUGGEST_MIN_PREFIX:
+        return []
+
+    key = constants.SUGGEST_KEY(prefix[:SUGGEST_MAX_PREFIX])
+    if len(prefix) <= SUGGEST_MAX_PREFIX:
+        entries = r.zrevrange(key, 0, limit - 1, withscores=True)
+    else:
+        # the index stops at SUGGEST_MAX_PREFIX characters, check the rest of the prefix here
+        entries = [
+            (member, score) for member, score in r.zrevrange(key, 0, -1, withscores=True)
+            if any(tail.startswith(prefix) for tail in _word_tails(member.partition("|")[2]))
+        ][:limit]
+
+    suggestions = []
+    for member, score in entries:
+        kind, _, completion = member.partition("|")
+        suggestions.append({"text": completion, "type": kind, "score": score})
+    return suggestions
+
+
+def _word_tails(text: str) -> list[str]:
+    words = normalize(text).split()
+    return [" ".join(words[start:]) for start in range(min(len(words), SUGGEST_MAX_WORDS))]
@@ -1,43 +1,155 @@
-import logging
+from logging.handlers import QueueHandler, QueueListener
+from lib.metrics import LOG_RECORDS_DROPPED
+import atexit, logging, os, queue, random, sys, time
+import orjson
 
 LOG_FILE_PATH = "app.log" # Define your log file path
 
+# Records are queued on the calling thread and formatted & written by one background thread,
+# so request handlers never wait on the disk or stdout.
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))     # records buffered before new ones are dropped
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")                   # 'json' (one object per line) or 'text'
+LOG_CONSOLE = os.getenv("LOG_CONSOLE", "false").lower() == "true"   # also write to stderr when logging to a file
+# per logger overrides, e.g. LOG_LEVELS="routers.search_api=WARNING,pymongo=WARNING"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# keep only this fraction of a logger's records below WARNING, e.g. LOG_SAMPLING="uvicorn.access=0.01"
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+
+# attributes every LogRecord has; anything else was passed through 'extra' and is logged as a field
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName", "color_message"}
+
+_listener: QueueListener | None = None
+_listener_pid: int | None = None
+
+
+def _parse_pairs(spec: str) -> dict[str, str]:
+    pairs = {}
+    for item in spec.split(","):
+        name, sep, value = item.strip().partition("=")
+        if sep and name:
+            pairs[name.strip()] = value.strip()
+    return pairs
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record. Fields passed with extra={...} are kept as their own keys,
+    so log lines can be filtered on user_id, book_id, etc. instead of parsing messages.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.processName,
+            "msg": record.getMessage(),
+            "module": record.module,
+            "line": record.lineno,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the records below WARNING from the given loggers (and their children).
+    Warnings & errors are always kept.
+    """
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        name = record.name
+        while name:
+            if name in self.rates:
+                return random.random() < self.rates[name]
+            name = name.rpartition(".")[0]
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    QueueHandler that never blocks: when the writer falls behind, new records are dropped and counted.
+    Formatting is left to the writer thread, so don't mutate objects after passing them as log args.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
 def setup_global_logger(log_file_path=LOG_FILE_PATH, level=logging.INFO):
     """
-    Configures a global logger to write to a specified file.
+    Configures the root logger to hand records to a background writer thread,
+    which writes them to 'log_file_path' (or stderr when it is None).
+    Safe to call again, e.g. in a forked worker process, which needs its own writer thread.
     """
+    global _listener, _listener_pid
+
     # Get the root logger
-    logger = logging.getLogger() # Get the root logger
-    logger.setLevel(level) # Set the minimum logging level
-
-    # Prevent duplicate handlers if this function is called multiple times
-    if logger.hasHandlers():
-        for handler in logger.handlers:
-            if isinstance(handler, logging.FileHandler) and handler.baseFilename == log_file_path:
-                print("File logger already configured.")
-                return
-            # Be careful with clearing all handlers if other libraries or Uvicorn also set them up.
-            # Often, just adding your file handler is enough.
-
-    # Create a file handler to write to the log file
-    file_handler = logging.FileHandler(log_file_path, mode='a')
-    file_handler.setLevel(level) # Set level for this specific handler
-
-    # Create a formatter to define the log message format
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    file_handler.setFormatter(formatter)
-
-    # Add the file handler to the logger
-    logger.addHandler(file_handler)
-
-    # Add a console handler as well if you want to see logs in console AND file
-    # console_handler = logging.StreamHandler()
-    # console_handler.setLevel(logging.DEBUG) # Or your desired console level
-    # console_handler.setFormatter(formatter) # Use the same or a different formatter
-    # logger.addHandler(console_handler)
-
-    print(f"Global file logger configured. Logging to: {log_file_path} with level: {logging.getLevelName(level)}")
+    logger = logging.getLogger()
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+
+    # Replace a previous setup; a listener inherited through fork has no running thread to stop
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    for handler in list(logger.handlers):
+        if isinstance(handler, DroppingQueueHandler):
+            logger.removeHandler(handler)
+
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        )
+
+    writers: list[logging.Handler] = []
+    if log_file_path:
+        writers.append(logging.FileHandler(log_file_path, mode='a'))
+    if not log_file_path or LOG_CONSOLE:
+        writers.append(logging.StreamHandler(sys.stderr))
+    for writer in writers:
+        writer.setFormatter(formatter)
 
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    queue_handler.addFilter(SamplingFilter({name: float(rate) for name, rate in _parse_pairs(LOG_SAMPLING).items()}))
+    logger.addHandler(queue_handler)
+
+    for name, name_level in _parse_pairs(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(name_level.upper())
+
+    # uvicorn writes its own logs straight to stdout, send them through the queue as well
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers.clear()
+        uvicorn_logger.propagate = True
+
+    _listener = QueueListener(queue_handler.queue, *writers, respect_handler_level=False)
+    _listener.start()
+    _listener_pid = os.getpid()
+    atexit.register(shutdown_logger)
+
+    logging.getLogger(__name__).info(f"Logging to {log_file_path or 'stderr'} at {logging.getLevelName(logger.level)} through a background writer")
+
+
+def shutdown_logger():
+    """
+    Flushes the queued records and stops the writer thread.
+    """
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    _listener = None
@@ -3,16 +3,23 @@ from fastapi import FastAPI
 from dotenv import load_dotenv
 import os, logging
 
+# before the imports below, they read their settings from the environment when imported
+load_dotenv()
+
 from routers.search_api import s_api
 from routers.book_api import b_api
 from routers.lib_api import l_api
-from lib.mongo import DBClient
-
-load_dotenv()
-
+from routers.metrics_api import m_api
+from lib.mongo import DBClient, CATALOG_INDEXES
+from lib.catalog import CATALOG_COLLECTION
+from lib.rabbit import RabbitPublisher
+from lib.http import HttpClient
+from lib.redis import redis_client
+from lib.l1cache import start_invalidation_listener
+from lib.metrics import MetricsMiddleware
 from log import setup_global_logger
 
-setup_global_logger(log_file_path="my_app.log", level=logging.DEBUG)
+setup_global_logger(log_file_path="my_app.log", level=os.getenv("LOG_LEVEL", "INFO"))
 
 DB_NAME = os.getenv("DB_NAME")
 MONGO_URI = os.getenv("MONGO_URI")
@@ -21,12 +28,22 @@ mongo = DBClient.get_instance(uri=MONGO_URI, db_name=DB_NAME)
 
 @asynccontextmanager
 async def lifespan(fapp: FastAPI):
+    mongo.ensure_indexes()
+    mongo.ensure_indexes(CATALOG_COLLECTION, CATALOG_INDEXES)
+    start_invalidation_listener(redis_client)
+    publisher = RabbitPublisher.get_instance()
+    publisher.start()
+    http_client = HttpClient.get_instance()
     yield
+    await http_client.close()
+    publisher.close()
     mongo.close()
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
 
 
 app.include_router(s_api)
 app.include_router(b_api, prefix="/book")
 app.include_router(l_api, prefix="/lib")
+app.include_router(m_api)
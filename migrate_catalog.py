@@ -0,0 +1,136 @@
+"""
+Moves the book details embedded in every library document into the shared catalog.
+
+For each batch of library documents that still embed a whole book, the books the catalog doesn't have yet are
+looked up on Google (the embedded details came from clients, so they are never copied into the catalog), then the
+details are removed from the library documents whose book the catalog has. Those keep only the book id, favorite
+flag & reading progress. Documents whose book couldn't be looked up keep their embedded copy (only their owner sees
+it) and are migrated by a later run. Safe to stop and run again: migrated documents no longer match.
+The library & favorites caches are dropped at the end, so they are rebuilt in the slim format.
+
+    python migrate_catalog.py --dry-run
+    python migrate_catalog.py --batch-size 500
+    python migrate_catalog.py --refresh-catalog     # also re-check entries older versions of this script copied from libraries
+"""
+from pymongo import UpdateOne, ASCENDING
+from dotenv import load_dotenv
+import argparse, asyncio, logging, os, sys, time
+import bson
+
+# before the imports below, they read their settings from the environment when imported
+load_dotenv()
+
+from lib import book_cache
+from lib.catalog import Catalog, CATALOG_COLLECTION
+from lib.google_books import GoogleBooksClient
+from lib.http import HttpClient
+from lib.mongo import DBClient
+from lib.redis import redis_client
+from log import setup_global_logger
+from schemas.book import catalog_entry
+
+logger = logging.getLogger("migrate_catalog")
+
+# library documents still embedding the book's details
+UNMIGRATED = {"book.title": {"$exists": True}}
+
+
+async def migrate_batch(db, catalog: Catalog, books_api: GoogleBooksClient, docs: list[dict[str, any]]) -> tuple[list[dict[str, any]], set[str]]:
+    """
+    Migrates one batch. Returns the slimmed library documents and the ids Google doesn't know.
+    """
+    found, unknown = await catalog.ensure([doc["book"]["id"] for doc in docs], books_api)
+    migrated = [doc for doc in docs if doc["book"]["id"] in found]
+    if migrated:
+        db["books"].bulk_write(
+            [
+                UpdateOne({"_id": doc["_id"], **UNMIGRATED}, {"$unset": {f"book.{field}": "" for field in catalog_entry(doc["book"])}})
+                for doc in migrated
+            ],
+            ordered=False,
+        )
+    return migrated, unknown
+
+
+async def refresh_catalog(db, catalog: Catalog, books_api: GoogleBooksClient, args: argparse.Namespace):
+    """
+    Looks every catalog entry up on Google again, replacing the ones that differ.
+    Entries seeded from library documents by earlier versions of this script are corrected this way.
+    """
+    checked = failed = 0
+    last_id = None
+    while True:
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        ids = [doc["_id"] for doc in db[CATALOG_COLLECTION].find(query, {"_id": 1}).sort("_id", ASCENDING).limit(args.batch_size)]
+        if not ids:
+            break
+
+        found, unknown = await catalog.ensure(ids, books_api, refresh=True)
+        checked += len(found)
+        failed += len(ids) - len(found) - len(unknown)
+        if unknown:
+            logger.warning(f"{len(unknown)} catalog entries are unknown to Google: {sorted(unknown)}")
+        last_id = ids[-1]
+        logger.info(f"Checked {checked} catalog entries against Google, {failed} couldn't be looked up")
+        if args.pause:
+            await asyncio.sleep(args.pause)
+
+
+async def main(args: argparse.Namespace):
+    db = DBClient.get_instance(uri=os.getenv("MONGO_URI"), db_name=os.getenv("DB_NAME")).db
+    books = db["books"]
+
+    remaining = books.count_documents(UNMIGRATED)
+    logger.info(f"{remaining} library documents to migrate")
+    if args.dry_run or (not remaining and not args.refresh_catalog):
+        return
+
+    catalog, books_api = Catalog.get_instance(), GoogleBooksClient.get_instance()
+    try:
+        if args.refresh_catalog:
+            await refresh_catalog(db, catalog, books_api, args)
+
+        migrated = skipped = size_before = size_after = 0
+        last_id = None
+        start = time.monotonic()
+        while True:
+            query = UNMIGRATED if last_id is None else {**UNMIGRATED, "_id": {"$gt": last_id}}
+            docs = list(books.find(query).sort("_id", ASCENDING).limit(args.batch_size))
+            if not docs:
+                break
+
+            batch_migrated, unknown = await migrate_batch(db, catalog, books_api, docs)
+            migrated += len(batch_migrated)
+            skipped += len(docs) - len(batch_migrated)
+            if unknown:
+                logger.warning(f"{len(unknown)} books are unknown to Google, their library documents keep their details: {sorted(unknown)}")
+            for doc in batch_migrated:
+                size_before += len(bson.encode(doc))
+                size_after += len(bson.encode({**doc, "book": {k: v for k, v in doc["book"].items() if k not in catalog_entry(doc["book"])}}))
+            last_id = docs[-1]["_id"]
+            logger.info(f"Migrated {migrated}/{remaining} documents, {skipped} left for a later run")
+            if args.pause:
+                await asyncio.sleep(args.pause)
+
+        logger.info(f"Done in {time.monotonic() - start:.1f}s: {migrated} documents migrated, {skipped} left for a later run, "
+                    f"migrated library documents went from {size_before} to {size_after} bytes")
+    finally:
+        await HttpClient.get_instance().close()
+
+    if migrated and not args.keep_caches:
+        book_cache.drop_all(redis_client)
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Move embedded book details into the shared catalog")
+    parser.add_argument("--batch-size", type=int, default=500, help="library documents per batch")
+    parser.add_argument("--pause", type=float, default=0, help="seconds to sleep between batches, to go easy on a live database")
+    parser.add_argument("--dry-run", action="store_true", help="only count the documents to migrate")
+    parser.add_argument("--keep-caches", action="store_true", help="don't drop the library & favorites caches at the end")
+    parser.add_argument("--refresh-catalog", action="store_true", help="first look every catalog entry up on Google again, replacing the ones that differ")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    setup_global_logger(log_file_path=None, level=os.getenv("LOG_LEVEL", "INFO"))
+    asyncio.run(main(parse_args(sys.argv[1:])))
@@ -1,138 +1,224 @@
-print("RECEIVER SCRIPT STARTED ----- TOP OF FILE") 
+import pika, os, redis, json, time, sys, logging, multiprocessing, constants
+from prometheus_client import start_http_server
+from lib import book_cache, metrics
+from lib.rabbit import queue_shards, base_queue
+from lib.redis import InstrumentedRedis
+from log import setup_global_logger
 
-import pika, os, redis, json, time, sys, constants
+logger = logging.getLogger("receiver")
 
-print("RECEIVER SCRIPT IMPORTS DONE")
+CONSUMER_LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
-redis_client: redis.Redis = redis.Redis(
-    host=os.getenv("REDIS_HOST", "localhost"),
-    port=6379, 
-    db=0,
-    decode_responses=True
-)
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+RABBITMQ_CONNECT_HOST = os.getenv("RABBITMQ_HOST", "localhost")
 
-print("RECEIVER SCRIPT REDIS CLIENT INITIALIZED (or attempted)") 
+CONSUMER_WORKERS = int(os.getenv("CONSUMER_WORKERS", "1"))            # worker processes per container
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "200"))        # unacked messages each worker may hold
+CONSUMER_BATCH_SIZE = int(os.getenv("CONSUMER_BATCH_SIZE", "100"))    # max messages applied per redis pipeline
+CONSUMER_BATCH_WINDOW = float(os.getenv("CONSUMER_BATCH_WINDOW", "0.05"))  # seconds to wait for a batch to fill
+CONSUMER_METRICS_PORT = int(os.getenv("CONSUMER_METRICS_PORT", "9100"))    # worker N serves /metrics on this port + N, 0 turns it off
 
-RABBITMQ_CONNECT_HOST = os.getenv("RABBITMQ_HOST", "localhost")
-print(f"RECEIVER SCRIPT RABBITMQ_HOST: {RABBITMQ_CONNECT_HOST}")
 
-def main():
-    connection, channel = None, None
+def apply_fav_message(r: redis.Redis, data: dict[str, any]):
+    uid = data['user_id']
+    # older messages carried the book as 'new_book'
+    book = data.get("book") or data.get("new_book")
+
+    match data["action"]:
+        case constants.ADD_FAV:
+            book_cache.put_book(r, uid, book, book_cache.FAV)
+            book_cache.put_book(r, uid, book, book_cache.LIB)
+
+        case constants.RM_FAV:
+            book_cache.remove_book(r, uid, book["id"], book_cache.FAV)
+            book_cache.put_book(r, uid, {**book, "is_favorite": False}, book_cache.LIB)
+
+        case constants.UPDATED_FAV:
+            # replace the out of date book in the library cache
+            book_cache.put_book(r, uid, book, book_cache.LIB)
+
+            # add to the favorite book cache
+            book_cache.put_book(r, uid, book, book_cache.FAV)
+
+
+def apply_lib_message(r: redis.Redis, data: dict[str, any]):
+    uid = data['user_id']
+    book = data.get("book")
+
+    match data["action"]:
+        case constants.ADD_LIB:
+            book_cache.put_book(r, uid, book, book_cache.LIB)
+
+        case constants.RM_LIB:
+            book_cache.remove_book(r, uid, book["id"], book_cache.LIB)
+            book_cache.remove_book(r, uid, book["id"], book_cache.FAV)
+
+        case constants.UPDATE_LIB:
+            book_cache.put_book(r, uid, book, book_cache.LIB)
+            if book.get("is_favorite"):
+                book_cache.put_book(r, uid, book, book_cache.FAV)
+
+        case constants.BULK_ADD_LIB:
+            for book in data["books"]:
+                book_cache.put_book(r, uid, book, book_cache.LIB)
+
+        case constants.BULK_UPDATE_LIB:
+            for book in data["books"]:
+                book_cache.put_book(r, uid, book, book_cache.LIB)
+                if book.get("is_favorite"):
+                    book_cache.put_book(r, uid, book, book_cache.FAV)
+
+
+def connect(queues: list[str]):
     retry_interval = 5
-    max_retries = 12 
+    max_retries = 12
     attempt = 0
 
-    print(f" [CONSUMER] Using RABBITMQ_HOST: {RABBITMQ_CONNECT_HOST}")
-
     while attempt < max_retries:
         try:
-            print(f" [CONSUMER] Attempting to connect to RabbitMQ at {RABBITMQ_CONNECT_HOST} (Attempt {attempt + 1}/{max_retries})...")
+            logger.info(f"Attempting to connect to RabbitMQ at {RABBITMQ_CONNECT_HOST} (Attempt {attempt + 1}/{max_retries})...")
             connection_params = pika.ConnectionParameters(
                 host=RABBITMQ_CONNECT_HOST,
-                heartbeat=60, 
+                heartbeat=60,
                 blocked_connection_timeout=3
             )
 
             connection = pika.BlockingConnection(connection_params)
             channel = connection.channel()
-            print(f" [CONSUMER] Successfully connected to RabbitMQ at {RABBITMQ_CONNECT_HOST}")
-
-
-            channel.queue_declare(queue=constants.RABBIT_QUEUE_FAV, durable=True)
-            print(f" [CONSUMER] Queue '{constants.RABBIT_QUEUE_FAV}' declared.")
+            logger.info(f"Successfully connected to RabbitMQ at {RABBITMQ_CONNECT_HOST}")
 
-            channel.queue_declare(queue=constants.RABBIT_QUEUE_LIB, durable=True)
-            print(f" [CONSUMER] Queue '{constants.RABBIT_QUEUE_LIB}' declared.")
-            break
+            for q in queues:
+                channel.queue_declare(queue=q, durable=True)
+            logger.info(f"Queues declared: {queues}")
+            return connection, channel
 
         except pika.exceptions.AMQPConnectionError as e:
-            print(f" [CONSUMER] RabbitMQ connection failed: {e}.")
+            logger.warning(f"RabbitMQ connection failed: {e}.")
             attempt += 1
             if attempt >= max_retries:
-                print(" [CONSUMER] Max retries reached. Could not connect to RabbitMQ. Exiting.")
-                sys.exit(1) 
+                logger.error("Max retries reached. Could not connect to RabbitMQ. Exiting.")
+                sys.exit(1)
 
-            print(f" [CONSUMER] Retrying in {retry_interval} seconds...")
+            logger.info(f"Retrying in {retry_interval} seconds...")
             time.sleep(retry_interval)
 
         except Exception as e_generic:
-            print(f" [CONSUMER] An unexpected error occurred during RabbitMQ setup: {e_generic}")
+            logger.error(f"An unexpected error occurred during RabbitMQ setup: {e_generic}")
             sys.exit(1)
 
-    # Should have exited if connection failed after retries
-    if not channel: 
-        print(" [CONSUMER] Failed to establish RabbitMQ channel. Exiting.")
+
+def run_worker(worker_id: int, workers: int):
+    """
+    Consumes the queue shards owned by this worker. Messages are applied to redis in batches,
+    one pipeline per batch, and acked only once that pipeline has succeeded.
+    Every shard is owned by exactly one worker, so each user's events are applied in order.
+    """
+    if workers > 1:
+        # a forked worker doesn't inherit the parent's log writer thread
+        setup_global_logger(log_file_path=None, level=CONSUMER_LOG_LEVEL)
+
+    redis_client = InstrumentedRedis(host=REDIS_HOST, port=6379, db=0, decode_responses=True)
+    if CONSUMER_METRICS_PORT:
+        start_http_server(CONSUMER_METRICS_PORT + worker_id)
+
+    handlers = {}
+    for queue, handler in ((constants.RABBIT_QUEUE_FAV, apply_fav_message), (constants.RABBIT_QUEUE_LIB, apply_lib_message)):
+        for i, shard in enumerate(queue_shards(queue)):
+            if i % workers == worker_id:
+                handlers[shard] = handler
+
+    if not handlers:
+        logger.warning(f"Worker {worker_id} owns no queue shards (more workers than shards), exiting.")
         return
 
-    def fav_callback(ch, method, properties, body):
-        print("[x] Received (in fav)")
-        json_data = body.decode('utf-8')
-        data = json.loads(json_data)
-        cache_key = constants.FAV_CACHE_KEY(data['user_id'])
-        cache_key_lib = constants.LIB_CACHE_KEY(data['user_id'])
-    
-        match data["action"]:
-            case constants.ADD_FAV:
-                print("adding book to favorites cache")
-                redis_client.lpush(cache_key, json.dumps(data["book"]))
-                redis_client.lpush(cache_key_lib, json.dumps(data["book"]))
-
-            case constants.RM_FAV:
-                print("removing book from favorites cache")
-                redis_client.lrem(cache_key, 0, json.dumps(data['book']))
-            
-            case constants.UPDATED_FAV:
-                print("updating book in lib to be favorited")
-
-                # remove the out of date book from library cache
-                redis_client.lrem(cache_key_lib, 0, json.dumps(data["old_book"]))
-
-                # add the up to date to the library cache
-                redis_client.lpush(cache_key_lib, json.dumps(data["new_book"]))
-
-                # add to the favorite book cache
-                redis_client.lpush(cache_key, json.dumps(data["new_book"]))
-
-        print("[x] Done processing message (fav queue). ")
-   
-    
-    def lib_callback(ch, method, properties, body):
-        print("[x] Received (in lib)")
-        json_data = body.decode('utf-8')
-        data = json.loads(json_data)
-        cache_key = constants.LIB_CACHE_KEY(data['user_id'])
-
-        match data["action"]:
-            case constants.ADD_LIB:
-                print("adding book to library cache")
-                redis_client.lpush(cache_key, json.dumps(data["book"]))
-                
-            case constants.RM_LIB:
-                print("removing from library cache")
-                redis_client.lrem(cache_key, 0, json.dumps(data["book"]))
-                
-            case constants.UPDATE_LIB:
-                print("updating book from library cache")
-                redis_client.lrem(cache_key, 0, json.dumps(data["old_book"]))
-                redis_client.lpush(cache_key, json.dumps(data["book"]))
-
-        print("[x] Done processing message(lib). ")
-
-
-    channel.basic_consume(queue=constants.RABBIT_QUEUE_FAV, on_message_callback=fav_callback, auto_ack=True)
-    channel.basic_consume(queue=constants.RABBIT_QUEUE_LIB, on_message_callback=lib_callback, auto_ack=True)
-
-    print(f' [*] Waiting for messages on host {RABBITMQ_CONNECT_HOST}. To exit press CTRL+C')
+    connection, channel = connect(list(handlers))
+    channel.basic_qos(prefetch_count=CONSUMER_PREFETCH)
+
+    batch: list[tuple[pika.spec.Basic.Deliver, bytes]] = []
+
+    def on_message(ch, method, properties, body):
+        batch.append((method, body))
+
+    for q in handlers:
+        channel.basic_consume(queue=q, on_message_callback=on_message, auto_ack=False)
+
+    def flush():
+        start = time.perf_counter()
+        pipe = redis_client.pipeline(transaction=False)
+        applied = []
+        for method, body in batch:
+            queue_name = base_queue(method.routing_key)
+            try:
+                data = json.loads(body)
+                handlers[method.routing_key](pipe, data)
+                applied.append((queue_name, data))
+            except (ValueError, KeyError, TypeError) as e:
+                # poison message: acked with the rest of the batch so it can't block the queue
+                logger.error(f"Dropping malformed message from '{method.routing_key}': {e!r}")
+                metrics.CONSUMER_MESSAGES.labels(queue_name, "unknown", "malformed").inc()
+
+        last_tag = batch[-1][0].delivery_tag
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.error(f"Redis write failed, requeueing {len(batch)} messages: {e}")
+            channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+            metrics.CONSUMER_REQUEUED.inc(len(batch))
+            time.sleep(1)
+        else:
+            channel.basic_ack(delivery_tag=last_tag, multiple=True)
+            now = time.time()
+            for queue_name, data in applied:
+                metrics.CONSUMER_MESSAGES.labels(queue_name, data.get("action", "unknown"), "applied").inc()
+                # messages from older publishers have no 'sent_at'
+                if "sent_at" in data:
+                    metrics.CONSUMER_LAG_SECONDS.observe(max(0.0, now - data["sent_at"]))
+            logger.debug(f"Applied batch of {len(batch)} messages")
+        metrics.CONSUMER_BATCH_SIZE.observe(len(batch))
+        metrics.CONSUMER_BATCH_SECONDS.observe(time.perf_counter() - start)
+        batch.clear()
+
+    logger.info(f"Worker {worker_id} waiting for messages on {list(handlers)}")
     try:
-        channel.start_consuming()
+        while True:
+            # wait for the first message, then give the batch a short window to fill
+            connection.process_data_events(time_limit=1)
+            deadline = time.monotonic() + CONSUMER_BATCH_WINDOW
+            while batch and len(batch) < CONSUMER_BATCH_SIZE and (remaining := deadline - time.monotonic()) > 0:
+                connection.process_data_events(time_limit=remaining)
+            if batch:
+                flush()
     except KeyboardInterrupt:
-        print(" [CONSUMER] Shutting down...")
+        logger.info("Shutting down...")
     except Exception as e:
-        print(f" [CONSUMER] An error occurred during consumption: {e}")
+        logger.error(f"An error occurred during consumption: {e}")
     finally:
         if connection and not connection.is_closed:
-            print(" [CONSUMER] Closing RabbitMQ connection.")
+            logger.info("Closing RabbitMQ connection.")
             connection.close()
 
+
+def main():
+    setup_global_logger(log_file_path=None, level=CONSUMER_LOG_LEVEL)
+    logger.info(f"Using RABBITMQ_HOST: {RABBITMQ_CONNECT_HOST}, workers: {CONSUMER_WORKERS}")
+
+    if CONSUMER_WORKERS <= 1:
+        run_worker(0, 1)
+        return
+
+    procs = [
+        multiprocessing.Process(target=run_worker, args=(i, CONSUMER_WORKERS), name=f"consumer-{i}")
+        for i in range(CONSUMER_WORKERS)
+    ]
+    for p in procs:
+        p.start()
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        logger.info("Shutting down workers...")
+        for p in procs:
+            p.terminate()
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
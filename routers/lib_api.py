@@ -1,99 +1,117 @@
-from fastapi import APIRouter, HTTPException, status, Depends
-from pymongo.errors import PyMongoError
+from fastapi import APIRouter, HTTPException, status, Depends, Query
+from fastapi.responses import StreamingResponse
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError, DuplicateKeyError
 from redis.exceptions import RedisError
-from lib.mongo import DBClient
 from lib.redis import redis_client
-from lib.rabbit import init_rabbit_mq
+from lib.mongo import BOOKS_UNIQUE_INDEX
+from lib import book_cache
+from lib.rabbit import RabbitPublisher
+from lib.catalog import Catalog
 from schemas.requests import *
-from schemas.book import Book
-from utils.utils import send_msg
+from schemas.book import library_entry
+from utils.utils import send_msg, send_raw_msg, raw_json_list, ndjson_books
 from crud.crud import MongoCRUD
-from dependencies import get_crud_service
-import json, logging, constants
+from dependencies import get_crud_service, get_publisher, get_catalog
+import logging, constants
 
 l_api = APIRouter()
+logger = logging.getLogger(__name__)
 
 RABBIT_QUEUE = constants.RABBIT_QUEUE_LIB
+BOOK_PROJECTION = { "book": 1 }
+DUPLICATE_KEY = 11000   # Mongo error code
 
 @l_api.post("/add-book", status_code=status.HTTP_201_CREATED)
-async def add_book(request: AddToLibRequest, crud_service: MongoCRUD = Depends(get_crud_service)):
+async def add_book(request: AddToLibRequest, crud_service: MongoCRUD = Depends(get_crud_service), publisher: RabbitPublisher = Depends(get_publisher),
+                   catalog: Catalog = Depends(get_catalog)):
     try:
-        if await crud_service.doc_exists({ "user_id": request.user_id, "book.id": request.book.id }):
-            logging.info(f"INFO: User '{request.user_id}' attempted to add book (ID: '{request.book.id}') which is already in library.")
+        book = request.book.model_dump()
+
+        # without the unique index (it failed to build, e.g. over existing duplicates) nothing else stops a second copy
+        if not crud_service.client.has_index("books", BOOKS_UNIQUE_INDEX) and await crud_service.doc_exists({ "user_id": request.user_id, "book.id": request.book.id }):
+            logger.info("Book is already in library", extra={"user_id": request.user_id, "book_id": request.book.id})
             return send_msg(msg="Book is already in your library")
 
-        channel, connection = init_rabbit_mq()
-        channel.queue_declare(queue=RABBIT_QUEUE, durable=True)
+        # Create & insert document, the unique (user_id, book.id) index rejects books already in the library
+        try:
+            res = await crud_service.create_document(
+                {   "user_id": request.user_id, 
+                    "book": library_entry(book)
+                }
+            )
+        except DuplicateKeyError:
+            logger.info("Book is already in library", extra={"user_id": request.user_id, "book_id": request.book.id})
+            return send_msg(msg="Book is already in your library")
 
-        # Create & insert document
-        res = await crud_service.create_document
-        (
-            {   "user_id": request.user_id, 
-                "book": request.book.model_dump()
-            }
-        )
+        if res is None:
+            raise HTTPException(status_code=500, detail="Failed to add book to library.")
+
+        # only the per user fields of the request are stored, the book's details are looked up on Google in the background
+        catalog.fill_later([request.book.id])
 
         # RabbitMQ: send message
         mq_msg_data = {
             "user_id": request.user_id, 
-            "book": request.book.model_dump(),
+            "book": library_entry(book),
             "action": constants.ADD_LIB 
         }
             
-        channel.basic_publish(exchange='', routing_key=RABBIT_QUEUE, body=json.dumps(mq_msg_data))
+        publisher.publish(RABBIT_QUEUE, mq_msg_data)
         
         return send_msg(msg="success", inserted_id=res)
     
     except PyMongoError as mongo_err:
-        print(f"MongoDB error: {mongo_err}")  # Log MongoDB-specific error
+        logger.error(f"MongoDB error: {mongo_err}")
         raise HTTPException(status_code=500, detail="Database error. Please try again later.")
-    except Exception as mq_err:
-        print(f"Error publishing to RabbitMQ (non-critical): {mq_err}")
-    finally:
-        if connection and connection.is_open:
-            connection.close()
 
 
 @l_api.get("/my-books", status_code=status.HTTP_200_OK)
-async def my_books(uid: str, crud_service: MongoCRUD = Depends(get_crud_service)):
-    cache_key = constants.LIB_CACHE_KEY(uid)
+async def my_books(uid: str, limit: int | None = Query(None, ge=1, le=constants.MAX_PAGE_SIZE), after: str | None = None, stream: bool = False,
+                   crud_service: MongoCRUD = Depends(get_crud_service), catalog: Catalog = Depends(get_catalog)):
+    """
+    Without paging params the whole list is returned (from the cache when possible).
+    'limit' / 'after' return one page, newest first, with the cursor for the next page in 'next'.
+    'stream=true' streams every book as NDJSON straight from the Mongo cursor.
+    """
+    query = { "user_id" : uid}
+
+    if stream:
+        return StreamingResponse(ndjson_books(catalog.stream(crud_service.iter_documents(query, projection=BOOK_PROJECTION))), media_type="application/x-ndjson")
+
     try:
+        if limit or after:
+            if after and not ObjectId.is_valid(after):
+                raise HTTPException(status_code=400, detail="Invalid cursor.")
+            book_docs, next_cursor = await crud_service.read_page(query, limit or constants.DEFAULT_PAGE_SIZE, after, projection=BOOK_PROJECTION)
+            return send_raw_msg("success", "books", raw_json_list(await catalog.join_docs(book_docs)), next=next_cursor)
+
         # check if the users books in library are cached
-        cached_books = redis_client.lrange(cache_key, 0, -1)
+        cached_books = book_cache.read_books(redis_client, uid, book_cache.LIB)
         if cached_books:
-            cached_response = [Book(**json.loads(book_json_str)) for book_json_str in cached_books]
-            return send_msg(msg="success", cache=True, books=cached_response)
-
-        books = []
-        for book_doc in await crud_service.read_documents({ "user_id" : uid}):
-            bk = Book(**book_doc['book'])
-            books.append(bk)
+            return send_raw_msg("success", "books", raw_json_list(await catalog.join(cached_books)), cache=True)
 
-            # add to cache
-            redis_client.lpush(cache_key, json.dumps(book_doc['book']))
-            redis_client.expire(cache_key, 86400)     # Set expiration 
+        # rebuild the cache, and answer with the same serialized books
+        entries = await book_cache.load(redis_client, uid, book_cache.LIB, lambda: crud_service.read_documents(query))
+        books = await catalog.join(entries)
         if not books:
-            print(f"No books found for user_id: {uid}")
+            logger.info("No books found", extra={"user_id": uid})
             raise HTTPException(status_code=400, detail="No books found")
         
-        return send_msg(msg="success", book=books)
+        return send_raw_msg("success", "books", raw_json_list(books), cache=False)
 
     except PyMongoError as mongo_err:
-        print(f"MongoDB error: {mongo_err}")  # Log MongoDB-specific error
-        logging.error(f"MongoDB error: {mongo_err}")
+        logger.error(f"MongoDB error: {mongo_err}")
         raise HTTPException(status_code=500, detail="Database error. Please try again later.")
     except RedisError as redis_err:
-        print(f"Redis error: {redis_err}")  # Log Redis-specific error
-        logging.error(f"Redis error: {redis_err}")
+        logger.error(f"Redis error: {redis_err}")
         raise HTTPException(status_code=500, detail="Redis error. Please try again later.") 
 
 
 @l_api.delete("/remove-my-book", status_code=status.HTTP_200_OK)
-async def remove_my_book(request: RemoveFromLibRequest, crud_service: MongoCRUD = Depends(get_crud_service)):
+async def remove_my_book(request: RemoveFromLibRequest, crud_service: MongoCRUD = Depends(get_crud_service), publisher: RabbitPublisher = Depends(get_publisher)):
     try:
-        channel, connection = init_rabbit_mq()
-        channel.queue_declare(queue=RABBIT_QUEUE, durable=True)
-
         query_filter = { "user_id" : request.user_id, "book.id" : request.book_id}
 
         book = await crud_service.read_document(query_filter)
@@ -106,41 +124,33 @@ async def remove_my_book(request: RemoveFromLibRequest, crud_service: MongoCRUD
             # RabbitMQ: send message
             mq_msg_data = {
                 "user_id": request.user_id,
-                "book": book['book'],
+                "book": library_entry(book['book']),
                 "action": constants.RM_LIB 
             }
 
-            channel.basic_publish(exchange='', routing_key=RABBIT_QUEUE, body=json.dumps(mq_msg_data))
+            publisher.publish(RABBIT_QUEUE, mq_msg_data)
         
         return send_msg(msg="Book removed from library", book_id=request.book_id) 
     except PyMongoError as mongo_err:
-            print(f"MongoDB error: {mongo_err}")  # Log MongoDB-specific error
-            logging.error(f"MongoDB error: {mongo_err}")
+            logger.error(f"MongoDB error: {mongo_err}")
             raise HTTPException(status_code=500, detail="Database error. Please try again later.")
-    except Exception as mq_err:
-        print(f"Error publishing to RabbitMQ (non-critical): {mq_err}")
-        logging.error(f"Error publishing to RabbitMQ (non-critical): {mq_err}")
-    finally:
-        if connection and connection.is_open:
-            connection.close()
 
 
 @l_api.patch("/update-book-progress", status_code=status.HTTP_200_OK)
-async def update_book_progress(request: UpdateBookProgress, crud_service: MongoCRUD = Depends(get_crud_service)):
+async def update_book_progress(request: UpdateBookProgress, crud_service: MongoCRUD = Depends(get_crud_service), publisher: RabbitPublisher = Depends(get_publisher),
+                               catalog: Catalog = Depends(get_catalog)):
     try:
-        channel, connection = init_rabbit_mq()
-        channel.queue_declare(queue=RABBIT_QUEUE, durable=True)
-        
         query_filter = { "user_id" : request.user_id, "book.id" : request.book_id}
         is_finished, is_reading = False, True 
 
         book = await crud_service.read_document(query_filter)
-        old_book_payload = book['book']
 
         if book:
-            total_page_count = book['book']['page_count']
+            # the page count is in the catalog (or still in the library document if it wasn't migrated)
+            shared = (await catalog.read([request.book_id])).get(request.book_id) or book['book']
+            total_page_count = shared.get('page_count')
             # check the client page request num is within range of the book page count
-            if request.page < 1 or request.page > total_page_count:
+            if total_page_count is None or request.page < 1 or request.page > total_page_count:
                 raise HTTPException(status_code=400, detail="Page is out of range.")
             
             # if the client page request num is the same as the number of pages in book
@@ -167,92 +177,182 @@ async def update_book_progress(request: UpdateBookProgress, crud_service: MongoC
             # RabbitMQ: send message
             mq_msg_data = {
                 "user_id": request.user_id,
-                "old_book": old_book_payload,
-                "book": updated_book['book'],
+                "book": library_entry(updated_book['book']),
                 "action": constants.UPDATE_LIB
             }
             
-            channel.basic_publish(exchange='', routing_key=RABBIT_QUEUE, body=json.dumps(mq_msg_data))
+            publisher.publish(RABBIT_QUEUE, mq_msg_data)
   
         return send_msg(msg="Book progress updated.", book_id=request.book_id)
         
     except PyMongoError as mongo_err:
-        print(f"MongoDB error: {mongo_err}")  # Log MongoDB-specific error
-        logging.error(f"MongoDB error: {mongo_err}")
+        logger.error(f"MongoDB error: {mongo_err}")
         raise HTTPException(status_code=500, detail="Database error. Please try again later.")
     except ValueError as e:
-        raise HTTPException(status_code=400, detail=e)
-    except Exception as mq_err:
-        print(f"Error publishing to RabbitMQ (non-critical): {mq_err}")
-        logging.error(f"Error publishing to RabbitMQ (non-critical): {mq_err}")
-    finally:
-        if connection and connection.is_open:
-            connection.close()
+        raise HTTPException(status_code=400, detail=str(e))
 
 
-# TODO: add caching to methods below
-@l_api.get("/completed-books", status_code=status.HTTP_200_OK)
-async def completed_books(uid: str, crud_service: MongoCRUD = Depends(get_crud_service)):
-    # cache_key = f"user_{uid}_books_in_lib"
+@l_api.post("/bulk-add-books", status_code=status.HTTP_200_OK)
+async def bulk_add_books(request: BulkAddToLibRequest, crud_service: MongoCRUD = Depends(get_crud_service), publisher: RabbitPublisher = Depends(get_publisher),
+                         catalog: Catalog = Depends(get_catalog)):
+    try:
+        books = [book.model_dump() for book in request.books]
+
+        # upserts only insert books that aren't in the library yet, existing ones are left untouched
+        operations = [
+            UpdateOne(
+                { "user_id": request.user_id, "book.id": book["id"] },
+                { "$setOnInsert": { "user_id": request.user_id, "book": library_entry(book) } },
+                upsert=True,
+            )
+            for book in books
+        ]
+        res = await crud_service.bulk_write(operations) if operations else {"upserted": {}, "errors": {}}
+
+        statuses = {}
+        for i, book in enumerate(books):
+            if i in res["upserted"]:
+                statuses[book["id"]] = "added"
+            elif res["errors"].get(i, DUPLICATE_KEY) == DUPLICATE_KEY:
+                # matched an existing document, or lost an insert race to another request
+                statuses[book["id"]] = "already_in_library"
+            else:
+                statuses[book["id"]] = "error"
+        results = [{ "book_id": book["id"], "status": statuses[book["id"]] } for book in books]
+        added_books = [library_entry(book) for book in books if statuses[book["id"]] == "added"]
+
+        # only the per user fields of the request are stored, the books' details are looked up on Google in the background
+        catalog.fill_later([book["id"] for book in added_books])
+
+        # RabbitMQ: one message for the whole batch
+        if added_books:
+            publisher.publish(RABBIT_QUEUE, {
+                "user_id": request.user_id,
+                "books": added_books,
+                "action": constants.BULK_ADD_LIB
+            })
+
+        return send_msg(msg="success", added=len(added_books), results=results)
+
+    except PyMongoError as mongo_err:
+        logger.error(f"MongoDB error: {mongo_err}")
+        raise HTTPException(status_code=500, detail="Database error. Please try again later.")
 
-    # # check if the users books in library are cached
-    # cached_books = redis_client.lrange(cache_key, 0, -1)
-    # if cached_books:
-    #     cached_response = [Book(**json.loads(book_json_str)) for book_json_str in cached_books]
-    #     return send_msg(msg="success", cache=True, books=cached_response)
 
+@l_api.patch("/bulk-update-book-progress", status_code=status.HTTP_200_OK)
+async def bulk_update_book_progress(request: BulkUpdateBookProgress, crud_service: MongoCRUD = Depends(get_crud_service), publisher: RabbitPublisher = Depends(get_publisher),
+                                    catalog: Catalog = Depends(get_catalog)):
     try:
-        books = []
-        for book_doc in await crud_service.read_documents({ "user_id" : uid }):
-            if book_doc['book']['reading_progress'] and book_doc['book']['reading_progress']['is_finished']:
-                bk = Book(**book_doc['book'])
-                books.append(bk)
+        # one read for the books in the library, one catalog lookup for their page counts
+        book_ids = [update.book_id for update in request.updates]
+        book_docs = await crud_service.read_documents(
+            { "user_id": request.user_id, "book.id": { "$in": book_ids } },
+            projection={ "_id": 0, "book": 1 },
+        )
+        books = { book_doc["book"]["id"]: book_doc["book"] for book_doc in book_docs }
+        shared = await catalog.read(list(books))
+
+        results, operations, updated_books = [], [], []
+        for update in request.updates:
+            book = books.get(update.book_id)
+            if book is None:
+                results.append({ "book_id": update.book_id, "status": "not_in_library" })
+                continue
+
+            total_page_count = shared.get(update.book_id, book).get("page_count")
+            # check the client page request num is within range of the book page count
+            if total_page_count is None or update.page < 1 or update.page > total_page_count:
+                results.append({ "book_id": update.book_id, "status": "page_out_of_range" })
+                continue
+
+            # mark the book as finished on its last page
+            is_finished = update.page == total_page_count
+            progress = { "page_bookmark": update.page, "is_finished": is_finished, "is_reading": not is_finished }
+
+            operations.append(UpdateOne(
+                { "user_id": request.user_id, "book.id": update.book_id },
+                { "$set": { "book.reading_progress": progress } },
+            ))
+            updated_books.append({ **library_entry(book), "reading_progress": progress })
+            results.append({ "book_id": update.book_id, "status": "updated" })
+
+        if operations:
+            res = await crud_service.bulk_write(operations)
+            if res["errors"]:
+                # map the failed operations back to their results
+                failed = { updated_books[i]["id"] for i in res["errors"] }
+                for result in results:
+                    if result["book_id"] in failed:
+                        result["status"] = "error"
+                updated_books = [book for book in updated_books if book["id"] not in failed]
+
+        # RabbitMQ: one message for the whole batch
+        if updated_books:
+            publisher.publish(RABBIT_QUEUE, {
+                "user_id": request.user_id,
+                "books": updated_books,
+                "action": constants.BULK_UPDATE_LIB
+            })
 
-            # add to cache
-            # redis_client.lpush(cache_key, json.dumps(book_doc['book']))
-            # redis_client.expire(cache_key, 86400)     # Set expiration 
+        return send_msg(msg="Book progress updated.", updated=len(updated_books), results=results)
+
+    except PyMongoError as mongo_err:
+        logger.error(f"MongoDB error: {mongo_err}")
+        raise HTTPException(status_code=500, detail="Database error. Please try again later.")
+
+
+# Progress views skip the (long) description and anything but the book itself
+PROGRESS_VIEW_PROJECTION = { "_id": 0, "user_id": 0, "book.description": 0 }
+PROGRESS_VIEW_OMIT = ("description",)
+
+async def books_by_progress(uid: str, flag: str, crud_service: MongoCRUD, catalog: Catalog) -> tuple[list[bytes], bool]:
+    """
+    Returns the user's serialized books whose reading progress 'flag' is set, and whether they came from the cache.
+    Served from the library cache when it's built, otherwise by an indexed Mongo query.
+    """
+    cached_books = book_cache.read_books_by_progress(redis_client, uid, flag)
+    if cached_books is not None:
+        return await catalog.join(cached_books, PROGRESS_VIEW_OMIT), True
+
+    book_docs = await crud_service.read_documents(
+        { "user_id" : uid, f"book.reading_progress.{flag}": True },
+        projection=PROGRESS_VIEW_PROJECTION,
+    )
+    return await catalog.join_docs(book_docs, PROGRESS_VIEW_OMIT), False
+
+
+@l_api.get("/completed-books", status_code=status.HTTP_200_OK)
+async def completed_books(uid: str, crud_service: MongoCRUD = Depends(get_crud_service), catalog: Catalog = Depends(get_catalog)):
+    try:
+        books, cached = await books_by_progress(uid, book_cache.FINISHED, crud_service, catalog)
 
         if not books:
-            print(f"No completed books found for user_id: {uid}")
+            logger.info("No completed books found", extra={"user_id": uid})
             raise HTTPException(status_code=400, detail="No finished books found")
         
-        return send_msg(msg="success", books=books)
+        return send_raw_msg("success", "books", raw_json_list(books), cache=cached)
         
     except PyMongoError as mongo_err:
-            print(f"MongoDB error: {mongo_err}")  # Log MongoDB-specific error
-            logging.error(f"MongoDB error: {mongo_err}")
+            logger.error(f"MongoDB error: {mongo_err}")
             raise HTTPException(status_code=500, detail="Database error. Please try again later.")
+    except RedisError as redis_err:
+        logger.error(f"Redis error: {redis_err}")
+        raise HTTPException(status_code=500, detail="Redis error. Please try again later.") 
 
 
 @l_api.get("/in-progress-books", status_code=status.HTTP_200_OK)
-async def in_progress_books(uid: str, crud_service: MongoCRUD = Depends(get_crud_service)):
-    # cache_key = f"user_{uid}_books_in_lib"
-
-    # # check if the users books in library are cached
-    # cached_books = redis_client.lrange(cache_key, 0, -1)
-    # if cached_books:
-    #     cached_response = [Book(**json.loads(book_json_str)) for book_json_str in cached_books]
-    #     return send_msg(msg="success", cache=True, books=cached_response)
-
+async def in_progress_books(uid: str, crud_service: MongoCRUD = Depends(get_crud_service), catalog: Catalog = Depends(get_catalog)):
     try:
-        client = DBClient.get_instance()
-        collection = client.db['books']
-        
-        books = []
-        for book_doc in await crud_service.read_documents({ "user_id" : uid }):
-            if book_doc['book']['reading_progress'] and book_doc['book']['reading_progress']['is_reading']:
-                bk = Book(**book_doc['book'])
-                books.append(bk)
-
-            # add to cache
-            # redis_client.lpush(cache_key, json.dumps(book_doc['book']))
-            # redis_client.expire(cache_key, 86400)     # Set expiration 
+        books, cached = await books_by_progress(uid, book_cache.READING, crud_service, catalog)
+
         if not books:
-            print(f"No books in progress found for user_id: {uid}")
-            raise HTTPException(status_code=400, detail="No finished books found")
+            logger.info("No books in progress found", extra={"user_id": uid})
+            raise HTTPException(status_code=400, detail="No books in progress found")
             
-        return send_msg(msg="success", books=books)
+        return send_raw_msg("success", "books", raw_json_list(books), cache=cached)
     except PyMongoError as mongo_err:
-            print(f"MongoDB error: {mongo_err}")  # Log MongoDB-specific error
-            logging.error(f"MongoDB error: {mongo_err}")
-            raise HTTPException(status_code=500, detail="Database error. Please try again later.")
\ No newline at end of file
+            logger.error(f"MongoDB error: {mongo_err}")
+            raise HTTPException(status_code=500, detail="Database error. Please try again later.")
+    except RedisError as redis_err:
+        logger.error(f"Redis error: {redis_err}")
+        raise HTTPException(status_code=500, detail="Redis error. Please try again later.") 
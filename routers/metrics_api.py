@@ -0,0 +1,12 @@
+from fastapi import APIRouter, Response
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+m_api = APIRouter()
+
+
+@m_api.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """
+    Prometheus scrape endpoint: route, Mongo, Redis, RabbitMQ, Google Books & cache metrics for this worker.
+    """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
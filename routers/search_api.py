@@ -1,122 +1,390 @@
-from fastapi import APIRouter, HTTPException
-import httpx, os, json
+from fastapi import APIRouter, HTTPException, Depends, Query
+from pymongo.errors import PyMongoError
+from redis.exceptions import RedisError
+import httpx, os, orjson, asyncio, logging, math, time
 
 from lib.redis import redis_client
-from schemas.book import Book, ReadingProgess
+from lib.l1cache import L1Cache, publish_invalidation
+from lib.google_books import GoogleBooksClient, UpstreamUnavailable
+from lib.catalog import Catalog
+from lib import suggest, search_history
+from schemas.book import Book, ReadingProgess, build_book
 from schemas.search import SearchItem
+from crud.crud import MongoCRUD
+from dependencies import get_google_books, get_crud_service, get_catalog
+from utils.stats import get_cache_stats, cache_stats
+from utils.utils import raw_json_response
+from utils.singleflight import SingleFlight, RedisSingleFlight
+import constants
 
 s_api = APIRouter()
+logger = logging.getLogger(__name__)
+
+SEARCH_DETAIL_CONCURRENCY = int(os.getenv("SEARCH_DETAIL_CONCURRENCY", "8"))   # max detail calls in flight per search
+SEARCH_DETAIL_TIMEOUT = float(os.getenv("SEARCH_DETAIL_TIMEOUT", "3"))         # seconds before a detail call is given up on
+SEARCH_PARTIAL_TTL = int(os.getenv("SEARCH_PARTIAL_TTL", "60"))                 # seconds before results missing some details are refreshed
+
+VOLUME_CACHE_TTL = int(os.getenv("VOLUME_CACHE_TTL", str(86400 * 7)))            # volume details rarely change
+VOLUME_CACHE_MAX_BYTES = int(os.getenv("VOLUME_CACHE_MAX_BYTES", "16384"))       # larger entries aren't cached
+
+volume_cache_stats = get_cache_stats("volume")
+
+# In-process caches in front of Redis for the hottest, rarely changing reads.
+# Kept short lived, and dropped everywhere through pub/sub when a worker rewrites the key.
+volume_l1 = L1Cache("volume", max_entries=int(os.getenv("L1_VOLUME_MAX_ENTRIES", "5000")), ttl=float(os.getenv("L1_VOLUME_TTL", "300")))
+search_l1 = L1Cache("search", max_entries=int(os.getenv("L1_SEARCH_MAX_ENTRIES", "1000")), ttl=float(os.getenv("L1_SEARCH_TTL", "30")))
+
+# Search results are fresh for the soft TTL. Between the soft & hard TTL the stale
+# results are served right away while one background task refreshes them.
+SEARCH_SOFT_TTL = int(os.getenv("SEARCH_SOFT_TTL", "600"))
+SEARCH_HARD_TTL = int(os.getenv("SEARCH_HARD_TTL", "3600"))
+SEARCH_REFRESH_CONCURRENCY = int(os.getenv("SEARCH_REFRESH_CONCURRENCY", "4"))   # background refreshes per worker
+# Past the hard TTL results are only served if Google can't be reached (stale-if-error), up to this age
+SEARCH_STALE_IF_ERROR_TTL = max(SEARCH_HARD_TTL, int(os.getenv("SEARCH_STALE_IF_ERROR_TTL", "86400")))
+
+# Searches missing from the cache are answered from the local catalog (every book fetched before) when it has
+# a full page of books matching every word of the query; Google is only asked otherwise, or for deeper pages
+SEARCH_LOCAL = os.getenv("SEARCH_LOCAL", "true").lower() == "true"
+SEARCH_LOCAL_MAX_DEPTH = int(os.getenv("SEARCH_LOCAL_MAX_DEPTH", "40"))     # results past this position always come from Google
+
+SUGGEST_MAX_LIMIT = 20      # max completions per /search/suggest call
+
+search_cache_stats = get_cache_stats("search")
+local_search_stats = get_cache_stats("search_local")
+catalog_tasks: set[asyncio.Task] = set()
+refresh_slots = asyncio.Semaphore(SEARCH_REFRESH_CONCURRENCY)
+refresh_tasks: set[asyncio.Task] = set()
+
+# Coalesce concurrent cache misses for the same search into one upstream fetch
+SEARCH_REDIS_LOCK = os.getenv("SEARCH_REDIS_LOCK", "false").lower() == "true"   # also across workers & containers
+
+search_flight = SingleFlight()
+search_lock = RedisSingleFlight(redis_client) if SEARCH_REDIS_LOCK else None
+
+async def fetch_volume_details(books_api: GoogleBooksClient, volume_id: str, sem: asyncio.Semaphore) -> dict[str, any] | None:
+    """
+    Second API call to get higher res cover images & the full description.
+    Returns None if the call fails, is too slow or Google is unavailable.
+    """
+    async with sem:
+        try:
+            data = await books_api.volume(volume_id, timeout=SEARCH_DETAIL_TIMEOUT)
+            volume_info = data.get("volumeInfo", {})
+            # only keep what build_book reads from the details
+            return {"description": volume_info.get("description"), "imageLinks": volume_info.get("imageLinks", {})}
+        except (UpstreamUnavailable, httpx.HTTPError) as e:
+            logger.debug("Volume detail lookup failed", extra={"volume_id": volume_id, "error": repr(e)})
+            return None
+
+
+async def get_volume_details(books_api: GoogleBooksClient, items: list[dict[str, any]]) -> tuple[list[dict[str, any]], bool]:
+    """
+    Returns the details for every search hit, in order, and whether all of them were found.
+    Volume details are the same for every user & query, so they are served from the
+    volume cache when possible and only the misses are fetched from Google (concurrently).
+    Hits whose lookup fails fall back to the search hit's own 'volumeInfo'.
+    """
+    volume_ids = [item.get("id") for item in items]
+
+    # in-process L1 first, then one MGET for the rest
+    details = [volume_l1.get(constants.VOLUME_CACHE_KEY(vid)) for vid in volume_ids]
+    l1_misses = [i for i, d in enumerate(details) if d is None]
+    if l1_misses:
+        cached = redis_client.mget([constants.VOLUME_CACHE_KEY(volume_ids[i]) for i in l1_misses])
+        for i, c in zip(l1_misses, cached):
+            if c:
+                details[i] = orjson.loads(c)
+                volume_l1.set(constants.VOLUME_CACHE_KEY(volume_ids[i]), details[i])
+
+    misses = [i for i, d in enumerate(details) if d is None]
+    volume_cache_stats.record(hits=len(items) - len(misses), misses=len(misses))
+
+    sem = asyncio.Semaphore(SEARCH_DETAIL_CONCURRENCY)
+    fetched = await asyncio.gather(*(fetch_volume_details(books_api, volume_ids[i], sem) for i in misses))
+
+    pipe = redis_client.pipeline(transaction=False)
+    for i, d in zip(misses, fetched):
+        if d is None:
+            details[i] = items[i].get("volumeInfo", {})
+            continue
+        details[i] = d
+        payload = orjson.dumps(d)
+        # don't let a few huge descriptions crowd out the rest of the cache
+        if len(payload) <= VOLUME_CACHE_MAX_BYTES:
+            volume_key = constants.VOLUME_CACHE_KEY(volume_ids[i])
+            pipe.setex(volume_key, VOLUME_CACHE_TTL, payload)
+            publish_invalidation(pipe, volume_key)
+            volume_l1.set(volume_key, d)
+    pipe.execute()
+
+    return details, all(d is not None for d in fetched)
+
+
+def normalize_query(bookname: str) -> str:
+    """
+    "Dune", "dune " and "DUNE" are the same search.
+    """
+    return " ".join(bookname.split()).lower()
+
+
+async def fetch_search_results(books_api: GoogleBooksClient, query: str, max_results: int, start_index: int, lang: str) -> tuple[list[dict[str, any]], bool]:
+    """
+    Runs a search against the Google Books API and returns the books as plain dicts,
+    and whether every book got its full details (False means the results are partial).
+    The result is the same for every user, so it is what gets cached.
+    """
+    # Raises UpstreamUnavailable if Google can't be used right now, httpx.HTTPStatusError on other 4xx
+    data = await books_api.search(query, max_results, start_index, lang)
+
+    # If no books are found, return an error message
+    if "items" not in data:
+        raise HTTPException(status_code=404, detail="No books found.")
+
+    items = data.get('items', [])
+    details, complete = await get_volume_details(books_api, items)
+
+    books = []
+    for item, d in zip(items, details):
+        book_data = build_book(item, d)
+        if book_data.description is None:
+            continue
+        books.append(book_data.model_dump())
+    return books, complete
+
+
+async def user_library(crud_service: MongoCRUD, uid: str, ids: list[str]) -> dict[str, dict[str, any]]:
+    """
+    Returns the user's own favorite & reading progress for the search results already in their library,
+    keyed by book id. It's sent next to the shared results rather than merged into them,
+    so cached results can be returned without decoding.
+    """
+    user_docs = await crud_service.read_documents(
+        {"user_id": uid, "book.id": {"$in": ids}},
+        projection={"_id": 0, "book.id": 1, "book.is_favorite": 1, "book.reading_progress": 1},
+    )
+    return {
+        doc["book"]["id"]: {"is_favorite": doc["book"].get("is_favorite", False), "reading_progress": doc["book"].get("reading_progress")}
+        for doc in user_docs
+    }
+
+
+def read_search_cache(cache_key: str) -> tuple[str, str, float] | None:
+    """
+    Returns the cached (serialized books, serialized ids, fetched at) for a search, or None on a miss.
+    """
+    entry = search_l1.get(cache_key)
+    if entry is not None:
+        return entry
+
+    raw_books, raw_ids, fetched_at = redis_client.hmget(cache_key, "books", "ids", "fetched_at")
+    if raw_books is None:
+        return None
+    entry = (raw_books, raw_ids, float(fetched_at or 0))
+    search_l1.set(cache_key, entry)
+    return entry
+
+
+async def fill_search_cache(books_api: GoogleBooksClient, cache_key: str, query: str, max_results: int, start_index: int, lang: str) -> tuple[bytes, bytes, float]:
+    """
+    Fetches a search from Google, caches it and returns the serialized (books, ids, fetched at).
+    Partial results are backdated so they turn stale, and get refreshed, after SEARCH_PARTIAL_TTL.
+    """
+    books, complete = await fetch_search_results(books_api, query, max_results, start_index, lang)
+    raw_books, raw_ids, fetched_at = orjson.dumps(books), orjson.dumps([book["id"] for book in books]), time.time()
+    if complete:
+        add_to_catalog(books)
+    else:
+        fetched_at -= max(0, SEARCH_SOFT_TTL - SEARCH_PARTIAL_TTL)
+
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(cache_key, mapping={"books": raw_books, "ids": raw_ids, "fetched_at": fetched_at})
+    pipe.expire(cache_key, SEARCH_STALE_IF_ERROR_TTL)
+    publish_invalidation(pipe, cache_key)
+    pipe.execute()
+
+    # titles & authors Google returns become typeahead completions
+    suggest.add_books(redis_client, books)
+    return raw_books, raw_ids, fetched_at
+
+
+def add_to_catalog(books: list[dict[str, any]]):
+    """
+    Adds the books of a search to the catalog in the background, so later searches can be answered locally.
+    Entries that differ are replaced with these books (see Catalog.save), so only complete results are added:
+    partial results lack descriptions & covers and would overwrite full entries.
+    """
+    async def save():
+        try:
+            await Catalog.get_instance().save(books)
+        except (PyMongoError, RedisError) as e:
+            logger.warning("Could not add search results to the catalog", extra={"error": repr(e)})
+
+    task = asyncio.create_task(save())
+    catalog_tasks.add(task)
+    task.add_done_callback(catalog_tasks.discard)
+
+
+async def search_catalog(catalog: Catalog, query: str, max_results: int, start_index: int, lang: str) -> tuple[bytes, bytes] | None:
+    """
+    Answers a search from the local catalog. Returns the serialized (books, ids),
+    or None if the catalog doesn't have a full page of matches and Google has to be asked.
+    """
+    # Google's field operators (intitle:, isbn:, ...) are left to Google
+    if not SEARCH_LOCAL or ":" in query or start_index + max_results > SEARCH_LOCAL_MAX_DEPTH:
+        return None
+
+    matches = await catalog.search(query, lang, SEARCH_LOCAL_MAX_DEPTH)
+    # like Google results, books without a description aren't shown
+    page = [book for book in matches if book.get("description")][start_index:start_index + max_results]
+    found = len(page) == max_results
+    local_search_stats.record(hits=int(found), misses=int(not found))
+    if not found:
+        return None
+
+    books = [Book(**book, reading_progress=ReadingProgess()).model_dump() for book in page]
+    return orjson.dumps(books), orjson.dumps([book["id"] for book in books])
+
+
+def read_fresh_search_cache(cache_key: str) -> tuple[str, str, float] | None:
+    """
+    Like read_search_cache, but entries past the hard TTL count as misses.
+    """
+    entry = read_search_cache(cache_key)
+    if entry is None or time.time() - entry[2] > SEARCH_HARD_TTL:
+        return None
+    return entry
+
+
+async def load_search(books_api: GoogleBooksClient, cache_key: str, query: str, max_results: int, start_index: int, lang: str) -> tuple[str | bytes, str | bytes, float]:
+    """
+    Fills a search cache miss. Concurrent misses for the same key share one upstream fetch:
+    always within this worker, and across workers/containers too when SEARCH_REDIS_LOCK is on.
+    """
+    async def fill():
+        return await fill_search_cache(books_api, cache_key, query, max_results, start_index, lang)
+
+    if search_lock is None:
+        return await search_flight.do(cache_key, fill)
+    return await search_flight.do(cache_key, lambda: search_lock.do(cache_key, fill, lambda: read_fresh_search_cache(cache_key)))
+
+
+def schedule_search_refresh(books_api: GoogleBooksClient, cache_key: str, query: str, max_results: int, start_index: int, lang: str):
+    """
+    Refreshes a stale search in the background. Skipped if a refresh (or miss) for the key is already
+    in flight, or if every refresh slot is busy: the stale entry is still good until the hard TTL.
+    """
+    if search_flight.in_flight(cache_key) or refresh_slots.locked():
+        return
+
+    async def refresh():
+        async with refresh_slots:
+            try:
+                await load_search(books_api, cache_key, query, max_results, start_index, lang)
+            except (UpstreamUnavailable, httpx.HTTPError, HTTPException) as e:
+                logger.warning("Background search refresh failed", extra={"cache_key": cache_key, "error": repr(e)})
+
+    task = asyncio.create_task(refresh())
+    refresh_tasks.add(task)
+    task.add_done_callback(refresh_tasks.discard)
 
-BASE_URL = os.getenv("BASE_URL") 
-API_KEY = os.getenv("BOOK_API")
 
 @s_api.get("/search")
-async def search(bookname: str, uid: str, max_results: int = 15, start_index: int = 0):
+async def search(bookname: str, uid: str | None = None, max_results: int = 15, start_index: int = 0, lang: str = "en",
+                 books_api: GoogleBooksClient = Depends(get_google_books), crud_service: MongoCRUD = Depends(get_crud_service),
+                 catalog: Catalog = Depends(get_catalog)):
     # Check if the search term is empty
     if not bookname.strip():
         raise HTTPException(status_code=400, detail="Search item cannot be empty.")
 
-    url = f"{BASE_URL}?q={bookname}&maxResults={max_results}&startIndex={start_index}&key={API_KEY}&printType=books&langRestrict=en"
-    cache_key = f"books_{bookname}_{max_results}_{start_index}_{uid}"
-    cached_res = redis_client.get(cache_key)
+    query = normalize_query(bookname)
+    cache_key = constants.SEARCH_CACHE_KEY(query, max_results, start_index, lang)
 
-    if cached_res:
-        return {"book query": bookname, "cached": True, "data": json.loads(cached_res)}
+    # cached as the serialized book list plus the ids, so a hit never decodes the books
+    cached_res = read_search_cache(cache_key)
+    age = time.time() - cached_res[2] if cached_res is not None else None
+    cached = age is not None and age <= SEARCH_HARD_TTL
+    stale = cached and age > SEARCH_SOFT_TTL
+    search_cache_stats.record(hits=int(cached), misses=int(not cached), stale=int(stale))
 
+    if stale:
+        schedule_search_refresh(books_api, cache_key, query, max_results, start_index, lang)
+
+    # which tier answered: the search cache, the local catalog or Google
+    tier = "cache" if cached else "google"
     try:
-        # Make an asynchronous request to the Google Books API
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-
-            # If the response status code is not 200 (OK), raise an error
-            response.raise_for_status()
-
-            # Parse the JSON response
-            data = response.json()
-
-            # If no books are found, return an error message
-            if "items" not in data:
-                raise HTTPException(status_code=404, detail="No books found.")
-
-            books = []
-            for item in data.get('items', []):
-                # Second API call to get higher res cover images 
-                imgs_url = f"{BASE_URL}/{item.get('id')}"
-                res = await client.get(imgs_url)
-                res.raise_for_status()
-                d = res.json()
-
-                volume_info = item.get("volumeInfo", {})
-
-                # Get the links to the cover
-                cover_img_list = list(d['volumeInfo'].get("imageLinks", {}).values())
-
-                # Get the ISBN's to the book
-                isbn_list = list(volume_info.get("industryIdentifiers", []))
-
-                # Description
-                desc = d['volumeInfo'].get("description")
-
-                # Create Book object
-                book_data = Book(
-                    id=item.get("id"),
-                    title=volume_info.get("title", "Unknown Title"),
-                    description=desc,
-                    page_count=volume_info.get("pageCount"),
-                    average_rating=volume_info.get("averageRating"),
-                    language=volume_info.get("language"),
-                    authors=volume_info.get("authors", []),
-                    genre=volume_info.get("categories", []),
-                    cover_img=cover_img_list,
-                    isbn=isbn_list,
-                    reading_progress=ReadingProgess()
-                )
-                if book_data.description is None:
-                    continue
-                books.append(book_data)
-        redis_client.setex(cache_key, 600, json.dumps([book.dict() for book in books]))
-
-        return {"book query": bookname, "cached": False, "data": books}
-
-    except httpx.RequestError as e:
-        # Handle errors that occur during the HTTP request
-        raise HTTPException(status_code=500, detail=f"An error occurred while requesting the Google Books API: {e}")
+        local_res = None if cached else await search_catalog(catalog, query, max_results, start_index, lang)
+        if cached:
+            raw_books, raw_ids, _ = cached_res
+        elif local_res is not None:
+            raw_books, raw_ids = local_res
+            tier = "local"
+        else:
+            raw_books, raw_ids, _ = await load_search(books_api, cache_key, query, max_results, start_index, lang)
+
+    except UpstreamUnavailable as e:
+        if cached_res is None:
+            raise HTTPException(status_code=503, detail="The Google Books API is unavailable, try again later.",
+                                headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))})
+        # stale-if-error: results past their hard TTL beat no results
+        logger.info("Serving expired search results, Google Books is unavailable", extra={"cache_key": cache_key, "age": round(age)})
+        raw_books, raw_ids, _ = cached_res
+        cached = stale = True
+        tier = "cache"
 
     except httpx.HTTPStatusError as e:
         # Handle HTTP errors (e.g., 4xx, 5xx responses)
         raise HTTPException(status_code=e.response.status_code, detail=f"HTTP error: {e.response.status_code}")
 
+    library = await user_library(crud_service, uid, orjson.loads(raw_ids)) if uid else {}
+
+    envelope = {"book query": bookname, "cached": cached, "stale": stale, "tier": tier, "in_library": list(library), "library": library}
+    return raw_json_response(envelope, "data", raw_books)
+
+
+@s_api.get("/search/suggest")
+def search_suggest(prefix: str, limit: int = Query(8, ge=1, le=SUGGEST_MAX_LIMIT)):
+    """
+    Typeahead: title, author & past search completions of what the user typed so far, most popular first.
+    Answered from the redis prefix index only, never from Google.
+    """
+    return {"prefix": prefix, "suggestions": suggest.suggest(redis_client, prefix, limit)}
+
 
 @s_api.post("/recent-searches")
 def post_recent_searches(item: SearchItem):
-    cache_key = f"recent_searches_{item.uid}"
-    max_len = 5             # Max searches stored
-    ttl_seconds = 86400 * 2     # 2 day (expiration time)
-
     # Check if the search term is empty
     if not item.search_item.strip():
         raise HTTPException(status_code=400, detail="Search item cannot be empty.")
 
-    # Check if the search item is in the cache
-    # if so, remove it and then it will be added to the front of the cache
-    if item.search_item in redis_client.lrange(cache_key, 0, -1):
-        redis_client.lrem(cache_key, 0, item.search_item)
+    query = normalize_query(item.search_item)
+    # recent & frequent searches plus the trending counts, updated by one script
+    recent_searches, frequent_searches = search_history.record(redis_client, item.uid, item.search_item, query)
 
-    redis_client.lpush(cache_key, item.search_item) # Push to the front of list
-    redis_client.ltrim(cache_key, 0, max_len - 1)   # Make sure only 10 items are kept
-    redis_client.expire(cache_key, ttl_seconds)     # Set expiration 
+    # what people search for is the strongest typeahead signal
+    suggest.add(redis_client, [(suggest.QUERY, query)], suggest.QUERY_WEIGHT)
 
-    recent_searches = redis_client.lrange(cache_key, 0, -1)     # Get list of all items
-    
-    return {"recent_searches": recent_searches, "len" : len(recent_searches)}
+    return {"recent_searches": recent_searches, "len" : len(recent_searches), "frequent_searches": frequent_searches}
 
 
 @s_api.get("/recent-searches")
 def get_recent_searches(uid: str):
-    cache_key = f"recent_searches_{uid}"
-    max_len = 5            # Max searches stored
+    recent_searches, frequent_searches = search_history.history(redis_client, uid)
+    return {"recent_searches": recent_searches, "len" : len(recent_searches), "frequent_searches": frequent_searches}
+
+
+@s_api.get("/search/trending")
+def get_trending_searches(limit: int = Query(10, ge=1, le=search_history.TRENDING_TOP_K)):
+    """
+    The most searched queries across all users lately, with their (decayed, estimated) search counts.
+    """
+    return {"trending": search_history.trending(redis_client, limit)}
+
+
+@s_api.get("/cache-stats")
+def get_cache_stats_report():
+    return {name: stats.to_dict() for name, stats in cache_stats.items()}
 
-    redis_client.ltrim(cache_key, 0, max_len - 1)   # Make sure only 10 items are kept
-    recent_searches = redis_client.lrange(cache_key, 0, -1)     # Get list of all items
 
-    return {"recent_searches": recent_searches, "len" : len(recent_searches)}
\ No newline at end of file
+@s_api.get("/upstream-stats")
+def get_upstream_stats(books_api: GoogleBooksClient = Depends(get_google_books)):
+    return books_api.stats()
@@ -24,3 +24,44 @@ class Book(BaseModel):
     cover_img: list[str] | None = None
     is_favorite: bool = False
     reading_progress: ReadingProgess | None
+
+
+# A user's library entry only holds these; everything else about a book is shared in the catalog
+LIBRARY_FIELDS = ("id", "is_favorite", "reading_progress")
+
+
+def library_entry(book: dict[str, any]) -> dict[str, any]:
+    """
+    The per user part of a book (also accepts a full book, e.g. from documents not migrated yet).
+    """
+    return {"id": book["id"], "is_favorite": book.get("is_favorite", False), "reading_progress": book.get("reading_progress")}
+
+
+def catalog_entry(book: dict[str, any]) -> dict[str, any]:
+    """
+    The shared part of a book, without its id.
+    """
+    return {field: value for field, value in book.items() if field not in LIBRARY_FIELDS}
+
+
+def build_book(item: dict[str, any], details: dict[str, any]) -> Book:
+    """
+    Builds a Book from Google data: a search hit (or a volume lookup) and the volume's detail 'volumeInfo'
+    (which carries the higher res covers and the full description).
+    """
+    volume_info = item.get("volumeInfo", {})
+
+    # Create Book object
+    return Book(
+        id=item.get("id"),
+        title=volume_info.get("title", "Unknown Title"),
+        description=details.get("description"),
+        page_count=volume_info.get("pageCount"),
+        average_rating=volume_info.get("averageRating"),
+        language=volume_info.get("language"),
+        authors=volume_info.get("authors", []),
+        genre=volume_info.get("categories", []),
+        cover_img=list(details.get("imageLinks", {}).values()),   # Get the links to the cover
+        isbn=list(volume_info.get("industryIdentifiers", [])),      # Get the ISBN's to the book
+        reading_progress=ReadingProgess()
+    )
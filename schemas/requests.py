@@ -1,6 +1,7 @@
 from schemas.book import Book
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
+import constants
 
 class BaseRequest(BaseModel):
     user_id: str
@@ -21,4 +22,16 @@ class AddToLibRequest(BaseModel):
     book: Book
 
 class UpdateBookProgress(BaseRequest):
-    page: int
\ No newline at end of file
+    page: int
+
+class BulkAddToLibRequest(BaseModel):
+    user_id: str
+    books: list[Book] = Field(min_length=1, max_length=constants.MAX_BULK_ITEMS)
+
+class ProgressUpdate(BaseModel):
+    book_id: str
+    page: int
+
+class BulkUpdateBookProgress(BaseModel):
+    user_id: str
+    updates: list[ProgressUpdate] = Field(min_length=1, max_length=constants.MAX_BULK_ITEMS)
@@ -0,0 +1,100 @@
+import json
+import fakeredis
+from bson import ObjectId
+import pytest
+
+import constants
+from lib import book_cache
+
+
+def doc(book_id, ts, **progress):
+    return {"_id": ObjectId.from_datetime(ts), "book": {"id": book_id, "reading_progress": progress}}
+
+
+def build(r, uid, docs, kind=book_cache.LIB):
+    return book_cache.rebuild(r, uid, docs, kind, book_cache.version(r, uid))
+
+
+@pytest.fixture
+def r():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+@pytest.fixture
+def ts():
+    from datetime import datetime, timezone
+    return datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def test_put_skips_unbuilt_cache(r):
+    book_cache.put_book(r, "u", {"id": "b1"}, book_cache.LIB)
+
+    assert not r.exists(constants.LIB_CACHE_KEY("u"), constants.LIB_ORDER_KEY("u"))
+    # the version still moves, so a rebuild reading Mongo concurrently won't swap in
+    assert book_cache.version(r, "u") == "1"
+
+
+def test_put_updates_book_in_place_and_progress_sets(r, ts):
+    build(r, "u", [doc("b1", ts)])
+    score = r.zscore(constants.LIB_ORDER_KEY("u"), "b1")
+
+    book_cache.put_book(r, "u", {"id": "b1", "reading_progress": {"is_finished": True}}, book_cache.LIB)
+    assert r.zscore(constants.LIB_ORDER_KEY("u"), "b1") == score
+    assert r.zscore(constants.LIB_FINISHED_KEY("u"), "b1") == score
+
+    book_cache.put_book(r, "u", {"id": "b1", "reading_progress": {"is_reading": True}}, book_cache.LIB)
+    assert r.zscore(constants.LIB_FINISHED_KEY("u"), "b1") is None
+    assert r.zscore(constants.LIB_READING_KEY("u"), "b1") == score
+    assert json.loads(r.hget(constants.LIB_CACHE_KEY("u"), "b1"))["reading_progress"] == {"is_reading": True}
+
+
+def test_rebuild_orders_same_second_books_by_id(r, ts):
+    # ObjectIds made in the same second: only their _id order tells them apart
+    docs = [{"_id": ObjectId(), "book": {"id": f"b{i}"}} for i in range(5)]
+
+    books = build(r, "u", list(reversed(docs)))
+
+    newest_first = [f"b{i}" for i in reversed(range(5))]
+    assert [json.loads(book)["id"] for book in books] == newest_first
+    assert [json.loads(book)["id"] for book in book_cache.read_books(r, "u", book_cache.LIB)] == newest_first
+
+
+def test_rebuild_not_swapped_in_when_version_moved(r, ts):
+    cache_version = book_cache.version(r, "u")
+    # a consumer write lands while the rebuild reads Mongo
+    book_cache.remove_book(r, "u", "b1", book_cache.LIB)
+
+    books = book_cache.rebuild(r, "u", [doc("b1", ts)], book_cache.LIB, cache_version)
+
+    assert [json.loads(book)["id"] for book in books] == ["b1"]
+    assert book_cache.read_books(r, "u", book_cache.LIB) is None
+    assert not r.keys("*_rebuild_*")
+
+
+def test_rebuild_deletes_live_keys_without_books(r, ts):
+    build(r, "u", [doc("b1", ts, is_finished=True)])
+
+    build(r, "u", [doc("b1", ts)])
+
+    assert not r.exists(constants.LIB_FINISHED_KEY("u"))
+    assert r.exists(constants.LIB_ORDER_KEY("u"))
+
+
+def test_read_by_progress(r, ts):
+    assert book_cache.read_books_by_progress(r, "u", book_cache.FINISHED) is None
+
+    build(r, "u", [doc("b1", ts, is_finished=True), doc("b2", ts.replace(minute=1)), doc("b3", ts.replace(minute=2), is_finished=True)])
+
+    books = book_cache.read_books_by_progress(r, "u", book_cache.FINISHED)
+    assert [json.loads(book)["id"] for book in books] == ["b3", "b1"]
+    assert book_cache.read_books_by_progress(r, "u", book_cache.READING) == []
+
+
+def test_evicted_hash_is_a_miss(r, ts):
+    build(r, "u", [doc("b1", ts, is_finished=True), doc("b2", ts.replace(minute=1))])
+    # volatile-lfu evicted the hash, then a put recreated it with a single book
+    r.delete(constants.LIB_CACHE_KEY("u"))
+    book_cache.put_book(r, "u", {"id": "b2"}, book_cache.LIB)
+
+    assert book_cache.read_books(r, "u", book_cache.LIB) is None
+    assert book_cache.read_books_by_progress(r, "u", book_cache.FINISHED) is None
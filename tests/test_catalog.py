@@ -0,0 +1,140 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import fakeredis
+import httpx
+import mongomock
+import orjson
+import pytest
+
+import constants
+from crud.crud import MongoCRUD
+from lib import catalog
+from lib.catalog import Catalog, splice, null_field
+from lib.google_books import UpstreamUnavailable
+
+
+@pytest.fixture
+def r(monkeypatch):
+    r = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(catalog, "redis_client", r)
+    return r
+
+
+@pytest.fixture
+def shared(r, monkeypatch):
+    monkeypatch.setattr(Catalog, "_instance", None)
+    catalog.catalog_l1.clear()
+    catalog.unknown_books.clear()
+    with ThreadPoolExecutor(1) as executor:
+        client = SimpleNamespace(db=mongomock.MongoClient().db, executor=executor)
+        yield Catalog(MongoCRUD(client, catalog.CATALOG_COLLECTION))
+    catalog.catalog_l1.clear()
+    catalog.unknown_books.clear()
+
+
+def entry(book_id, **fields):
+    return orjson.dumps({"id": book_id, "is_favorite": False, "reading_progress": None, **fields})
+
+
+def test_splice():
+    assert orjson.loads(splice(entry("b1"), b'{"title":"T"}')) == {"id": "b1", "is_favorite": False, "reading_progress": None, "title": "T"}
+    assert splice(entry("b1"), b"{}") == entry("b1")
+
+
+@pytest.mark.parametrize("description", ["plain", 'say "hi"', "ends with \\", '\\"', ""])
+def test_null_field(description):
+    book = orjson.dumps({"id": "b1", "description": description, "title": "T"})
+
+    assert orjson.loads(null_field(book, "description")) == {"id": "b1", "description": None, "title": "T"}
+
+
+def test_null_field_leaves_null_and_missing_fields():
+    assert null_field(b'{"id":"b1","description":null}', "description") == b'{"id":"b1","description":null}'
+    assert null_field(b'{"id":"b1"}', "description") == b'{"id":"b1"}'
+
+
+def test_join_keeps_order_and_legacy_entries(shared, r):
+    r.set(constants.CATALOG_CACHE_KEY("b1"), '{"title":"One","description":"long"}')
+    shared.crud.collection.insert_one({"_id": "b3", "title": "Three", "description": "long"})
+    legacy = entry("b2", title="Two", description="long")
+
+    books = asyncio.run(shared.join([entry("b1").decode(), legacy, entry("b3")]))
+
+    assert [orjson.loads(book)["title"] for book in books] == ["One", "Two", "Three"]
+    # the Mongo read was cached
+    assert r.exists(constants.CATALOG_CACHE_KEY("b3"))
+
+    books = asyncio.run(shared.join([entry("b1"), legacy], omit=("description",)))
+    assert [orjson.loads(book)["description"] for book in books] == [None, None]
+
+
+def test_join_leaves_out_and_fills_missing_entries(shared, monkeypatch):
+    filled = []
+    monkeypatch.setattr(shared, "fill_later", filled.extend)
+
+    books = asyncio.run(shared.join([entry("b1")]))
+
+    assert books == []
+    assert filled == ["b1"]
+
+
+class FakeBooksAPI:
+    """
+    Answers volume lookups from 'volumes'; a value that is an exception is raised instead.
+    """
+    def __init__(self, volumes):
+        self.volumes = volumes
+        self.calls = []
+
+    async def volume(self, volume_id):
+        self.calls.append(volume_id)
+        res = self.volumes[volume_id]
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+
+def not_found():
+    request = httpx.Request("GET", "https://example.test")
+    return httpx.HTTPStatusError("not found", request=request, response=httpx.Response(404, request=request))
+
+
+def test_ensure_splits_found_unknown_and_unavailable(shared):
+    shared.crud.collection.insert_one({"_id": "known", "title": "Known"})
+    books_api = FakeBooksAPI({
+        "new": {"id": "new", "volumeInfo": {"title": "New"}},
+        "gone": not_found(),
+        "later": UpstreamUnavailable("circuit open"),
+    })
+
+    found, unknown = asyncio.run(shared.ensure(["known", "new", "gone", "later"], books_api))
+
+    assert found == {"known", "new"}
+    assert unknown == {"gone"}
+    assert "known" not in books_api.calls
+    assert shared.crud.collection.find_one({"_id": "new"})["title"] == "New"
+
+
+def test_fill_later_retries_then_remembers_unknown(shared, monkeypatch):
+    monkeypatch.setattr(catalog, "CATALOG_FILL_BACKOFF", 0.001)
+    books_api = FakeBooksAPI({"gone": not_found(), "later": UpstreamUnavailable("circuit open")})
+    monkeypatch.setattr(catalog.GoogleBooksClient, "get_instance", staticmethod(lambda: books_api))
+
+    async def run():
+        shared.fill_later(["gone", "later"])
+        await asyncio.sleep(0.01)
+        books_api.volumes["later"] = {"id": "later", "volumeInfo": {"title": "Later"}}
+        await shared._filler
+
+    asyncio.run(run())
+
+    assert books_api.calls.count("gone") == 1
+    assert books_api.calls.count("later") >= 2
+    assert catalog.unknown_books.get("gone")
+    assert shared.crud.collection.find_one({"_id": "later"})["title"] == "Later"
+    assert not shared._pending
+
+    # a known unknown isn't looked up again
+    shared.fill_later(["gone"])
+    assert not shared._pending
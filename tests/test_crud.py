@@ -0,0 +1,141 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import mongomock
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+import pytest
+
+from crud import crud
+from crud.crud import MongoCRUD, QueryPlanError
+
+
+@pytest.fixture
+def client():
+    with ThreadPoolExecutor(1) as executor:
+        yield SimpleNamespace(db=mongomock.MongoClient().db, executor=executor)
+
+
+class PlanCollection:
+    """
+    Stands in for a collection whose explain() reports 'stage' as the winning plan's leaf.
+    """
+    name = "library"
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.explained = 0
+
+    def find(self, query, projection=None):
+        return self
+
+    def explain(self):
+        self.explained += 1
+        return {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": self.stage}}}}
+
+    def find_one(self, query):
+        return None
+
+
+def test_check_query_plan_rejects_collscan(client):
+    db = MongoCRUD(client, "library")
+
+    db.collection = PlanCollection("IXSCAN")
+    db.check_query_plan({"user_id": "u"})
+
+    db.collection = PlanCollection("COLLSCAN")
+    with pytest.raises(QueryPlanError, match="'user_id': 'str'"):
+        db.check_query_plan({"user_id": "u"})
+
+
+def test_guard_checks_each_shape_once(client, monkeypatch):
+    monkeypatch.setattr(crud, "MONGO_EXPLAIN_QUERIES", True)
+    monkeypatch.setattr(MongoCRUD, "_checked_shapes", set())
+    db = MongoCRUD(client, "library")
+    db.collection = PlanCollection("IXSCAN")
+
+    asyncio.run(db.read_document({"user_id": "a", "book.id": "b"}))
+    asyncio.run(db.read_document({"user_id": "c", "book.id": "d"}))
+    assert db.collection.explained == 1
+
+    asyncio.run(db.read_document({"user_id": "a"}))
+    assert db.collection.explained == 2
+
+
+def test_guard_raises_on_collscan(client, monkeypatch):
+    monkeypatch.setattr(crud, "MONGO_EXPLAIN_QUERIES", True)
+    monkeypatch.setattr(MongoCRUD, "_checked_shapes", set())
+    db = MongoCRUD(client, "library")
+    db.collection = PlanCollection("COLLSCAN")
+
+    with pytest.raises(QueryPlanError):
+        asyncio.run(db.read_document({"title": "x"}))
+    # a failing shape is not remembered, it fails every time
+    with pytest.raises(QueryPlanError):
+        asyncio.run(db.read_document({"title": "y"}))
+
+
+def test_guard_off_by_default(client, monkeypatch):
+    monkeypatch.setattr(crud, "MONGO_EXPLAIN_QUERIES", False)
+    db = MongoCRUD(client, "library")
+    db.collection = PlanCollection("COLLSCAN")
+
+    asyncio.run(db.read_document({"title": "x"}))
+    assert db.collection.explained == 0
+
+
+def test_read_page_walks_newest_first(client):
+    db = MongoCRUD(client, "library")
+    ids = [ObjectId() for _ in range(5)]
+    db.collection.insert_many([{"_id": _id, "user_id": "u", "n": i} for i, _id in enumerate(ids)])
+
+    page, cursor = asyncio.run(db.read_page({"user_id": "u"}, limit=2))
+    assert [doc["n"] for doc in page] == [4, 3]
+    assert cursor == str(ids[3])
+
+    page, cursor = asyncio.run(db.read_page({"user_id": "u"}, limit=2, after=cursor))
+    assert [doc["n"] for doc in page] == [2, 1]
+
+    page, cursor = asyncio.run(db.read_page({"user_id": "u"}, limit=2, after=cursor))
+    assert [doc["n"] for doc in page] == [0]
+    assert cursor is None
+
+
+def test_read_page_exact_fit_has_no_next_page(client):
+    db = MongoCRUD(client, "library")
+    db.collection.insert_many([{"user_id": "u"} for _ in range(2)])
+
+    page, cursor = asyncio.run(db.read_page({"user_id": "u"}, limit=2, projection={"_id": 0}))
+
+    assert page == [{"user_id": "u"}, {"user_id": "u"}]
+    assert cursor is None
+
+
+def test_bulk_write_maps_upserts(client):
+    db = MongoCRUD(client, "library")
+    result = SimpleNamespace(upserted_ids={1: "a", 2: "b"}, matched_count=1, modified_count=0)
+    db.collection = SimpleNamespace(name="library", bulk_write=lambda operations, ordered: result)
+
+    res = asyncio.run(db.bulk_write([]))
+
+    assert res == {"upserted": {1: "a", 2: "b"}, "errors": {}, "matched": 1, "modified": 0}
+
+
+def test_bulk_write_maps_partial_failure(client):
+    db = MongoCRUD(client, "library")
+    details = {
+        "upserted": [{"index": 0, "_id": "new"}, {"index": 2, "_id": "other"}],
+        "writeErrors": [{"index": 1, "code": 11000, "errmsg": "duplicate key"}],
+        "nMatched": 0,
+        "nModified": 0,
+    }
+
+    def bulk_write(operations, ordered):
+        assert not ordered
+        raise BulkWriteError(details)
+
+    db.collection = SimpleNamespace(name="library", bulk_write=bulk_write)
+
+    res = asyncio.run(db.bulk_write([]))
+
+    assert res == {"upserted": {0: "new", 2: "other"}, "errors": {1: 11000}, "matched": 0, "modified": 0}
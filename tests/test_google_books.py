@@ -0,0 +1,125 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+
+from lib import google_books
+from lib.google_books import TokenBucket, CircuitBreaker
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(google_books, "time", SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(google_books, "asyncio", SimpleNamespace(sleep=clock.sleep))
+    return clock
+
+
+def test_bucket_bursts_then_paces(clock):
+    bucket = TokenBucket(rate=10, burst=3)
+
+    for _ in range(3):
+        assert asyncio.run(bucket.acquire(max_wait=0))
+    assert clock.slept == []
+
+    # empty bucket: the next token is due in 1/rate seconds
+    assert not asyncio.run(bucket.acquire(max_wait=0.05))
+    assert asyncio.run(bucket.acquire(max_wait=1))
+    assert clock.slept == [pytest.approx(0.1)]
+
+
+def test_bucket_refills_up_to_burst(clock):
+    bucket = TokenBucket(rate=10, burst=3)
+    for _ in range(3):
+        asyncio.run(bucket.acquire(max_wait=0))
+
+    clock.now += 60
+    bucket._refill()
+    assert bucket.tokens == 3
+
+
+def test_bucket_slows_down_and_recovers(clock):
+    bucket = TokenBucket(rate=16, burst=1)
+
+    bucket.slow_down()
+    assert bucket.rate == 8
+    for _ in range(10):
+        bucket.slow_down()
+    assert bucket.rate == 1
+
+    bucket.speed_up()
+    assert bucket.rate == pytest.approx(1.8)
+    for _ in range(100):
+        bucket.speed_up()
+    assert bucket.rate == 16
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert breaker.retry_after() == 30
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_honours_longer_retry_after(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+
+    breaker.record_failure(retry_after=120)
+
+    assert breaker.retry_after() == 120
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+
+    clock.now += 30
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(3):
+        breaker.record_failure()
+
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.retry_after() == 30
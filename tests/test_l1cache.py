@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+import pytest
+
+from lib import l1cache
+from lib.l1cache import L1Cache
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(l1cache, "l1_caches", [])
+    return L1Cache("test", max_entries=2, ttl=60)
+
+
+def test_lru_eviction(cache):
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+
+
+def test_own_invalidations_are_skipped(cache):
+    published = []
+    r = SimpleNamespace(publish=lambda channel, message: published.append(message))
+    cache.set("k", "mine")
+
+    l1cache.publish_invalidation(r, "k")
+    l1cache._invalidate(published[0])
+    assert cache.get("k") == "mine"
+
+    l1cache._invalidate("other-worker k")
+    assert cache.get("k") is None
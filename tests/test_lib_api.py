@@ -0,0 +1,69 @@
+import asyncio
+
+import constants
+from routers import lib_api
+from schemas.requests import BulkAddToLibRequest
+
+
+class FakeCrud:
+    def __init__(self, result):
+        self.result = result
+        self.operations = None
+
+    async def bulk_write(self, operations):
+        self.operations = operations
+        return self.result
+
+
+class FakePublisher:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, routing_key, msg):
+        self.published.append((routing_key, msg))
+        return True
+
+
+class FakeCatalog:
+    def __init__(self):
+        self.filled = []
+
+    def fill_later(self, ids):
+        self.filled.extend(ids)
+
+
+def bulk_add(result, book_ids):
+    request = BulkAddToLibRequest(user_id="u", books=[{"id": book_id, "title": book_id, "reading_progress": None} for book_id in book_ids])
+    crud, publisher, catalog = FakeCrud(result), FakePublisher(), FakeCatalog()
+    res = asyncio.run(lib_api.bulk_add_books(request, crud, publisher, catalog))
+    return res, crud, publisher, catalog
+
+
+def test_bulk_add_maps_results_by_operation_index():
+    result = {"upserted": {0: "x", 3: "y"}, "errors": {1: lib_api.DUPLICATE_KEY, 2: 121}, "matched": 1, "modified": 0}
+
+    res, crud, publisher, catalog = bulk_add(result, ["b0", "b1", "b2", "b3", "b4"])
+
+    assert res["added"] == 2
+    assert res["results"] == [
+        {"book_id": "b0", "status": "added"},
+        {"book_id": "b1", "status": "already_in_library"},
+        {"book_id": "b2", "status": "error"},
+        {"book_id": "b3", "status": "added"},
+        {"book_id": "b4", "status": "already_in_library"},
+    ]
+    # only the per user fields are written
+    assert crud.operations[0]._doc["$setOnInsert"]["book"] == {"id": "b0", "is_favorite": False, "reading_progress": None}
+    assert catalog.filled == ["b0", "b3"]
+    [(_, msg)] = publisher.published
+    assert msg["action"] == constants.BULK_ADD_LIB
+    assert [book["id"] for book in msg["books"]] == ["b0", "b3"]
+
+
+def test_bulk_add_publishes_nothing_when_nothing_added():
+    res, _, publisher, catalog = bulk_add({"upserted": {}, "errors": {}, "matched": 2, "modified": 0}, ["b0", "b1"])
+
+    assert res["added"] == 0
+    assert {r["status"] for r in res["results"]} == {"already_in_library"}
+    assert publisher.published == []
+    assert catalog.filled == []
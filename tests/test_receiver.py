@@ -0,0 +1,93 @@
+import json
+import fakeredis
+from bson import ObjectId
+import pytest
+
+import constants
+import receiver
+from lib import book_cache
+
+
+class FakeChannel:
+    """
+    Records acks/nacks and the consumer callbacks run_worker registers.
+    """
+    def __init__(self):
+        self.callbacks = {}
+        self.acked = []
+        self.nacked = []
+
+    def basic_qos(self, prefetch_count):
+        pass
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        self.callbacks[queue] = on_message_callback
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acked.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.nacked.append(delivery_tag)
+
+
+class FakeConnection:
+    """
+    Delivers the queued (queue, body) messages on the first poll, and stops the worker
+    when it next waits for a new batch (the 1s poll).
+    """
+    def __init__(self, channel, messages):
+        self.channel = channel
+        self.messages = messages
+        self.is_closed = False
+        self.polls = 0
+
+    def process_data_events(self, time_limit=None):
+        self.polls += 1
+        if self.polls > 1 and time_limit == 1:
+            raise KeyboardInterrupt
+        for tag, (queue, body) in enumerate(self.messages, start=1):
+            method = type("Deliver", (), {"routing_key": queue, "delivery_tag": tag})()
+            self.channel.callbacks[queue](self.channel, method, None, body)
+        self.messages = []
+
+    def close(self):
+        self.is_closed = True
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    r = fakeredis.FakeRedis(decode_responses=True)
+    channel = FakeChannel()
+    monkeypatch.setattr(receiver, "CONSUMER_METRICS_PORT", 0)
+    monkeypatch.setattr(receiver, "InstrumentedRedis", lambda **kwargs: r)
+
+    def run(messages):
+        connection = FakeConnection(channel, messages)
+        monkeypatch.setattr(receiver, "connect", lambda queues: (connection, channel))
+        receiver.run_worker(0, 1)
+        return connection
+
+    return r, channel, run
+
+
+def test_flush_applies_and_acks_batch(worker):
+    r, channel, run = worker
+    uid = "u1"
+    # a built library cache, which put_book only ever updates
+    book_cache.rebuild(r, uid, [{"_id": ObjectId(), "book": {"id": "old"}}], book_cache.LIB, book_cache.version(r, uid), book_cache.CACHE_TTL)
+
+    book = {"id": "b1", "is_favorite": False, "reading_progress": {}}
+    body = json.dumps({"action": constants.ADD_LIB, "user_id": uid, "book": book, "sent_at": 0})
+    connection = run([(constants.RABBIT_QUEUE_LIB, body)])
+
+    assert channel.acked == [1]
+    assert channel.nacked == []
+    assert json.loads(r.hget(constants.LIB_CACHE_KEY(uid), "b1")) == book
+    assert connection.is_closed
+
+
+def test_flush_acks_malformed_message(worker):
+    r, channel, run = worker
+    run([(constants.RABBIT_QUEUE_LIB, b"not json")])
+
+    assert channel.acked == [1]
@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+
+from utils.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_call():
+    flight = SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    async def run():
+        results = await asyncio.gather(*(flight.do("k", fetch) for _ in range(5)))
+        assert not flight.in_flight("k")
+        # done calls are forgotten, the next one fetches again
+        return results, await flight.do("k", fetch)
+
+    results, later = asyncio.run(run())
+    assert results == [1] * 5
+    assert later == 2
+
+
+def test_every_waiter_gets_the_error():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream")
+
+    async def run():
+        return await asyncio.gather(*(flight.do("k", fail) for _ in range(3)), return_exceptions=True)
+
+    assert all(isinstance(res, ValueError) for res in asyncio.run(run()))
+
+
+def test_cancelled_waiter_does_not_cancel_the_call():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def run():
+        first = asyncio.ensure_future(flight.do("k", fetch))
+        second = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == "done"
+
+
+def test_redis_singleflight_waiter_reads_holders_result():
+    import fakeredis
+    from utils.singleflight import RedisSingleFlight
+
+    r = fakeredis.FakeRedis(decode_responses=True)
+    flight = RedisSingleFlight(r, poll_interval=0.001)
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.02)
+        r.set("result", "cached")
+        return "fetched"
+
+    async def run():
+        return await asyncio.gather(flight.do("k", fetch, lambda: r.get("result")), flight.do("k", fetch, lambda: r.get("result")))
+
+    assert asyncio.run(run()) == ["fetched", "cached"]
+    assert calls == 1
+    assert not r.exists("lock_k")
@@ -0,0 +1,75 @@
+from typing import Awaitable, Callable, TypeVar
+import asyncio, uuid, time, logging
+import redis
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls in this process: while a call for a key is in flight,
+    every other caller with the same key awaits that call's result instead of making its own.
+    """
+    def __init__(self):
+        self._calls: dict[str, asyncio.Future] = {}
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._calls
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        fut = self._calls.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(fn())
+            self._calls[key] = fut
+            # forget the call once it's done, even if the caller that started it went away
+            fut.add_done_callback(lambda _: self._calls.pop(key, None))
+        # shield: one waiter being cancelled (e.g. client disconnect) must not cancel the shared call
+        return await asyncio.shield(fut)
+
+
+# Deletes the lock only if we still own it
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisSingleFlight:
+    """
+    Coalesces calls across processes & containers with a short lived Redis lock.
+    The lock holder runs 'fn' (which is expected to populate a shared cache),
+    everyone else polls 'read' until the result shows up, the lock is released or they time out.
+    """
+    def __init__(self, r: redis.Redis, lock_ttl: float = 10, wait_timeout: float = 5, poll_interval: float = 0.05):
+        self.r = r
+        self.lock_ttl = lock_ttl
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]], read: Callable[[], T | None]) -> T:
+        lock_key = f"lock_{key}"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.wait_timeout
+
+        while True:
+            if self.r.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000)):
+                try:
+                    return await fn()
+                finally:
+                    self.r.register_script(_RELEASE_SCRIPT)(keys=[lock_key], args=[token])
+
+            # someone else is fetching, wait for them to fill the cache
+            while self.r.exists(lock_key):
+                if time.monotonic() > deadline:
+                    logger.warning(f"Timed out waiting on '{lock_key}', fetching without the lock")
+                    return await fn()
+                await asyncio.sleep(self.poll_interval)
+
+            result = read()
+            if result is not None:
+                return result
+            # the holder released the lock without filling the cache (e.g. it failed): try to take over
@@ -0,0 +1,35 @@
+import threading
+
+class CacheStats:
+    """
+    Hit/miss counters for one cache, shared by every request in the worker.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0      # hits served past their freshness window
+        self._lock = threading.Lock()
+
+    def record(self, hits: int = 0, misses: int = 0, stale: int = 0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.stale += stale
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def to_dict(self) -> dict[str, any]:
+        return {"hits": self.hits, "misses": self.misses, "stale": self.stale, "hit_ratio": round(self.hit_ratio, 4)}
+
+
+# Registry of every cache's stats, keyed by cache name
+cache_stats: dict[str, CacheStats] = {}
+
+def get_cache_stats(name: str) -> CacheStats:
+    if name not in cache_stats:
+        cache_stats[name] = CacheStats(name)
+    return cache_stats[name]
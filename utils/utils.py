@@ -1,4 +1,7 @@
 from datetime import datetime, date
+from fastapi.responses import Response
+from typing import AsyncIterator
+import orjson
 
 def datetime_serializer(obj):
     if isinstance(obj, (datetime, date)): 
@@ -10,4 +13,34 @@ def send_msg(msg: str, **kwargs: any) -> dict[str, any]:
         "msg" : msg
     } 
     response.update(kwargs)
-    return response
\ No newline at end of file
+    return response
+
+def raw_json_list(items: list[str | bytes]) -> bytes:
+    """
+    Joins already serialized json values into a json array without decoding them.
+    """
+    return b"[" + b",".join(item.encode() if isinstance(item, str) else item for item in items) + b"]"
+
+def raw_json_response(envelope: dict[str, any], raw_field: str, raw_value: str | bytes) -> Response:
+    """
+    Serializes 'envelope' with 'raw_field' set to already serialized json.
+    The raw value is spliced into the body as-is, it is never decoded or validated
+    (cached payloads are validated when they are written).
+    """
+    head = orjson.dumps(envelope)
+    raw = raw_value.encode() if isinstance(raw_value, str) else raw_value
+    body = head[:-1] + (b"," if envelope else b"") + orjson.dumps(raw_field) + b":" + raw + b"}"
+    return Response(content=body, media_type="application/json")
+
+def send_raw_msg(msg: str, raw_field: str, raw_value: str | bytes, **kwargs: any) -> Response:
+    """
+    send_msg() with one field of already serialized json, see raw_json_response().
+    """
+    return raw_json_response(send_msg(msg, **kwargs), raw_field, raw_value)
+
+async def ndjson_books(books: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Turns a stream of serialized books into newline delimited json.
+    """
+    async for book in books:
+        yield book + b"\n"